@@ -21,7 +21,7 @@ try:
     # This is required to allow for multiple train type.  If the default value (-1) is used, we get error:
     # Error code 10020: Objective Q not PSD (diagonal adjustment of 2.3e+02 would be required). Set NonConvex parameter to 2 to solve model.
     # This is not in the base level 2 model.
-    gp.setParam("NonConvex", 2)
+    m.setParam("NonConvex", 2)
 
 
 
@@ -0,0 +1,635 @@
+#!/usr/bin/env python3.7
+
+# Benchmarks for the level 3 model.
+#
+# Usage:
+#   python level3/level3_benchmark.py [--seeds n] [--threads n] [--manifest path] <benchmark> [args]
+#   python level3/level3_benchmark.py lazy [max_routes]
+#   python level3/level3_benchmark.py headway [max_routes]
+#   python level3/level3_benchmark.py units [max_routes]
+#   python level3/level3_benchmark.py day [max_hours]
+#   python level3/level3_benchmark.py recovery [n_disruptions]
+#   python level3/level3_benchmark.py od [max_routes]
+#   python level3/level3_benchmark.py evaluate [max_routes]
+#   python level3/level3_benchmark.py env [n_solves]
+#   python level3/level3_benchmark.py cache [max_routes]
+#   python level3/level3_benchmark.py symmetry [max_copies]
+#   python level3/level3_benchmark.py start [max_routes] [time_limit]
+#   python level3/level3_benchmark.py consists [max_routes]
+#   python level3/level3_benchmark.py fleet [max_routes]
+#   python level3/level3_benchmark.py crew [max_routes]
+#
+# lazy: compares model size, build time and solve time of the eager model (all max-speed constraints added up
+#       front) against the lazy model (max-speed and headway constraints separated in a callback).
+# headway: time to generate the headway pairs through the shared edge index, compared with a scan over every
+#          pair of routes and edges.
+# units: coefficient ranges and solve time with times in hours, whole minutes and whole seconds.
+# day: solve time and largest model size of the rolling-horizon day model (level3_day.py) against a single
+#      model for the whole day, for an increasing number of hours.
+# recovery: replays random disruptions on the solved timetable with level3_recovery.py and reports the time to
+#           the first feasible timetable, compared with re-solving the full model.
+# od: build time and number of flow variables of passenger routing with a full OD matrix, with the flows
+#     aggregated by origin, compared with one commodity per OD pair.
+# evaluate: time to check a timetable with level3_evaluator.py, compared with the time to build the model it
+#           would otherwise be checked with.  The timetable of each copied route is the solved timetable of the
+#           route it was copied from, so the copies break the headways.
+# env: fixed overhead per solve (time outside of the optimization) of the toy model, starting a new Gurobi
+#      environment for every solve (as each run of a script does) compared with reusing one environment.
+# cache: time to build a model in Python, compared with loading it from the model cache (level3_cache.py) and
+#        patching the coefficients of new data.
+# symmetry: solve time and nodes with and without symmetry breaking, on fleets where every loco type is
+#           duplicated 1 up to max_copies times, and on a network where a route is duplicated.
+# start: time to the first incumbent and gap at a time limit, with and without the MIP start of the constructive
+#        heuristic (level3_heuristic.py).
+# consists: catalogue size and time to build it, and solve time and nodes of the consist model (one consist per
+#           route from the catalogue) compared with the integer numbers of cars w_rt.
+# fleet: time to build the time-space network of the interlining fleet (level3_fleet.py) and to solve it, for the
+#        solved timetable replicated on up to max_routes routes.  The copies of a route are shifted by a few minutes
+#        so their trips do not all start at the same time.
+# crew: number of feasible duties (counted, not listed) and time, columns and iterations of the column generation
+#       of the crew duties (level3_crew.py) for the solved timetable replicated on up to max_routes routes.
+#
+# Options (before the benchmark name):
+#   --seeds n: repeat each solve of run() with the seeds 0 to n - 1, and report the median solve time and nodes
+#              with their variances (solve_time_var, nodes_var).
+#   --threads n: thread count of the solves of run() (default: every processor).
+#   --manifest path: write the run manifest of the solves of run() (see level3_manifest.py) to path.
+#
+# Larger networks are generated from the Barrie and Lakeshore West data by replicate_routes().
+
+import copy
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import gurobipy as gp
+
+from level3_model import (init_data, build_model, optimize, headway_pairs, coefficient_ranges, solved_timetable,
+                          record_incumbents, time_to_first_incumbent, consist_catalogue)
+from level3_evaluator import prepare_network, timetable_events, evaluate
+import level3_manifest
+
+# Time limit (in seconds) for each solve in a benchmark.
+time_limit = 120
+
+# Gurobi environment shared by every model of a benchmark, started in __main__.
+env = None
+
+# Seeds each solve of run() is repeated with, and its thread count (None: Gurobi's defaults).  Set with --seeds and
+# --threads.  The records of the solves are written to the run manifest given with --manifest.
+seeds = None
+threads = None
+manifest_records = []
+
+
+def replicate_routes(data, n_routes, shared=True):
+    '''
+    Return a copy of data with n_routes routes.  Route r<k> is a copy of the shipped route r<(k-1) % 2 + 1>,
+    so the copies serve the same stations (by name) and share every edge with the route they were copied from.
+    If shared is False, the stations of the copies get new names (e.g. "Aurora (2)"), except Union.
+    '''
+    base_routes = list(data['routes'])
+    routes = []
+    route_edges, route_dist, stations, station_to_name, route_to_name = {}, {}, {}, {}, {}
+    edges, edge_len, edge_Npassengers = {}, {}, {}
+    for i in range(n_routes):
+        route = "r{}".format(i + 1)
+        base = base_routes[i % len(base_routes)]
+        routes.append(route)
+        route_edges[route] = list(data['route_edges'][base])
+        route_dist[route] = data['route_dist'][base]
+        stations[route] = list(data['stations'][base])
+        copy_number = i // len(base_routes) + 1
+        station_to_name[route] = dict(data['station_to_name'][base])
+        if not shared and copy_number > 1:
+            station_to_name[route] = {station: name if name == "Union" else "{} ({})".format(name, copy_number)
+                                      for station, name in station_to_name[route].items()}
+        route_to_name[route] = "{} ({})".format(data['route_to_name'][base], copy_number)
+        edges[route] = list(data['edges'][base])
+        edge_len[route] = dict(data['edge_len'][base])
+        edge_Npassengers[route] = dict(data['edge_Npassengers'][base])
+
+    synthetic = dict(data)
+    synthetic.update({'routes': routes, 'route_edges': route_edges, 'route_dist': route_dist,
+                      'stations': stations, 'station_to_name': station_to_name, 'route_to_name': route_to_name,
+                      'edges': edges, 'edge_len': edge_len, 'edge_Npassengers': edge_Npassengers})
+    return synthetic
+
+
+def model_size(m):
+    # Number of rows/columns in the model, as printed in the Gurobi log.
+    m.update()
+    return {'rows': m.NumConstrs, 'qconstrs': m.NumQConstrs, 'columns': m.NumVars, 'nonzeros': m.NumNZs}
+
+
+def run(data, ranges=False, **options):
+    '''
+    Build and solve one model, returning its size and timings (and its coefficient ranges if ranges is True).
+    With seeds, the model is built and solved once per seed, and the solve time and nodes are the medians, with
+    their variances in solve_time_var and nodes_var.
+    '''
+    if seeds is None:
+        return run_once(data, ranges, None, **options)
+    results = [run_once(data, ranges, seed, **options) for seed in seeds]
+    if any('error' in result for result in results):
+        return results[0]
+    result = dict(results[0])
+    for key in ('build_time', 'solve_time', 'nodes'):
+        values = [row[key] for row in results]
+        result[key] = statistics.median(values)
+        if key != 'build_time':
+            result[key + '_var'] = statistics.variance(values) if len(values) > 1 else 0.0
+    return result
+
+
+def run_once(data, ranges, seed, **options):
+    start = time.time()
+    m = build_model(data, env=env, **options)
+    size = model_size(m)
+    build_time = time.time() - start
+    if ranges:
+        for key, value in coefficient_ranges(m).items():
+            if value is not None:
+                size[key] = "[{:.0e}, {:.0e}]".format(*value)
+
+    m.setParam("OutputFlag", 0)
+    m.setParam("TimeLimit", time_limit)
+    if seed is not None or threads is not None:
+        level3_manifest.reproducible(m, seed or 0, threads)
+    result = dict(size)
+    result['build_time'] = build_time
+    try:
+        optimize(m)
+    except gp.GurobiError as e:
+        # e.g. the model is too large for the license.  Keep the row so the rest of the benchmark still runs.
+        result['error'] = e.errno
+        m.dispose()
+        return result
+
+    result.update({'solve_time': m.Runtime, 'nodes': m.NodeCount,
+                   'objective': m.objVal if m.SolCount > 0 else None, 'gap': m.MIPGap if m.SolCount > 0 else None})
+    manifest_records.append(level3_manifest.run_record(m, data, options))
+    if m._lazy_constraints:
+        result['lazy_added'] = m._lazy_added
+    m.dispose()
+    return result
+
+
+def print_table(rows, columns):
+    # The variances of repeated solves (see run()) follow their columns.
+    columns = [name for column in columns for name in (column, column + '_var')
+               if name == column or any(name in row for row in rows)]
+    if any('error' in row for row in rows):
+        columns = columns + ['error']
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join("-" if row.get(column) is None else
+                        "{:.4g}".format(row[column]) if isinstance(row[column], float) else str(row[column])
+                        for column in columns))
+
+
+def benchmark_lazy(max_routes=8):
+    # Eager vs. lazy max-speed constraints on networks with 2, 4, ..., max_routes routes.
+    data = init_data()
+    rows = []
+    for n_routes in range(2, max_routes + 1, 2):
+        synthetic = replicate_routes(data, n_routes)
+        for mode, lazy in (('eager', False), ('lazy', True)):
+            result = run(synthetic, lazy_constraints=lazy)
+            result.update({'mode': mode, 'routes': n_routes})
+            rows.append(result)
+    print_table(rows, ['routes', 'mode', 'rows', 'qconstrs', 'columns', 'lazy_added',
+                       'build_time', 'solve_time', 'nodes', 'objective'])
+    return rows
+
+
+def naive_headway_pairs(data):
+    # Reference for benchmark_headway(): compare every edge of every route with every edge of every other route.
+    station_to_name, routes, route_edges = data['station_to_name'], data['routes'], data['route_edges']
+    pairs = []
+    for i, route1 in enumerate(routes):
+        for route2 in routes[i + 1:]:
+            for edge1 in route_edges[route1]:
+                names1 = (station_to_name[route1][edge1[0]], station_to_name[route1][edge1[1]])
+                for edge2 in route_edges[route2]:
+                    names2 = (station_to_name[route2][edge2[0]], station_to_name[route2][edge2[1]])
+                    if names1 == names2 or names1 == names2[::-1]:
+                        pairs.append((route1, edge1, route2, edge2))
+    return pairs
+
+
+def benchmark_headway(max_routes=200):
+    # Headway pair generation with the shared edge index vs. the naive scan, on 2 up to max_routes routes.
+    data = init_data()
+    rows = []
+    n_routes = 2
+    while n_routes <= max_routes:
+        synthetic = replicate_routes(data, n_routes)
+        start = time.time()
+        n_pairs = sum(1 for _ in headway_pairs(synthetic))
+        indexed_time = time.time() - start
+        start = time.time()
+        n_naive = 2 * len(naive_headway_pairs(synthetic))  # One pair per direction.
+        naive_time = time.time() - start
+        rows.append({'routes': n_routes, 'pairs': n_pairs, 'naive_pairs': n_naive,
+                     'indexed_time': indexed_time, 'naive_time': naive_time})
+        n_routes *= 2
+    print_table(rows, ['routes', 'pairs', 'naive_pairs', 'indexed_time', 'naive_time'])
+    return rows
+
+
+def benchmark_units(max_routes=8):
+    # Coefficient ranges and solve time for each time unit, on networks with 2, 4, ..., max_routes routes.
+    data = init_data()
+    rows = []
+    for n_routes in range(2, max_routes + 1, 2):
+        synthetic = replicate_routes(data, n_routes)
+        for time_unit in ('h', 'min', 's'):
+            result = run(synthetic, ranges=True, time_unit=time_unit)
+            result.update({'time_unit': time_unit, 'routes': n_routes})
+            rows.append(result)
+    print_table(rows, ['routes', 'time_unit', 'Matrix', 'QObjective', 'RHS', 'solve_time', 'nodes', 'objective'])
+    return rows
+
+
+def benchmark_day(max_hours=18, window=2):
+    # Rolling horizon vs. monolithic day model for 2, 4, ..., max_hours hours of demand.
+    import level3_day
+
+    data = init_data()
+    demand = level3_day.hourly_demand(data)
+    hours = sorted(demand)
+    rows = []
+    for n_hours in range(2, max_hours + 1, 2):
+        day_demand = {hour: demand[hour] for hour in hours[:n_hours]}
+        for mode, model_hours in (('rolling', hours[:min(window, n_hours)]), ('monolithic', hours[:n_hours])):
+            # Size of the largest model solved: one window, or the whole day.
+            m = level3_day.build_window(data, day_demand, model_hours, None, env=env)
+            row = {'hours': n_hours, 'mode': mode, 'max_columns': model_size(m)['columns']}
+            m.dispose()
+            start = time.time()
+            try:
+                if mode == 'rolling':
+                    level3_day.solve_day(data, day_demand, window=window, time_limit=time_limit, env=env)
+                else:
+                    level3_day.solve_day_monolithic(data, day_demand, time_limit=time_limit, env=env)
+            except gp.GurobiError as e:
+                row['error'] = e.errno
+            row['solve_time'] = time.time() - start
+            rows.append(row)
+    print_table(rows, ['hours', 'mode', 'max_columns', 'solve_time'])
+    return rows
+
+
+def random_disruption(data, rng):
+    # A random delay, blocked edge or lost unit on the shipped network.
+    route = rng.choice(list(data['routes']))
+    edge = rng.choice(data['route_edges'][route])
+    kind = rng.choice(['delay', 'delay', 'blocked_edge', 'lost_unit'])
+    if kind == 'delay':
+        return {'type': kind, 'route': route, 'edge': edge, 'direction': rng.randint(0, 1), 'delay': rng.randint(1, 20)}
+    if kind == 'blocked_edge':
+        start = rng.randint(0, 120)
+        return {'type': kind, 'route': route, 'edge': edge, 'start': start, 'end': start + rng.randint(5, 30)}
+    return {'type': kind, 'route': route}
+
+
+def benchmark_recovery(n_disruptions=20, seed=0):
+    # Time to first feasible timetable when recovering from n_disruptions random disruptions.
+    import level3_recovery
+
+    data = init_data()
+    m = build_model(data, env=env)
+    m.setParam("OutputFlag", 0)
+    record_incumbents(m)
+    optimize(m)
+    timetable = solved_timetable(m)
+    rows = [{'disruption': 'full re-plan', 'window': '-', 'feasible': m.SolCount > 0,
+             'time_to_first': time_to_first_incumbent(m), 'solve_time': m.Runtime}]
+    m.dispose()
+
+    rng = random.Random(seed)
+    for _ in range(n_disruptions):
+        disruption = random_disruption(data, rng)
+        new_timetable, stats = level3_recovery.recover(data, timetable, disruption, env=env)
+        rows.append({'disruption': disruption['type'], 'window': stats['window'], 'feasible': new_timetable is not None,
+                     'time_to_first': stats['time_to_first'], 'solve_time': stats['solve_time']})
+    print_table(rows, ['disruption', 'window', 'feasible', 'time_to_first', 'solve_time'])
+    return rows
+
+
+def benchmark_od(max_routes=12):
+    # Passenger routing with a full OD matrix (10 passengers between every pair of stations).
+    data = init_data()
+    rows = []
+    for n_routes in range(2, max_routes + 1, 2):
+        synthetic = replicate_routes(data, n_routes, shared=False)
+        names = sorted({name for route in synthetic['routes'] for name in synthetic['station_to_name'][route].values()})
+        synthetic['od_demand'] = {(origin, destination): 10 for origin in names for destination in names
+                                  if origin != destination}
+        start = time.time()
+        m = build_model(synthetic, passenger_routing=True, env=env)
+        m.update()
+        build_time = time.time() - start
+        n_arcs = 2 * sum(len(synthetic['route_edges'][route]) for route in synthetic['routes'])
+        rows.append({'routes': n_routes, 'stations': len(names), 'od_pairs': len(synthetic['od_demand']),
+                     'flow_vars': len(m._flow), 'per_pair_vars': len(synthetic['od_demand']) * n_arcs,
+                     'build_time': build_time})
+        m.dispose()
+    print_table(rows, ['routes', 'stations', 'od_pairs', 'flow_vars', 'per_pair_vars', 'build_time'])
+    return rows
+
+
+def duplicate_loco_types(data, copies):
+    # Return a copy of data where each loco type has copies identical types (e.g. 'MP40', 'MP40 (2)').
+    loco_types = [loco_type if copy_number == 1 else "{} ({})".format(loco_type, copy_number)
+                  for loco_type in data['loco_types'] for copy_number in range(1, copies + 1)]
+    synthetic = dict(data, loco_types=gp.tuplelist(loco_types))
+    for key in ('loco_Cfix', 'loco_Ckm', 'loco_speed', 'car_Cfix', 'car_Ckm', 'car_cap', 'car_min', 'car_max'):
+        synthetic[key] = gp.tupledict({loco_type: data[key][loco_type.split(" (")[0]] for loco_type in loco_types})
+    return synthetic
+
+
+def benchmark_symmetry(max_copies=3):
+    # Symmetry breaking on duplicated loco types (2 routes), and on a duplicated route (3 routes).
+    data = init_data()
+    rows = []
+    cases = [("{} loco copies".format(copies), duplicate_loco_types(data, copies)) for copies in range(1, max_copies + 1)]
+    # Copies of the routes are only symmetric with the route they were copied from if they are in the same transfers.
+    synthetic = replicate_routes(data, 3)
+    synthetic['transfers'] = [dict(transfer, routes=None) for transfer in data['transfers']]
+    cases.append(("3 routes", synthetic))
+    for case, synthetic in cases:
+        for symmetry_breaking in (False, True):
+            result = run(synthetic, symmetry_breaking=symmetry_breaking)
+            result.update({'case': case, 'symmetry_breaking': symmetry_breaking})
+            rows.append(result)
+    print_table(rows, ['case', 'symmetry_breaking', 'columns', 'solve_time', 'nodes', 'objective'])
+    return rows
+
+
+def benchmark_start(max_routes=4, limit=10):
+    # Time to first incumbent and final gap with and without the heuristic MIP start, on 2 up to max_routes routes.
+    import level3_heuristic
+
+    data = init_data()
+    rows = []
+    for n_routes in range(2, max_routes + 1):
+        synthetic = replicate_routes(data, n_routes)
+        start = time.time()
+        timetable = level3_heuristic.initial_timetable(synthetic)
+        heuristic_time = time.time() - start
+        for use_start in (False, True):
+            row = {'routes': n_routes, 'mip_start': use_start, 'heuristic_time': heuristic_time}
+            m = build_model(synthetic, env=env)
+            m.setParam("TimeLimit", limit)
+            if use_start:
+                row['start_violations'] = len(level3_heuristic.set_start(m, timetable))
+            record_incumbents(m)
+            try:
+                optimize(m)
+                row.update({'time_to_first': time_to_first_incumbent(m), 'objective': m.objVal if m.SolCount else None,
+                            'gap': m.MIPGap if m.SolCount else None})
+            except gp.GurobiError as e:
+                row['error'] = e.errno
+            m.dispose()
+            rows.append(row)
+    print_table(rows, ['routes', 'mip_start', 'heuristic_time', 'start_violations', 'time_to_first', 'objective', 'gap'])
+    return rows
+
+
+def benchmark_consists(max_routes=3):
+    # Consist catalogue vs. integer numbers of cars on networks with 2 up to max_routes routes.
+    data = init_data()
+    start = time.time()
+    catalogue = consist_catalogue(data)
+    print("{} consists in the catalogue, built in {:.4f}s".format(len(catalogue['loco']), time.time() - start))
+    rows = []
+    for n_routes in range(2, max_routes + 1):
+        synthetic = replicate_routes(data, n_routes)
+        for consists in (False, True):
+            result = run(synthetic, consists=consists)
+            result.update({'routes': n_routes, 'consists': consists})
+            rows.append(result)
+    print_table(rows, ['routes', 'consists', 'columns', 'rows', 'build_time', 'solve_time', 'nodes', 'objective'])
+    return rows
+
+
+def benchmark_fleet(max_routes=4096):
+    # Fleet with interlining on networks with 2, 4, 8, ..., max_routes routes.
+    import level3_fleet
+
+    data = init_data()
+    with build_model(data, env=env) as m:
+        optimize(m)
+        timetable = solved_timetable(m)
+    rows = []
+    n_routes = 2
+    while n_routes <= max_routes:
+        synthetic = replicate_routes(data, n_routes)
+        replicated = shift_copies(replicate_timetable(timetable, synthetic), synthetic)
+        for interline in (False, True):
+            row = {'routes': n_routes, 'interline': interline}
+            try:
+                row.update(level3_fleet.min_fleet(synthetic, replicated, interline, env=env))
+            except gp.GurobiError as e:
+                # e.g. the network is too large for the license: still report the time to build it.
+                start = time.time()
+                network = level3_fleet.fleet_network(synthetic, replicated, interline)
+                row.update({'trips': network['trips'], 'arcs': len(network['arcs']), 'build_time': time.time() - start,
+                            'error': e.errno})
+            rows.append(row)
+        n_routes *= 2
+    print_table(rows, ['routes', 'interline', 'trips', 'arcs', 'build_time', 'solve_time', 'fleet'])
+    return rows
+
+
+def replicate_timetable(timetable, synthetic):
+    # Timetable of a replicate_routes() network: every route runs the timetable of the route it was copied from.
+    base_routes = sorted(timetable['loco_type'], key=lambda route: int(route[1:]))
+    replicated = {'time_unit': timetable['time_unit']}
+    for key in ('loco_type', 'cars', 'cycle_time', 'period', 'arrival_times', 'departure_times'):
+        replicated[key] = {route: timetable[key][base_routes[i % len(base_routes)]]
+                           for i, route in enumerate(synthetic['routes'])}
+    return replicated
+
+
+def shift_copies(replicated, synthetic):
+    # Shift the timetable of copy k of each shipped route by k minutes (modulo the period), so the trips of the
+    # copies do not all start at the same time.  The shipped data has two routes, so copy k is routes r<2k+1> and
+    # r<2k+2> (see replicate_routes()), i.e. the routes at indices 2k and 2k + 1.  The times are in minutes.
+    for key in ('arrival_times', 'departure_times'):
+        replicated[key] = {route: {direction: {edge: t + i // 2 % synthetic['period'] for edge, t in times.items()}
+                                   for direction, times in replicated[key][route].items()}
+                           for i, route in enumerate(synthetic['routes'])}
+    return replicated
+
+
+def benchmark_crew(max_routes=16):
+    # Crew scheduling by column generation on networks with 2, 4, 8, ..., max_routes routes (copies shifted as for
+    # the fleet), compared with the number of duties a full enumeration would generate.
+    import level3_crew
+
+    data = init_data()
+    with build_model(data, env=env) as m:
+        optimize(m)
+        timetable = solved_timetable(m)
+    rows = []
+    n_routes = 2
+    while n_routes <= max_routes:
+        synthetic = replicate_routes(data, n_routes)
+        replicated = shift_copies(replicate_timetable(timetable, synthetic), synthetic)
+        trips = level3_crew.day_trips(synthetic, replicated)
+        start = time.time()
+        row = {'routes': n_routes, 'feasible_duties': level3_crew.count_duties(level3_crew.DutyGraph(trips)),
+               'count_time': time.time() - start}
+        start = time.time()
+        try:
+            result = level3_crew.crew_schedule(synthetic, replicated, trips, env=env)
+            row.update({key: result[key] for key in ('trips', 'columns', 'iterations', 'pricing_time', 'master_time',
+                                                     'lp_bound', 'cost')})
+            row['duties'] = len(result['duties'])
+        except gp.GurobiError as e:
+            # e.g. the master is too large for the license.
+            row.update({'trips': len(trips), 'error': e.errno})
+        row['time'] = time.time() - start
+        rows.append(row)
+        n_routes *= 2
+    print_table(rows, ['routes', 'trips', 'feasible_duties', 'count_time', 'columns', 'iterations', 'pricing_time',
+                       'master_time', 'time', 'lp_bound', 'cost', 'duties'])
+    return rows
+
+
+def benchmark_evaluate(max_routes=256, repeat=100):
+    # Evaluation time of a timetable on 2 up to max_routes routes, against the time to build the model.
+    data = init_data()
+    m = build_model(data, env=env)
+    m.setParam("OutputFlag", 0)
+    optimize(m)
+    timetable = solved_timetable(m)
+    m.dispose()
+    rows = []
+    n_routes = 2
+    while n_routes <= max_routes:
+        synthetic = replicate_routes(data, n_routes)
+        replicated = replicate_timetable(timetable, synthetic)
+        start = time.time()
+        network = prepare_network(synthetic)
+        prepare_time = time.time() - start
+        events = timetable_events(network, replicated)
+        start = time.time()
+        for _ in range(repeat):
+            _, violations = evaluate(network, replicated, events)
+        evaluate_time = (time.time() - start) / repeat
+        start = time.time()
+        m = build_model(synthetic, env=env)
+        m.update()
+        build_time = time.time() - start
+        m.dispose()
+        rows.append({'routes': n_routes, 'events': len(events) - 1, 'violations': len(violations),
+                     'prepare_time': prepare_time, 'evaluate_time': evaluate_time, 'build_time': build_time})
+        n_routes *= 2
+    print_table(rows, ['routes', 'events', 'violations', 'prepare_time', 'evaluate_time', 'build_time'])
+    return rows
+
+
+def benchmark_env(n_solves=20):
+    # Per-solve overhead with a new environment per solve vs. one shared environment.
+    from level3_model_toydata import init_toy_data
+
+    data = init_toy_data()
+    rows = []
+    for mode in ('new env', 'shared env'):
+        total_time, solve_time = 0.0, 0.0
+        for _ in range(n_solves):
+            start = time.time()
+            if mode == 'new env':
+                with gp.Env(params={'OutputFlag': 0}) as solve_env, build_model(data, env=solve_env) as m:
+                    optimize(m)
+                    solve_time += m.Runtime
+            else:
+                with build_model(data, env=env) as m:
+                    optimize(m)
+                    solve_time += m.Runtime
+            total_time += time.time() - start
+        rows.append({'mode': mode, 'solves': n_solves, 'time_per_solve': total_time / n_solves,
+                     'overhead_per_solve': (total_time - solve_time) / n_solves})
+    print_table(rows, ['mode', 'solves', 'time_per_solve', 'overhead_per_solve'])
+    return rows
+
+
+def benchmark_cache(max_routes=128):
+    # Build time vs. save and load + patch time of the model cache, on 2 up to max_routes routes.
+    import level3_cache
+
+    data = init_data()
+    rows = []
+    n_routes = 2
+    with tempfile.TemporaryDirectory() as directory:
+        while n_routes <= max_routes:
+            synthetic = replicate_routes(data, n_routes)
+            path = os.path.join(directory, "level3_{}".format(n_routes))
+            start = time.time()
+            m = build_model(synthetic, env=env)
+            m.update()
+            build_time = time.time() - start
+            start = time.time()
+            level3_cache.save_model(m, path, {})
+            save_time = time.time() - start
+            m.dispose()
+
+            # Nightly data: same network, new demand and costs.
+            nightly = copy.deepcopy(synthetic)
+            for route_demand in nightly['edge_Npassengers'].values():
+                for edge in route_demand:
+                    route_demand[edge] += 10
+            for loco_type in nightly['loco_Ckm']:
+                nightly['loco_Ckm'][loco_type] *= 1.1
+            start = time.time()
+            m = level3_cache.load_model(path, nightly, env)
+            load_time = time.time() - start
+            level3_cache.patch_model(m, nightly)
+            patch_time = time.time() - start - load_time
+            rows.append({'routes': n_routes, 'columns': m.NumVars, 'file_kb': os.path.getsize(path + ".mps.gz") / 1024,
+                         'build_time': build_time, 'save_time': save_time, 'load_time': load_time,
+                         'patch_time': patch_time})
+            m.dispose()
+            n_routes *= 2
+    print_table(rows, ['routes', 'columns', 'file_kb', 'build_time', 'save_time', 'load_time', 'patch_time'])
+    return rows
+
+
+benchmarks = {'lazy': benchmark_lazy, 'headway': benchmark_headway, 'units': benchmark_units, 'day': benchmark_day,
+              'recovery': benchmark_recovery, 'od': benchmark_od, 'evaluate': benchmark_evaluate, 'env': benchmark_env,
+              'cache': benchmark_cache, 'symmetry': benchmark_symmetry, 'start': benchmark_start,
+              'consists': benchmark_consists, 'fleet': benchmark_fleet, 'crew': benchmark_crew}
+
+
+if __name__ == "__main__":
+    # Options before the benchmark name: --seeds n (repeat each solve with seeds 0 to n - 1), --threads n and
+    # --manifest path (write the run manifest of the solves).
+    args = sys.argv[1:]
+    manifest_path = None
+    while args and args[0] in ('--seeds', '--threads', '--manifest') and len(args) > 1:
+        option, value = args[0], args[1]
+        if option == '--seeds':
+            seeds = list(range(int(value)))
+        elif option == '--threads':
+            threads = int(value)
+        else:
+            manifest_path = value
+        args = args[2:]
+    if not args or args[0] not in benchmarks:
+        print("Usage: {} [--seeds n] [--threads n] [--manifest path] {{{}}} [args]".format(
+            sys.argv[0], ",".join(sorted(benchmarks))))
+        sys.exit(1)
+    try:
+        with gp.Env(params={'OutputFlag': 0}) as env:
+            benchmarks[args[0]](*[int(arg) for arg in args[1:]])
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
+    if manifest_path is not None:
+        level3_manifest.write_manifest(manifest_path, manifest_records)
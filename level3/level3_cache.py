@@ -0,0 +1,251 @@
+#!/usr/bin/env python3.7
+
+# Cache of built level 3 models, for repeated runs on the same network:
+# - save_model() writes a model built by level3_model.build_model() to compressed MPS (.mps.gz), with a JSON
+#   sidecar (.json) holding the build options, a key of the structure of the data and the index of every variable
+#   the m._x_rt, m._arrival_times, ... attributes refer to.
+# - load_model() reads the model back and restores these attributes, and patch_model() updates the coefficients
+#   that depend on data values: costs, route lengths, speeds and edge lengths (running times), car limits and demand.
+# - cached_model() loads the cache when the structure of the data matches it, and builds and saves the model
+#   otherwise.  Any other change of the data (e.g. routes, stations, transfers, period, car capacities) changes the
+#   structure key, so the model is rebuilt.
+#
+# Lazy constraints are kept in Python (m._lazy), not in the model, so models with lazy constraints are not cached.
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import (init_data, build_model, optimize, print_results, running_times, route_costs,
+                          passenger_km_costs, od_by_origin, passenger_arcs, name_part, to_time_units,
+                          formulation_name, profile_parameters)
+
+# Data that is patched into a loaded model.  Every other entry of the data is part of the structure key.
+patched_data = ('loco_Cfix', 'loco_Ckm', 'loco_speed', 'car_Cfix', 'car_Ckm', 'car_min', 'car_max',
+                'route_dist', 'edge_len', 'edge_Npassengers', 'od_demand')
+
+
+def encode(value):
+    # JSON form of a key: tuples become lists (recursively).
+    if isinstance(value, (tuple, list)):
+        return [encode(item) for item in value]
+    return value
+
+
+def decode(value):
+    # Inverse of encode(): lists become tuples (recursively).
+    if isinstance(value, list):
+        return tuple(decode(item) for item in value)
+    return value
+
+
+def structure_key(data, options):
+    '''
+    Hash of everything the structure of the model depends on: the build options, the data that is not patched and
+    the OD pairs with a nonzero demand (but not their demand), which decide the flow variables and rows.
+    '''
+    structure = {key: value for key, value in data.items() if key not in patched_data}
+    od = od_by_origin(data) if 'od_demand' in data else {}
+    structure['od_pairs'] = sorted((origin, destination) for origin, destinations in od.items()
+                                   for destination in destinations)
+    structure['options'] = options
+    text = json.dumps(encode(structure), sort_keys=True, default=lambda value: sorted(value, key=str)
+                      if isinstance(value, (set, frozenset)) else str(value))
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def save_model(m, path, options):
+    '''
+    Write the model to path.mps.gz and its sidecar to path.json.
+    options are the keyword arguments the model was built with (see build_model()).
+    '''
+    m.update()
+    m.write(path + ".mps.gz")
+    variables = {
+        'x_rt': [(key, var.index) for key, var in m._x_rt.items()],
+        'w_rt': [(key, var.index) for key, var in m._w_rt.items()],
+        'cycle_times': [((route, loco_type), var.index) for route, route_vars in m._cycle_times.items()
+                        for loco_type, var in route_vars.items()],
+        'headway_z': [(key, var.index) for key, var in m._headway_z.items()]}
+    for name, times in (('arrival_times', m._arrival_times), ('departure_times', m._departure_times)):
+        variables[name] = [((route, direction, edge), var.index) for route, route_times in times.items()
+                           for direction, direction_times in route_times.items()
+                           for edge, var in direction_times.items()]
+    if m._frequency_selection:
+        variables['y_rp'] = [(key, var.index) for key, var in m._y_rp.items()]
+        variables['num_trains'] = [((route, loco_type), var.index) for route, route_vars in m._num_trains.items()
+                                   for loco_type, var in route_vars.items()]
+    if m._flow is not None:
+        variables['flow'] = [(key, var.index) for key, var in m._flow.items()]
+    sidecar = {'key': structure_key(m._data, options), 'options': options,
+               'variables': {name: [[encode(key), index] for key, index in items]
+                             for name, items in variables.items()}}
+    with open(path + ".json", 'w') as f:
+        json.dump(sidecar, f)
+
+
+def load_model(path, data, env=None):
+    '''
+    Read a model written by save_model() and restore the attributes set by build_model().
+    The coefficients are the ones of the data the model was saved with: call patch_model() to update them.
+    '''
+    with open(path + ".json") as f:
+        sidecar = json.load(f)
+    m = gp.read(path + ".mps.gz", env=env)
+    m.setParam("NonConvex", 2)
+    options = sidecar['options']
+    m._formulation = formulation_name(options)
+    for parameter, value in profile_parameters(m._formulation).items():
+        m.setParam(parameter, value)
+    all_vars = m.getVars()
+    variables = {name: [(decode(key), all_vars[index]) for key, index in items]
+                 for name, items in sidecar['variables'].items()}
+
+    m._data = data
+    m._callbacks = []
+    m._lazy = []
+    m._lazy_added = 0
+    m._lazy_used = set()
+    m._lazy_constraints = False
+    m._frequency_selection = options.get('frequency_selection', False)
+    m._time_unit = options.get('time_unit', 'min')
+    # cached_model() refuses consists and speed profiles, so a cached model never has them.
+    m._consists = False
+    m._speed_profiles = False
+    m._x_rt = gp.tupledict(variables['x_rt'])
+    m._w_rt = gp.tupledict(variables['w_rt'])
+    m._headway_z = dict(variables['headway_z'])
+    m._cycle_times = {route: {} for route in data['routes']}
+    for (route, loco_type), var in variables['cycle_times']:
+        m._cycle_times[route][loco_type] = var
+    for name in ('arrival_times', 'departure_times'):
+        times = {route: {0: {}, 1: {}} for route in data['routes']}
+        for (route, direction, edge), var in variables[name]:
+            times[route][direction][edge] = var
+        setattr(m, '_' + name, times)
+    if m._frequency_selection:
+        m._y_rp = gp.tupledict(variables['y_rp'])
+        m._num_trains = {route: {} for route in data['routes']}
+        for (route, loco_type), var in variables['num_trains']:
+            m._num_trains[route][loco_type] = var
+    else:
+        period_units = to_time_units(data['period'], m._time_unit)
+        m._num_trains = {route: {loco_type: var / period_units for loco_type, var in route_vars.items()}
+                         for route, route_vars in m._cycle_times.items()}
+    m._flow = gp.tupledict(variables['flow']) if 'flow' in variables else None
+    return m
+
+
+def patch_model(m, data):
+    '''
+    Update the coefficients of a loaded model that depend on the values of data (see patched_data), in place.
+    The structure of data must be the one the model was built with.
+    '''
+    m._data = data
+    routes, route_edges, loco_types = data['routes'], data['route_edges'], data['loco_types']
+    x_rt, w_rt = m._x_rt, m._w_rt
+    constrs = {constr.ConstrName: constr for constr in m.getConstrs()}
+
+    # Car limits: w_rt - car_min * x_rt >= 0 and w_rt - car_max * x_rt <= 0.
+    for route in routes:
+        for loco_type in loco_types:
+            m.chgCoeff(constrs["car_min_rt_{}_{}".format(route, loco_type)], x_rt[route, loco_type],
+                       -data['car_min'][loco_type])
+            m.chgCoeff(constrs["car_max_rt_{}_{}".format(route, loco_type)], x_rt[route, loco_type],
+                       -data['car_max'][loco_type])
+
+    # Running times: arrival - departure - running time * x_rt >= 0.
+    running_time = running_times(data, m._time_unit)
+    for route in routes:
+        for loco_type in loco_types:
+            for edge in route_edges[route]:
+                for direction in (0, 1):
+                    name = "speed_{}_{}_{}_{}_{}".format(route, loco_type, edge[0], edge[1], direction)
+                    m.chgCoeff(constrs[name], x_rt[route, loco_type], -running_time[route][edge][loco_type])
+
+    # Demand: the capacity rows, or the flow conservation rows with passenger routing.
+    cap_scale = max(data['car_cap'][loco_type] for loco_type in loco_types)
+    if m._flow is not None:
+        arcs = passenger_arcs(data)
+        stations = {}
+        for origin, i in m._flow:
+            stations.setdefault(origin, set()).update((arcs[i][3], arcs[i][4]))
+        for origin, destinations in od_by_origin(data).items():
+            for station in stations[origin]:
+                supply = sum(destinations.values()) if station == origin else -destinations.get(station, 0)
+                constrs["flow_{}_{}".format(name_part(origin), name_part(station))].RHS = supply
+    elif m._frequency_selection:
+        period = data['period']
+        genconstrs = {genconstr.GenConstrName: genconstr for genconstr in m.getGenConstrs()}
+        for route in routes:
+            route_capacity = gp.quicksum(w_rt[route, loco_type] * (data['car_cap'][loco_type] / cap_scale)
+                                         for loco_type in loco_types)
+            max_Npassengers = max(data['edge_Npassengers'][route][edge] for edge in route_edges[route])
+            for p in data['period_choices']:
+                name = "capacity_{}_{}".format(route, p)
+                m.remove(genconstrs[name])
+                m.addGenConstrIndicator(m._y_rp[route, p], True, route_capacity, GRB.GREATER_EQUAL,
+                                        max_Npassengers / cap_scale * p / period, name=name)
+    else:
+        for route in routes:
+            for edge in route_edges[route]:
+                constrs["capacity_{}_{}_{}".format(route, edge[0], edge[1])].RHS = \
+                    data['edge_Npassengers'][route][edge] / cap_scale
+
+    obj = route_costs(data, x_rt, w_rt, m._num_trains)
+    if m._flow is not None:
+        obj += passenger_km_costs(data, m._flow)
+    m.setObjective(obj, GRB.MINIMIZE)
+    m.update()
+
+
+def cached_model(data, path, env=None, **options):
+    '''
+    Return the model of data: loaded from path (see save_model()) and patched if the cache exists and has the same
+    structure, else built with build_model(data, **options) and saved to path.
+    Returns (model, True if it was loaded from the cache).
+    '''
+    if options.get('lazy_constraints'):
+        raise ValueError("Models with lazy constraints cannot be cached")
+    if options.get('consists'):
+        # The costs of the consists are not patched.
+        raise ValueError("Models with consists cannot be cached")
+    if options.get('symmetry_breaking'):
+        # The symmetry classes and the cuts breaking them depend on the costs, edge lengths and demand, which are
+        # patched.
+        raise ValueError("Models with symmetry breaking cannot be cached")
+    if options.get('speed_profiles'):
+        # The running times and energy costs of the speed profiles are not patched.
+        raise ValueError("Models with speed profiles cannot be cached")
+    if os.path.exists(path + ".json") and os.path.exists(path + ".mps.gz"):
+        with open(path + ".json") as f:
+            key = json.load(f)['key']
+        if key == structure_key(data, options):
+            m = load_model(path, data, env)
+            patch_model(m, data)
+            return m, True
+    m = build_model(data, env=env, **options)
+    save_model(m, path, options)
+    return m, False
+
+
+if __name__ == "__main__":
+    # Usage: python level3/level3_cache.py [cache path]
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "level3_cache")
+    try:
+
+        with gp.Env() as env:
+            start = time.time()
+            m, loaded = cached_model(init_data(), path, env)
+            print("{} the model in {:.3f}s".format("Loaded" if loaded else "Built and saved", time.time() - start))
+            with m:
+                optimize(m)
+                print_results(m)
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
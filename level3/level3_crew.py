@@ -0,0 +1,325 @@
+#!/usr/bin/env python3.7
+
+# Crew scheduling for solved level 3 timetables:
+# - day_trips() rolls the periodic timetable out over the service day.  Every trip (see level3_fleet.route_trips())
+#   is a task that one driver runs from its first to its last station.  The outbound and return trips of a cycle
+#   are run by the same unit, so a cycle is crewed as a whole if it starts during the service day.
+# - A duty is a sequence of trips run by one driver.  It starts and ends at a crew depot, each trip starts at the
+#   station where the previous one ended (at least min_connection minutes later to change units, or right after it
+#   to stay on the same unit), it lasts at most max_duty_length minutes from sign-on to sign-off, and the driver
+#   works at most max_work_without_break minutes before a break of at least break_length minutes at a break
+#   station (Union).
+# - The duties are chosen with a set covering model solved by column generation: the master LP covers every trip
+#   with the duties generated so far (an uncovered trip costs uncovered_cost), and the pricing problem finds duties
+#   with a negative reduced cost with a resource-constrained shortest path (labelling) over the trips.  The trips
+#   are processed by start time, so the labels of a trip are final when it is reached, and duties are streamed to
+#   the master as soon as they are found.  The connections of a trip are found with a binary search over the trips
+#   leaving its last station, so the duties are never enumerated.
+# - When no duty has a negative reduced cost, the LP bound is reached and the master is solved with binary duties
+#   over the generated columns (price and branch), which gives a feasible crew schedule and its gap to the bound.
+
+import time
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from math import ceil
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize, solved_timetable
+from level3_fleet import route_trips
+
+debug = False
+# debug = True
+
+# Service day (minutes after midnight): trips starting from service_start until service_end are crewed.
+service_start = 6 * 60
+service_end = 24 * 60
+
+# Duty rules (minutes).
+crew_depots = ("Union",)
+break_stations = ("Union",)
+sign_on = 15
+sign_off = 15
+min_connection = 5
+max_connection = 120
+max_duty_length = 510
+max_work_without_break = 300
+break_length = 30
+
+# Cost of a duty, plus paid_minute_cost for each minute from sign-on to sign-off, and cost of leaving a trip
+# without a driver (only used so the first master LP is feasible).
+duty_cost = 240.0
+paid_minute_cost = 1.0
+uncovered_cost = 1e4
+
+# Maximum number of duties added to the master per pricing round, and of column generation iterations.
+max_columns = 50
+max_iterations = 500
+
+# Tolerance on the reduced costs.
+tolerance = 1e-6
+
+
+def day_trips(data, timetable, start=None, end=None):
+    '''
+    Trips of a timetable over the service day, as (route, start station name, start time, end station name, end
+    time, cycle) with times in minutes after midnight, sorted by start time.  The trips of the same cycle are run by
+    the same unit.
+    '''
+    start = service_start if start is None else start
+    end = service_end if end is None else end
+    trips = []
+    # The trips of one period, shifted to every period of the day.  route_trips() lists the outbound and return
+    # trips of each cycle one after the other.
+    period_trips = route_trips(data, timetable)
+    for k in range(int(ceil((end - start) / data['period']))):
+        offset = start + k * data['period']
+        for n, (route, origin, departure, destination, arrival) in enumerate(period_trips):
+            if period_trips[n - n % 2][2] + offset < end:
+                trips.append((route, origin, departure + offset, destination, arrival + offset, (k, n // 2)))
+    trips.sort(key=lambda trip: (trip[2], trip[4], trip[0]))
+    return trips
+
+
+class DutyGraph:
+    '''
+    Connections between the trips, generated on demand: the trips leaving each station are kept sorted by start
+    time, and the successors of a trip are the trips leaving its last station at most max_connection minutes after
+    it arrives (see connects() for the shortest connection).
+    '''
+
+    def __init__(self, trips):
+        self.trips = trips
+        self.leaving = {}
+        for i, (_, origin, departure, _, _, _) in enumerate(trips):
+            self.leaving.setdefault(origin, ([], []))
+            self.leaving[origin][0].append(departure)
+            self.leaving[origin][1].append(i)
+
+    def successors(self, i):
+        _, _, _, destination, arrival, _ = self.trips[i]
+        if destination not in self.leaving:
+            return []
+        times, indices = self.leaving[destination]
+        first = bisect_left(times, arrival)
+        last = bisect_right(times, arrival + max_connection)
+        return [j for j in indices[first:last] if connects(self.trips, i, j)]
+
+
+def connects(trips, i, j):
+    # A driver can run trip j after trip i: j leaves where i arrives, after min_connection minutes to change units.
+    gap = trips[j][2] - trips[i][4]
+    same_unit = trips[i][0] == trips[j][0] and trips[i][5] == trips[j][5]
+    return trips[j][1] == trips[i][3] and gap >= (0 if same_unit else min_connection)
+
+
+def extend(trips, label, j):
+    '''
+    Extend a label (reduced cost, sign-on time, work since the last break, trip, parent) with trip j, without the
+    dual of j.  Returns None if the duty would break a rule.
+    '''
+    cost, signed_on, work, i, _ = label
+    _, origin, departure, _, arrival, _ = trips[j]
+    gap = departure - trips[i][4]
+    if gap >= break_length and origin in break_stations:
+        work = arrival - departure
+    else:
+        work += arrival - trips[i][4]
+    if work > max_work_without_break or arrival + sign_off - signed_on > max_duty_length:
+        return None
+    return cost + paid_minute_cost * (arrival - trips[i][4]), signed_on, work, j, label
+
+
+def dominates(a, b):
+    # Label a dominates label b of the same trip: cheaper, signed on later and less work since its break.
+    return a[0] <= b[0] + tolerance and a[1] >= b[1] and a[2] <= b[2]
+
+
+def label_duty(label):
+    # Trips of the duty of a label, in order.
+    duty = []
+    while label is not None:
+        duty.append(label[3])
+        label = label[4]
+    return duty[::-1]
+
+
+def price_duties(graph, duals):
+    '''
+    Resource-constrained shortest path pricing: yields (reduced cost, duty cost, trips) for every duty with a
+    negative reduced cost, as soon as the labels of its last trip are final.  duals[i] is the dual of the cover
+    constraint of trip i.  Labels are kept only if no other label of the same trip dominates them.
+    '''
+    trips = graph.trips
+    labels = [[] for _ in trips]
+    for j, (_, origin, departure, _, arrival, _) in enumerate(trips):
+        if origin in crew_depots:
+            signed_on = departure - sign_on
+            labels[j].append((duty_cost + paid_minute_cost * (arrival - signed_on) - duals[j], signed_on,
+                              arrival - signed_on, j, None))
+    for i, (_, _, _, destination, arrival, _) in enumerate(trips):
+        for label in labels[i]:
+            if destination in crew_depots:
+                reduced_cost = label[0] + paid_minute_cost * sign_off
+                if reduced_cost < -tolerance:
+                    cost = duty_cost + paid_minute_cost * (arrival + sign_off - label[1])
+                    yield reduced_cost, cost, label_duty(label)
+            for j in graph.successors(i):
+                extended = extend(trips, label, j)
+                if extended is None:
+                    continue
+                extended = (extended[0] - duals[j],) + extended[1:]
+                if any(dominates(other, extended) for other in labels[j]):
+                    continue
+                labels[j] = [other for other in labels[j] if not dominates(extended, other)] + [extended]
+        labels[i] = None
+
+
+def count_duties(graph):
+    '''
+    Number of feasible duties, i.e. of the columns a full enumeration would generate.  Counted by dynamic
+    programming over the states (trip, sign-on time, work since the last break), without listing the duties.
+    '''
+    trips = graph.trips
+    states = [{} for _ in trips]
+    total = 0
+    for j, (_, origin, departure, _, arrival, _) in enumerate(trips):
+        if origin in crew_depots:
+            state = (departure - sign_on, arrival - departure + sign_on)
+            states[j][state] = states[j].get(state, 0) + 1
+    for i, (_, _, _, destination, _, _) in enumerate(trips):
+        for (signed_on, work), count in states[i].items():
+            if destination in crew_depots:
+                total += count
+            for j in graph.successors(i):
+                extended = extend(trips, (0, signed_on, work, i, None), j)
+                if extended is not None:
+                    state = extended[1:3]
+                    states[j][state] = states[j].get(state, 0) + count
+        states[i] = None
+    return total
+
+
+def check_duty(trips, duty):
+    # Rules broken by a duty (a list of trip indices), as a list of messages.
+    violations = []
+    first, last = trips[duty[0]], trips[duty[-1]]
+    if first[1] not in crew_depots or last[3] not in crew_depots:
+        violations.append("does not start and end at a depot")
+    if last[4] + sign_off - (first[2] - sign_on) > max_duty_length:
+        violations.append("longer than {} min".format(max_duty_length))
+    work = first[4] - first[2] + sign_on
+    for i, j in zip(duty, duty[1:]):
+        gap = trips[j][2] - trips[i][4]
+        if not connects(trips, i, j):
+            violations.append("no connection from trip {} to trip {}".format(i, j))
+        work = trips[j][4] - trips[j][2] + (gap + work if gap < break_length or trips[j][1] not in break_stations
+                                             else 0)
+        if work > max_work_without_break:
+            violations.append("no break before trip {}".format(j))
+    return violations
+
+
+def crew_schedule(data, timetable, trips=None, time_limit=60, env=None):
+    '''
+    Crew duties covering the trips of a timetable over the service day (day_trips() unless trips is given), by
+    column generation.
+    Returns a dict with the duties (lists of trip indices) and their costs, the LP bound, the cost of the integer
+    schedule, the number of trips left uncovered, and the number of columns, iterations and time spent in the
+    master and in the pricing.
+    '''
+    if trips is None:
+        trips = day_trips(data, timetable)
+    graph = DutyGraph(trips)
+    duties, costs = [], []
+    result = {'trips': len(trips), 'iterations': 0, 'master_time': 0.0, 'pricing_time': 0.0}
+
+    with gp.Model("level3_crew", env=env) as m:
+        m.setParam("OutputFlag", 1 if debug else 0)
+        uncovered = m.addVars(len(trips), obj=uncovered_cost, name="uncovered")
+        cover = m.addConstrs((uncovered[i] >= 1 for i in range(len(trips))), name="cover")
+        columns = []
+
+        for iteration in range(max_iterations):
+            m.optimize()
+            result['master_time'] += m.Runtime
+            result['iterations'] = iteration + 1
+            duals = [cover[i].Pi for i in range(len(trips))]
+            start = time.time()
+            # Only the first max_columns duties are generated: the pricing stops as soon as they are found.
+            new = list(islice(price_duties(graph, duals), max_columns))
+            result['pricing_time'] += time.time() - start
+            if debug:
+                print("Iteration {}: LP {:.2f}, {} new duties".format(iteration, m.ObjVal, len(new)))
+            if not new:
+                break
+            for _, cost, duty in new:
+                columns.append(m.addVar(obj=cost, name="duty[{}]".format(len(duties)),
+                                        column=gp.Column([1.0] * len(duty), [cover[i] for i in duty])))
+                duties.append(duty)
+                costs.append(cost)
+        result['lp_bound'] = m.ObjVal
+        result['converged'] = not new
+        result['columns'] = len(duties)
+
+        # Price and branch: the integer master over the generated duties.
+        for var in columns:
+            var.VType = GRB.BINARY
+        m.setParam("TimeLimit", time_limit)
+        m.optimize()
+        result['master_time'] += m.Runtime
+        result['cost'], result['duties'], result['costs'] = None, [], []
+        if m.SolCount > 0:
+            result['cost'] = m.ObjVal
+            result['gap'] = m.MIPGap
+            chosen = [d for d, var in enumerate(columns) if var.X > 0.5]
+            result['duties'] = [duties[d] for d in chosen]
+            result['costs'] = [costs[d] for d in chosen]
+            result['uncovered'] = sum(1 for var in uncovered.values() if var.X > 0.5)
+    return result
+
+
+def print_duties(trips, result):
+    # One line per duty: sign-on and sign-off times, and its trips.
+    def clock(minutes):
+        return "{:02d}:{:02d}".format(int(minutes // 60) % 24, int(minutes % 60))
+
+    for duty, cost in zip(result['duties'], result['costs']):
+        first, last = trips[duty[0]], trips[duty[-1]]
+        print("\t{}-{} ({:.0f}): {}".format(clock(first[2] - sign_on), clock(last[4] + sign_off), cost, ", ".join(
+            "{} {} {}->{} {}".format(trips[i][0], clock(trips[i][2]), trips[i][1], trips[i][3], clock(trips[i][4]))
+            for i in duty)))
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        with gp.Env() as env:
+            with build_model(data, env=env) as m:
+                m.setParam("OutputFlag", 0)
+                optimize(m)
+                timetable = solved_timetable(m)
+            trips = day_trips(data, timetable)
+            start = time.time()
+            n_duties = count_duties(DutyGraph(trips))
+            count_time = time.time() - start
+            result = crew_schedule(data, timetable, trips, env=env)
+            print("\nCrew: {} trips, {} feasible duties (counted in {:.3f}s)".format(len(trips), n_duties, count_time))
+            print("\t{} duties generated in {} iterations (master {:.3f}s, pricing {:.3f}s), LP bound {:.2f}".format(
+                result['columns'], result['iterations'], result['master_time'], result['pricing_time'],
+                result['lp_bound']))
+            if result['cost'] is None:
+                print("\tNo crew schedule found")
+            else:
+                print("\t{} duties, cost {:.2f} (gap to the LP bound {:.2%}), {} uncovered trips".format(
+                    len(result['duties']), result['cost'], result['cost'] / result['lp_bound'] - 1,
+                    result['uncovered']))
+                print_duties(trips, result)
+                for duty in result['duties']:
+                    for violation in check_duty(trips, duty):
+                        print("\tDuty {}: {}".format(duty, violation))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
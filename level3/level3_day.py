@@ -0,0 +1,163 @@
+#!/usr/bin/env python3.7
+
+# Day-long level 3 model:
+# - One level 3 block (see level3_model.build_model()) per hour of service, with the demand of that hour.
+# - The blocks are linked by fleet continuity: the number of units on a route can only change by
+#   max_fleet_change from one hour to the next, and all routes share fleet_size units.
+#   Each unit in service costs unit_cost per hour, on top of the level 3 costs.
+# - The day is solved with a rolling horizon: a window of a few hours is optimized, the first hour is fixed and
+#   the window moves on by one hour.  Each window is a new model of the same size, so memory is constant and the
+#   solve time grows linearly with the number of hours.
+
+import time
+from math import ceil
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize
+
+debug = False
+# debug = True
+
+# Cost of keeping one unit in service for an hour.
+unit_cost = 1.0
+
+'''
+Share of the peak hourly demand (edge_Npassengers) for each hour of service.
+e.g. at 10:00 there are 40% as many passengers as in the peak hours.
+'''
+demand_profile = {6: 0.5, 7: 1.0, 8: 1.0, 9: 0.7, 10: 0.4, 11: 0.4, 12: 0.4, 13: 0.4, 14: 0.4, 15: 0.6,
+                  16: 0.9, 17: 1.0, 18: 0.8, 19: 0.5, 20: 0.4, 21: 0.3, 22: 0.3, 23: 0.2}
+
+
+def hourly_demand(data, profile=None):
+    '''
+    Build hourly demand matrices from the peak demand of data and a demand profile.
+    The structure is: demand[hour][route][edge], the number of passengers on the edge in that hour.
+    '''
+    if profile is None:
+        profile = demand_profile
+    demand = {}
+    for hour, share in sorted(profile.items()):
+        demand[hour] = {route: {edge: ceil(passengers * share) for edge, passengers in route_demand.items()}
+                        for route, route_demand in data['edge_Npassengers'].items()}
+    return demand
+
+
+def build_window(data, demand, hours, previous_fleet, fleet_size=None, max_fleet_change=1, **options):
+    '''
+    Build one model with a level 3 block for each hour in hours.
+    previous_fleet is the number of units of each route in the hour before the window (None for the first hour
+    of the day).  options are passed to build_model().
+    Returns the model, with the blocks in m._blocks[hour] and the fleet variables in m._fleet[route, hour].
+    '''
+    routes, loco_types = data['routes'], data['loco_types']
+    m = None
+    blocks = {}
+    for hour in hours:
+        block_data = dict(data)
+        block_data['edge_Npassengers'] = demand[hour]
+        m = build_model(block_data, name="level3_day", m=m, tag="h{}".format(hour), **options)
+        blocks[hour] = {'x_rt': m._x_rt, 'w_rt': m._w_rt, 'cycle_times': m._cycle_times,
+                        'num_trains': m._num_trains, 'arrival_times': m._arrival_times,
+                        'departure_times': m._departure_times}
+    m._blocks = blocks
+
+    # Fleet continuity between the blocks:
+    # fleet[route, hour] is the number of units running route in that hour.
+    fleet = m.addVars(routes, hours, vtype=GRB.INTEGER, name="fleet")
+    m.addConstrs((fleet[route, hour] >= gp.quicksum(blocks[hour]['num_trains'][route][loco_type]
+                                                    for loco_type in loco_types)
+                  for route in routes for hour in hours), name="fleet_needed")
+    for i, hour in enumerate(hours):
+        if i == 0 and previous_fleet is None:
+            continue
+        for route in routes:
+            previous = previous_fleet[route] if i == 0 else fleet[route, hours[i - 1]]
+            m.addConstr(fleet[route, hour] - previous <= max_fleet_change, "fleet_up_{}_{}".format(route, hour))
+            m.addConstr(previous - fleet[route, hour] <= max_fleet_change, "fleet_down_{}_{}".format(route, hour))
+    if fleet_size is not None:
+        m.addConstrs((fleet.sum('*', hour) <= fleet_size for hour in hours), name="fleet_size")
+    m.update()
+    m.setObjective(m.getObjective() + unit_cost * fleet.sum(), GRB.MINIMIZE)
+    m._fleet = fleet
+    return m
+
+
+def block_solution(m, hour):
+    # Values of one solved block: the loco type, number of cars, units and cycle time of each route.
+    block = m._blocks[hour]
+    data = m._data
+    solution = {}
+    for route in data['routes']:
+        loco_type = max(data['loco_types'], key=lambda loco_type: block['x_rt'][route, loco_type].x)
+        solution[route] = {'loco_type': loco_type, 'cars': round(block['w_rt'][route, loco_type].x),
+                           'fleet': round(m._fleet[route, hour].x),
+                           'cycle_time': block['cycle_times'][route][loco_type].x}
+    return solution
+
+
+def solve_day(data, demand=None, window=2, fleet_size=None, max_fleet_change=1, time_limit=30, **options):
+    '''
+    Solve the day with a rolling horizon of window hours.
+    Returns the list of (hour, solution of the hour, objective of the window) for every hour of demand.
+    If a window has no solution, the day stops there.
+    '''
+    if demand is None:
+        demand = hourly_demand(data)
+    hours = sorted(demand)
+    previous_fleet = None
+    results = []
+    for i, hour in enumerate(hours):
+        m = build_window(data, demand, hours[i:i + window], previous_fleet, fleet_size, max_fleet_change, **options)
+        m.setParam("OutputFlag", 1 if debug else 0)
+        m.setParam("TimeLimit", time_limit)
+        optimize(m)
+        if m.SolCount == 0:
+            print("Hour {}: no feasible timetable (status {})".format(hour, m.Status))
+            m.dispose()
+            break
+        solution = block_solution(m, hour)
+        previous_fleet = {route: solution[route]['fleet'] for route in data['routes']}
+        results.append((hour, solution, m.objVal))
+        m.dispose()
+    return results
+
+
+def solve_day_monolithic(data, demand=None, fleet_size=None, max_fleet_change=1, time_limit=300, **options):
+    # Solve every hour in a single model, for comparison with solve_day().
+    if demand is None:
+        demand = hourly_demand(data)
+    hours = sorted(demand)
+    m = build_window(data, demand, hours, None, fleet_size, max_fleet_change, **options)
+    m.setParam("OutputFlag", 1 if debug else 0)
+    m.setParam("TimeLimit", time_limit)
+    optimize(m)
+    results = [(hour, block_solution(m, hour), m.objVal) for hour in hours] if m.SolCount > 0 else []
+    m.dispose()
+    return results
+
+
+def print_day(data, results):
+    print("\nDay timetable: - - - -")
+    print("\tHour\t" + "\t".join("{} (loco, cars, units, cycle)".format(route) for route in data['routes']))
+    for hour, solution, _ in results:
+        print("\t{:02d}:00\t".format(hour) + "\t".join(
+            "{}, {}, {}, {:.0f}".format(solution[route]['loco_type'], solution[route]['cars'],
+                                       solution[route]['fleet'], solution[route]['cycle_time'])
+            for route in data['routes']))
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        start = time.time()
+        with gp.Env() as env:
+            results = solve_day(data, env=env)
+        print_day(data, results)
+        print("\nSolved {} hours in {:.2f}s".format(len(results), time.time() - start))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
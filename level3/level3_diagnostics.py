@@ -0,0 +1,210 @@
+#!/usr/bin/env python3.7
+
+# Diagnostics for level 3 models:
+# - model_statistics() counts the variables, constraints and nonzeros of a model, and presolve_statistics() the
+#   same for the presolved model.  Presolve often proves a broken input infeasible in a fraction of the solve time,
+#   so check() runs it before optimizing.
+# - diagnose() checks the status of a model after optimizing.  If it has no solution because it is infeasible, it
+#   computes an IIS (an irreducible set of conflicting constraints and bounds) and reports its members with the
+#   station ids of their names replaced by the station names, e.g. capacity_r2_s5_s6 becomes
+#   "capacity r2 Port Credit (s5) Clarkson (s6)".
+#
+# Every constraint of build_model() is named after its kind, route, loco type, stations and direction, which is
+# what makes the IIS readable.
+
+import re
+import time
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize
+
+debug = False
+# debug = True
+
+# Name of each optimization status code, e.g. status_names[2] = 'OPTIMAL'.
+status_names = {getattr(GRB.Status, name): name for name in dir(GRB.Status) if name.isupper()}
+
+# Descriptions of the kinds of constraints of build_model(), by the start of their names.
+constraint_kinds = {
+    'speed': "running time at max speed",
+    'run': "arrival after departure on an edge",
+    'dwell': "wait at a station",
+    'turnaround': "wait at the turn-around station",
+    'cycle': "cycle time of a route",
+    'capacity': "seats for the demand",
+    'car_min': "minimum number of cars",
+    'car_max': "maximum number of cars",
+    'consist': "consist of a route",
+    'one_consist': "one consist per route",
+    'one_period': "one period per route",
+    'numtrains': "number of trains with the chosen period",
+    'profile': "one speed level per edge",
+    'overlap': "overlap at a transfer station",
+    'headway': "headway on a shared edge",
+    'symmetry': "symmetry breaking",
+    'flow': "passenger flow conservation",
+}
+
+
+def model_statistics(m):
+    # Size of a model: variables by type, constraints by type and nonzeros.
+    m.update()
+    return {'vars': m.NumVars, 'binary': m.NumBinVars, 'integer': m.NumIntVars - m.NumBinVars,
+            'continuous': m.NumVars - m.NumIntVars, 'constrs': m.NumConstrs, 'qconstrs': m.NumQConstrs,
+            'genconstrs': m.NumGenConstrs, 'nonzeros': m.NumNZs, 'q_nonzeros': m.NumQNZs}
+
+
+def presolve_statistics(m):
+    '''
+    Size of the presolved model (see model_statistics()) and the time to presolve it.
+    Returns (statistics, seconds); statistics is None if presolve failed, which means it found the model infeasible
+    or unbounded.
+    '''
+    start = time.time()
+    try:
+        presolved = m.presolve()
+    except gp.GurobiError as e:
+        if debug:
+            print("Presolve failed: {}".format(e))
+        return None, time.time() - start
+    statistics = model_statistics(presolved)
+    presolved.dispose()
+    return statistics, time.time() - start
+
+
+def constraint_kind(name):
+    # Description of the kind of a constraint from its name (the longest known start), or None.
+    name = re.sub(r'^h\d+_', '', name)  # Tag of a block of the day model (level3_day.py).
+    matches = [kind for kind in constraint_kinds if name == kind or name.startswith((kind + '_', kind + '['))]
+    return constraint_kinds[max(matches, key=len)] if matches else None
+
+
+def readable_name(name, data):
+    '''
+    Name of a constraint or variable with the station ids replaced by their names on its route (the first route
+    in the name), and the transfer numbers by their stations, e.g. overlap_min[0] -> "overlap min transfer at Union".
+    '''
+    tokens = [token for token in re.split(r'[_\[\],]', name) if token]
+    route = next((token for token in tokens if token in data['routes']), None)
+    station_names = data['station_to_name'].get(route, {})
+    words = []
+    for k, token in enumerate(tokens):
+        if token in station_names:
+            words.append("{} ({})".format(station_names[token], token))
+        elif tokens[0] == 'overlap' and k == 2 and token.isdigit() and int(token) < len(data['transfers']):
+            words.append("transfer at {}".format(data['transfers'][int(token)]['station']))
+        else:
+            words.append(token)
+    return " ".join(words)
+
+
+def compute_iis(m, data):
+    '''
+    Compute an IIS of an infeasible model.
+    Returns a list of (type, name, readable name, kind) for its constraints and bounds, the type being 'constr',
+    'qconstr', 'genconstr', 'lb' or 'ub'.
+    '''
+    m.computeIIS()
+    members = []
+    for constr in m.getConstrs():
+        if constr.IISConstr:
+            members.append(('constr', constr.ConstrName))
+    for qconstr in m.getQConstrs():
+        if qconstr.IISQConstr:
+            members.append(('qconstr', qconstr.QCName))
+    for genconstr in m.getGenConstrs():
+        if genconstr.IISGenConstr:
+            members.append(('genconstr', genconstr.GenConstrName))
+    for var in m.getVars():
+        if var.IISLB:
+            members.append(('lb', var.VarName))
+        if var.IISUB:
+            members.append(('ub', var.VarName))
+    return [(kind, name, readable_name(name, data), constraint_kind(name)) for kind, name in members]
+
+
+def diagnose(m, data=None):
+    '''
+    Check the status of an optimized model.  If it has no solution and is infeasible, compute an IIS.
+    A model that is infeasible or unbounded (INF_OR_UNBD) is re-solved without dual reductions to tell them apart.
+    Returns a dict with the status name, solved (True if there is a solution), and the IIS (see compute_iis()) if
+    the model is infeasible.
+    '''
+    if data is None:
+        data = m._data
+    if m.Status == GRB.INF_OR_UNBD:
+        m.setParam("DualReductions", 0)
+        optimize(m)
+    report = {'status': status_names.get(m.Status, str(m.Status)), 'solved': m.SolCount > 0}
+    if m.Status == GRB.INFEASIBLE:
+        report['iis'] = compute_iis(m, data)
+    return report
+
+
+def check(data, env=None, **options):
+    '''
+    Build the model of data with options (passed to build_model()), report its size before and after presolve,
+    and optimize it only if presolve did not already prove it infeasible.
+    Returns (model, report): the report of diagnose() with the statistics and the presolve and solve times.  The
+    model is returned so the solution can be read, and must be disposed by the caller.
+    '''
+    m = build_model(data, env=env, **options)
+    before = model_statistics(m)
+    after, presolve_time = presolve_statistics(m)
+    report = None
+    if after is None:
+        # Presolve could not build the presolved model: skip the solve and look for the conflict directly.  If there
+        # is no conflict (computeIIS() fails), the model is unbounded and the solve tells it.
+        try:
+            report = {'status': 'INFEASIBLE (presolve)', 'solved': False, 'iis': compute_iis(m, data)}
+            solve_time = 0.0
+        except gp.GurobiError:
+            pass
+    if report is None:
+        optimize(m)
+        solve_time = m.Runtime
+        report = diagnose(m, data)
+    report.update({'statistics': before, 'presolved': after, 'presolve_time': presolve_time,
+                   'solve_time': solve_time})
+    return m, report
+
+
+def print_statistics(before, after):
+    # Size of the model before and after presolve, side by side.
+    print("\t\tmodel\tpresolved")
+    for key in before:
+        print("\t{}\t{}\t{}".format(key, before[key], "-" if after is None else after[key]))
+
+
+def print_diagnostics(report):
+    print("\nStatus: {}".format(report['status']))
+    if 'statistics' in report:
+        print_statistics(report['statistics'], report['presolved'])
+        print("\tPresolved in {:.3f}s, solved in {:.3f}s".format(report['presolve_time'], report['solve_time']))
+    if 'iis' in report:
+        print("\nIrreducible inconsistent subsystem ({} members):".format(len(report['iis'])))
+        for kind, name, readable, description in report['iis']:
+            print("\t{}\t{}\t{}{}".format(kind, name, readable, "" if description is None else
+                                          " ({})".format(description)))
+
+
+if __name__ == "__main__":
+    try:
+
+        with gp.Env() as env:
+            data = init_data()
+            m, report = check(data, env=env)
+            m.dispose()
+            print_diagnostics(report)
+
+            # A broken input: trains of at most one car cannot carry the demand.
+            broken = dict(data)
+            broken['car_max'] = {car_type: 1 for car_type in data['car_types']}
+            m, report = check(broken, env=env)
+            m.dispose()
+            print_diagnostics(report)
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3.7
+
+# Standalone feasibility checker and cost evaluator for level 3 timetables:
+# - Checks every constraint family of level3_model.build_model(): max speed (running times, at the chosen speed
+#   levels with speed profiles), station order and wait time, turn-around, cycle time, transfer overlaps,
+#   headways, cars and capacity (against edge_Npassengers), and the cab cars of timetables with consists.
+# - Computes the cost objective of the timetable.
+# - prepare_network() turns the network into NumPy index arrays once.  evaluate() then checks a timetable with a
+#   few vectorized operations per constraint family, so timetables from heuristics, caches or manual edits can be
+#   validated without building the model.
+#
+# Timetables use the structure of level3_model.solved_timetable().
+
+import time
+
+import numpy as np
+
+from level3_model import (init_data, running_times, compile_transfers, headway_pairs, to_time_units, time_units,
+                          coach_data, energy_cost_km, wait_time_at_station, min_headway, speed_profile_table,
+                          speed_levels)
+
+debug = False
+# debug = True
+
+# Tolerance on every constraint.
+tolerance = 1e-6
+
+
+def prepare_network(data, time_unit='min'):
+    '''
+    Build the index arrays used by evaluate().
+    The event times of a timetable are stacked in one vector (see timetable_events()):
+    [departures direction 0, arrivals direction 0, departures direction 1, arrivals direction 1, 0], each block
+    having one entry per edge of every route, in route_edges order.  The last entry is the constant 0 used as the
+    arrival at the first station.
+    '''
+    routes, route_edges, loco_types = list(data['routes']), data['route_edges'], list(data['loco_types'])
+    running_time = running_times(data, time_unit)
+    n_edges = sum(len(route_edges[route]) for route in routes)
+    offsets, route_of_edge, edge_keys = {}, [], []
+    for r, route in enumerate(routes):
+        offsets[route] = len(edge_keys)
+        for edge in route_edges[route]:
+            route_of_edge.append(r)
+            edge_keys.append((route, edge))
+    route_of_edge = np.array(route_of_edge)
+    first = np.array([offsets[route] for route in routes])
+    last = np.array([offsets[route] + len(route_edges[route]) - 1 for route in routes])
+
+    def event(kind, direction, index):
+        # Index in the event vector of an event of edge index.
+        return ({'d': 0, 'a': 1}[kind] + 2 * direction) * n_edges + index
+
+    network = {'data': data, 'time_unit': time_unit, 'routes': routes, 'loco_types': loco_types,
+               'n_edges': n_edges, 'offsets': offsets, 'edge_keys': edge_keys, 'route_of_edge': route_of_edge,
+               'first': first, 'last': last, 'event': event}
+
+    # running_time[loco index, edge index]
+    network['running_time'] = np.array([[running_time[route][edge][loco_type] for route, edge in edge_keys]
+                                        for loco_type in loco_types], dtype=float)
+    # profile_time[loco index, edge index, level index]: running time at each speed level of speed_levels.
+    profiles = speed_profile_table(data, time_unit)
+    network['profile_time'] = np.concatenate([profiles[route]['time'] for route in routes]).transpose(1, 0, 2)
+    network['edge_len'] = np.array([data['edge_len'][route][edge] for route, edge in edge_keys], dtype=float)
+
+    # Station order: the departure from a station is after the arrival at it (plus the wait time).
+    not_first = np.setdiff1d(np.arange(n_edges), first)
+    not_last = np.setdiff1d(np.arange(n_edges), last)
+    wait = to_time_units(wait_time_at_station, time_unit)
+    network['order'] = {
+        'after': np.concatenate([event('d', 0, not_first), event('d', 1, last), event('d', 1, not_last)]),
+        'before': np.concatenate([event('a', 0, not_first - 1), event('a', 0, last), event('a', 1, not_last + 1)]),
+        'edge': np.concatenate([not_first, last, not_last]),
+        'wait': wait}
+
+    # Transfers: every train of a transfer is at the station during a common window of min_overlap.
+    zero = 4 * n_edges
+    transfer_rows = []
+    for t, route, position, direction, min_overlap, max_overlap in compile_transfers(data):
+        edges = route_edges[route]
+        index = offsets[route]
+        if position == len(edges):
+            arrival, departure = event('a', 0, index + position - 1), event('d', 1, index + position - 1)
+        elif direction == 0:
+            arrival = zero if position == 0 else event('a', 0, index + position - 1)
+            departure = event('d', 0, index + position)
+        else:
+            arrival, departure = event('a', 1, index + position), event('d', 1, index + position - 1)
+        transfer_rows.append((t, arrival, departure, to_time_units(min_overlap, time_unit),
+                              np.inf if max_overlap is None else to_time_units(max_overlap, time_unit), route))
+    network['transfers'] = {
+        'id': np.array([row[0] for row in transfer_rows], dtype=int),
+        'arrival': np.array([row[1] for row in transfer_rows], dtype=int),
+        'departure': np.array([row[2] for row in transfer_rows], dtype=int),
+        'min_overlap': np.array([row[3] for row in transfer_rows], dtype=float),
+        'max_overlap': np.array([row[4] for row in transfer_rows], dtype=float),
+        'route': [row[5] for row in transfer_rows]}
+
+    # Headways: departures and arrivals of two routes on a shared edge.
+    pairs = [(offsets[route1] + route_edges[route1].index(edge1), offsets[route2] + route_edges[route2].index(edge2),
+              direction, routes.index(route1), routes.index(route2))
+             for _, (route1, edge1), (route2, edge2), direction in headway_pairs(data)]
+    pairs = np.array(pairs, dtype=int).reshape(-1, 5)
+    network['headways'] = {'edge1': pairs[:, 0], 'edge2': pairs[:, 1], 'direction': pairs[:, 2],
+                           'route1': pairs[:, 3], 'route2': pairs[:, 4],
+                           'headway': to_time_units(min_headway, time_unit)}
+
+    # Demand of the busiest edge and length of each route, and the loco/car data by loco index.
+    network['max_demand'] = np.array([max(data['edge_Npassengers'][route][edge] for edge in route_edges[route])
+                                      for route in routes], dtype=float)
+    network['route_dist'] = np.array([data['route_dist'][route] for route in routes], dtype=float)
+    for key in ('loco_Cfix', 'loco_Ckm', 'car_Cfix', 'car_Ckm', 'car_cap', 'car_min', 'car_max'):
+        network[key] = np.array([data[key][loco_type] for loco_type in loco_types], dtype=float)
+    network['coaches'] = coach_data(data)
+    return network
+
+
+def timetable_events(network, timetable):
+    # Stack the event times of a timetable into the event vector described in prepare_network().
+    events = np.zeros(4 * network['n_edges'] + 1)
+    n_edges = network['n_edges']
+    for index, (route, edge) in enumerate(network['edge_keys']):
+        events[index] = timetable['departure_times'][route][0][edge]
+        events[n_edges + index] = timetable['arrival_times'][route][0][edge]
+        events[2 * n_edges + index] = timetable['departure_times'][route][1][edge]
+        events[3 * n_edges + index] = timetable['arrival_times'][route][1][edge]
+    scale = time_units[network['time_unit']] / time_units[timetable['time_unit']]
+    return events * scale
+
+
+def evaluate(network, timetable, events=None):
+    '''
+    Check a timetable against every constraint of the level 3 model and compute its cost.
+    events can be given (from timetable_events()) to skip the conversion of the timetable.
+    Returns (cost, violations) where violations is a list of (constraint family, description, amount), the
+    amount being how much the constraint is violated by (in time units, cars or passengers).
+    '''
+    if events is None:
+        events = timetable_events(network, timetable)
+    routes, n_edges, event = network['routes'], network['n_edges'], network['event']
+    loco_index = {loco_type: i for i, loco_type in enumerate(network['loco_types'])}
+    loco = np.array([loco_index[timetable['loco_type'][route]] for route in routes])
+    cars = np.array([timetable['cars'][route] for route in routes], dtype=float)
+    if 'coaches' in timetable:
+        # Consists: the capacity and costs are those of the coaches (see level3_model.consist_catalogue()).
+        coaches = network['coaches']
+        counts = np.array([[timetable['coaches'][route].get(coach_type, 0) for coach_type in coaches['coach_types']]
+                           for route in routes], dtype=float)
+        capacity, car_Cfix, car_Ckm = (counts @ coaches[key] for key in ('coach_cap', 'coach_Cfix', 'coach_Ckm'))
+        cab_cars = counts @ coaches['coach_cab']
+    else:
+        capacity = cars * network['car_cap'][loco]
+        car_Cfix, car_Ckm = cars * network['car_Cfix'][loco], cars * network['car_Ckm'][loco]
+    period_minutes = np.array([timetable['period'][route] for route in routes], dtype=int)
+    period = to_time_units(period_minutes, network['time_unit'])
+    cycle_time = np.array([timetable['cycle_time'][route] for route in routes]) * (
+        time_units[network['time_unit']] / time_units[timetable['time_unit']])
+    checks = []
+
+    # Max speed: arrival - departure >= running time of the loco type (at the chosen speed level with speed
+    # profiles), in both directions.
+    edges = np.arange(n_edges)
+    edge_loco = loco[network['route_of_edge']]
+    running = network['running_time'][edge_loco, edges]
+    levels = None
+    if 'speed_level' in timetable:
+        levels = {direction: np.array([timetable['speed_level'][route][direction][edge]
+                                       for route, edge in network['edge_keys']]) for direction in (0, 1)}
+    for direction in (0, 1):
+        if levels is not None:
+            level_index = np.abs(levels[direction][:, None] - np.array(speed_levels)).argmin(axis=1)
+            running = network['profile_time'][edge_loco, edges, level_index]
+        slack = events[event('a', direction, edges)] - events[event('d', direction, edges)] - running
+        checks.append(('speed', slack, lambda i, direction=direction: "edge {} direction {}".format(
+            network['edge_keys'][i], direction)))
+
+    # Station order and wait time (including the turn-around).
+    order = network['order']
+    slack = events[order['after']] - events[order['before']] - order['wait']
+    checks.append(('order', slack, lambda i: "departure onto edge {}".format(network['edge_keys'][order['edge'][i]])))
+
+    # Cycle time: the arrival back at the first station.
+    slack = -np.abs(cycle_time - events[event('a', 1, network['first'])])
+    checks.append(('cycle_time', slack, lambda i: "route {}".format(routes[i])))
+
+    # Transfers.
+    transfers = network['transfers']
+    if len(transfers['id']):
+        arrival, departure = events[transfers['arrival']], events[transfers['departure']]
+        n_transfers = transfers['id'].max() + 1
+        latest_arrival = np.full(n_transfers, -np.inf)
+        earliest_departure = np.full(n_transfers, np.inf)
+        np.maximum.at(latest_arrival, transfers['id'], arrival)
+        np.minimum.at(earliest_departure, transfers['id'], departure)
+        min_overlap = np.zeros(n_transfers)
+        np.maximum.at(min_overlap, transfers['id'], transfers['min_overlap'])
+        checks.append(('transfer_overlap', earliest_departure - latest_arrival - min_overlap,
+                       lambda i: "transfer {}".format(i)))
+        checks.append(('transfer_max_wait', transfers['max_overlap'] - (departure - arrival),
+                       lambda i: "transfer {} route {}".format(transfers['id'][i], transfers['route'][i])))
+
+    # Headways: (t1 - t2) modulo the period of the two routes is in [headway, period - headway], and the two
+    # trains are in the same order at both ends of the edge.
+    headways = network['headways']
+    if len(headways['edge1']):
+        pair_period = to_time_units(np.gcd(period_minutes[headways['route1']], period_minutes[headways['route2']]),
+                                    network['time_unit'])
+        shifts = []
+        for kind in ('d', 'a'):
+            t1 = events[event(kind, headways['direction'], headways['edge1'])]
+            t2 = events[event(kind, headways['direction'], headways['edge2'])]
+            difference = t1 - t2
+            shift = np.floor(difference / pair_period)
+            shifts.append(shift)
+            offset = difference - shift * pair_period
+            slack = np.minimum(offset - headways['headway'], pair_period - headways['headway'] - offset)
+            checks.append(('headway', slack, lambda i, kind=kind: "{} of edges {} and {}".format(
+                kind, network['edge_keys'][headways['edge1'][i]], network['edge_keys'][headways['edge2'][i]])))
+        checks.append(('overtaking', -np.abs(shifts[0] - shifts[1]), lambda i: "edges {} and {}".format(
+            network['edge_keys'][headways['edge1'][i]], network['edge_keys'][headways['edge2'][i]])))
+
+    # Cars and capacity: a train carries the demand of one of its periods.
+    checks.append(('car_min', cars - network['car_min'][loco], lambda i: "route {}".format(routes[i])))
+    checks.append(('car_max', network['car_max'][loco] - cars, lambda i: "route {}".format(routes[i])))
+    demand = network['max_demand'] * period / to_time_units(network['data']['period'], network['time_unit'])
+    checks.append(('capacity', capacity - demand, lambda i: "route {}".format(routes[i])))
+    if 'coaches' in timetable:
+        checks.append(('cab_cars', -np.abs(cab_cars - coaches['cab_cars']), lambda i: "route {}".format(routes[i])))
+
+    violations = []
+    for family, slack, describe in checks:
+        for i in np.flatnonzero(slack < -tolerance):
+            violations.append((family, describe(i), float(-slack[i])))
+
+    # Cost: number of trains * cost of running the route once.
+    num_trains = cycle_time / period
+    fixed_costs = network['loco_Cfix'][loco] + car_Cfix
+    variable_costs = network['route_dist'] * (network['loco_Ckm'][loco] + car_Ckm)
+    cost = float(np.sum(num_trains * (fixed_costs + variable_costs)))
+    if levels is not None:
+        # Energy saved by the speed levels of the speed profiles, for every trip of the period of the data.
+        trips = to_time_units(network['data']['period'], network['time_unit']) / period
+        for direction in (0, 1):
+            extra = network['edge_len'] * energy_cost_km(network['loco_Ckm'][edge_loco], levels[direction])
+            cost += float(np.sum(trips * np.bincount(network['route_of_edge'], extra, minlength=len(routes))))
+    return cost, violations
+
+
+def print_report(cost, violations):
+    print("\nCost: {}".format(cost))
+    if not violations:
+        print("The timetable is feasible")
+        return
+    print("{} violated constraints: - - - -".format(len(violations)))
+    for family, description, amount in violations:
+        print("\t{}: {} (by {:.4g})".format(family, description, amount))
+
+
+if __name__ == "__main__":
+    import gurobipy as gp
+    from level3_model import build_model, optimize, solved_timetable
+
+    try:
+
+        data = init_data()
+        with gp.Env() as env, build_model(data, env=env) as m:
+            m.setParam("OutputFlag", 0)
+            optimize(m)
+            timetable = solved_timetable(m)
+            print("Model objective: {}".format(m.objVal))
+
+        network = prepare_network(data)
+        events = timetable_events(network, timetable)
+        repeat = 1000
+        start = time.time()
+        for _ in range(repeat):
+            cost, violations = evaluate(network, timetable, events)
+        elapsed = (time.time() - start) / repeat
+        print_report(cost, violations)
+        print("Evaluated in {:.1f} microseconds ({:.1f} per route)".format(elapsed * 1e6,
+                                                                        elapsed * 1e6 / len(network['routes'])))
+
+        # A manual edit: depart 5 minutes earlier from the second station of the first route.
+        route = network['routes'][0]
+        timetable['departure_times'][route][0][data['route_edges'][route][1]] -= to_time_units(5, timetable['time_unit'])
+        print("\nAfter moving a departure 5 minutes earlier:")
+        print_report(*evaluate(network, timetable))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
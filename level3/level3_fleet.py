@@ -0,0 +1,235 @@
+#!/usr/bin/env python3.7
+
+# Fleet sizing with interlining for solved level 3 timetables:
+# - The level 3 model counts the units of each route on its own (cycle time / period).  Here a unit arriving at a
+#   terminal can run the next trip of any route that leaves from that terminal (by station name, e.g. Union), or
+#   run empty (deadhead) to another terminal first.  Units can only run the trips of routes with the same loco
+#   type and cars (or consist), since the timetable depends on them.
+# - Each route is split into trips between its terminals: outbound from its first station to its last station,
+#   and back.  A unit is ready for its next trip turnaround minutes after it arrives.
+# - The minimum fleet is a min-cost circulation on a periodic time-space network over one period (data['period'],
+#   the hyperperiod with frequency selection): one node per trip start and per trip end at each terminal, sorted
+#   by time.  The arcs are the trips, the waits between consecutive nodes of a terminal (the last one wraps around
+#   to the first), and the deadheads from a trip end to the first node of another terminal after the deadhead
+#   time.  The fleet is the flow crossing the start of the period.
+# - The network has O(n) arcs for n trips, and the deadhead arcs are found with a binary search over the sorted
+#   nodes of each terminal, so it is built in O(n log n).
+
+import heapq
+import time
+from bisect import bisect_left
+from math import floor
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize, solved_timetable, time_units, wait_time_at_station
+from level3_diagnostics import status_names
+
+debug = False
+# debug = True
+
+# Minimum time (minutes) between the arrival of a unit at a terminal and its next departure.
+turnaround = wait_time_at_station
+
+# Cost of one minute of deadhead, on top of the fleet.  Small, so the fleet is minimized first.
+deadhead_cost = 1e-4
+
+
+def unit_class(timetable, route, by_loco_type=False):
+    # Units can run the trips of routes of the same class: same loco type and cars (or consist), or only the same
+    # loco type if by_loco_type is True.
+    if by_loco_type:
+        return timetable['loco_type'][route],
+    if 'coaches' in timetable:
+        return timetable['loco_type'][route], tuple(sorted(timetable['coaches'][route].items()))
+    return timetable['loco_type'][route], timetable['cars'][route]
+
+
+def route_trips(data, timetable):
+    '''
+    Trips of every route in one period of data, as (route, start station name, start time, end station name, end
+    time) with times in minutes.  A route with a shorter period runs its trips several times.
+    '''
+    to_minutes = 1 / time_units[timetable['time_unit']]
+    trips = []
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        names = data['station_to_name'][route]
+        first, last = edges[0][0], edges[-1][1]
+        times = ((first, timetable['departure_times'][route][0][edges[0]], last,
+                  timetable['arrival_times'][route][0][edges[-1]]),
+                 (last, timetable['departure_times'][route][1][edges[-1]], first,
+                  timetable['arrival_times'][route][1][edges[0]]))
+        period = timetable['period'][route]
+        for k in range(data['period'] // period):
+            for start, departure, end, arrival in times:
+                trips.append((route, names[start], departure * to_minutes + k * period, names[end],
+                              arrival * to_minutes + k * period))
+    return trips
+
+
+def deadhead_times(data, speed):
+    '''
+    Shortest running time (minutes) between every pair of stations (by name) over the edges of every route, at
+    speed km/h.  Returns {(origin, destination): minutes}, computed with Dijkstra's algorithm from each station.
+    '''
+    adjacent = {}
+    for route in data['routes']:
+        names = data['station_to_name'][route]
+        for edge in data['route_edges'][route]:
+            minutes = data['edge_len'][route][edge] / speed * 60
+            a, b = names[edge[0]], names[edge[1]]
+            for u, v in ((a, b), (b, a)):
+                adjacent.setdefault(u, {})
+                adjacent[u][v] = min(adjacent[u].get(v, minutes), minutes)
+    times = {}
+    for origin in adjacent:
+        distance = {origin: 0.0}
+        queue = [(0.0, origin)]
+        while queue:
+            d, u = heapq.heappop(queue)
+            if d > distance[u]:
+                continue
+            for v, minutes in adjacent[u].items():
+                if d + minutes < distance.get(v, float('inf')):
+                    distance[v] = d + minutes
+                    heapq.heappush(queue, (d + minutes, v))
+        for destination, d in distance.items():
+            times[origin, destination] = d
+    return times
+
+
+def fleet_network(data, timetable, interline=True, deadheads=True, by_loco_type=False):
+    '''
+    Build the periodic time-space network of the trips of a timetable (see the top of the file).
+    If interline is False, each route has its own terminals, which gives the fleet of each route on its own.
+    If by_loco_type is True, units of the same loco type are shared even if the routes have different cars (the
+    units then need the largest consist of the routes they run).
+    Returns a dict with nodes (class, terminal, time modulo the period), arcs (tail, head, crossings of the start of
+    the period, kind, deadhead minutes) and the number of trips.
+    '''
+    period = data['period']
+    trips = route_trips(data, timetable)
+    nodes, arcs = [], []
+    terminals = {}  # (class, terminal) -> [(time, 0 for an end / 1 for a start, node)]
+
+    def add_node(group, t, order):
+        node = len(nodes)
+        nodes.append(group + (t % period,))
+        terminals.setdefault(group, []).append((t % period, order, node))
+        return node
+
+    def crossings(t, duration):
+        # Number of period starts passed from time t (modulo the period) during duration.
+        return floor(((t % period) + duration) / period + 1e-9)
+
+    for route, start, departure, end, arrival in trips:
+        group = (unit_class(timetable, route, by_loco_type),) + ((route,) if not interline else ())
+        tail = add_node(group + (start,), departure, 1)
+        ready = arrival + turnaround
+        head = add_node(group + (end,), ready, 0)
+        arcs.append((tail, head, crossings(departure, ready - departure), 'trip', 0.0))
+
+    # Waits: consecutive nodes of each terminal, ends before starts at the same time.
+    for group in terminals:
+        terminals[group].sort()
+        events = terminals[group]
+        for (t1, _, u), (t2, _, v) in zip(events, events[1:]):
+            arcs.append((u, v, crossings(t1, t2 - t1), 'wait', 0.0))
+        (t_last, _, u), (t_first, _, v) = events[-1], events[0]
+        arcs.append((u, v, crossings(t_last, t_first + period - t_last), 'wait', 0.0))
+
+    # Deadheads: from each trip end to the first node of another terminal of its class after the deadhead time.
+    if deadheads and interline:
+        speed = {loco_type: data['loco_speed'][loco_type] for loco_type in data['loco_types']}
+        times = {loco_type: deadhead_times(data, speed[loco_type]) for loco_type in data['loco_types']}
+        by_class = {}
+        for group in terminals:
+            by_class.setdefault(group[:-1], []).append(group)
+        starts = {group: [t for t, _, _ in events] for group, events in terminals.items()}
+        for group, events in terminals.items():
+            others = [other for other in by_class[group[:-1]] if other != group]
+            loco_type = group[0][0]
+            for t, order, u in events:
+                if order != 0:
+                    continue
+                for other in others:
+                    minutes = times[loco_type].get((group[-1], other[-1]))
+                    if minutes is None:
+                        continue
+                    arrival = (t + minutes) % period
+                    i = bisect_left(starts[other], arrival)
+                    wait = starts[other][i] - arrival if i < len(starts[other]) else starts[other][0] + period - arrival
+                    v = terminals[other][i % len(starts[other])][2]
+                    arcs.append((u, v, crossings(t, minutes + wait), 'deadhead', minutes))
+    return {'nodes': nodes, 'arcs': arcs, 'trips': len(trips)}
+
+
+def min_fleet(data, timetable, interline=True, deadheads=True, by_loco_type=False, env=None):
+    '''
+    Minimum number of units to run a timetable, with units shared between routes if interline is True.
+    Returns a dict with the fleet, the deadhead minutes per period, the fleet of each class, the size of the
+    network, the time to build and solve it and the status of the solve.  fleet, deadhead and by_class are None if
+    the network was not solved to optimality.
+    '''
+    start = time.time()
+    network = fleet_network(data, timetable, interline, deadheads, by_loco_type)
+    build_time = time.time() - start
+    nodes, arcs = network['nodes'], network['arcs']
+
+    with gp.Model("level3_fleet", env=env) as m:
+        m.setParam("OutputFlag", 1 if debug else 0)
+        # Every trip is run by exactly one unit.  The network is a circulation, so the LP solution is integral.
+        flow = m.addVars(len(arcs), lb=[1 if kind == 'trip' else 0 for _, _, _, kind, _ in arcs],
+                         ub=[1 if kind == 'trip' else GRB.INFINITY for _, _, _, kind, _ in arcs], name="flow")
+        outgoing = [[] for _ in nodes]
+        incoming = [[] for _ in nodes]
+        for a, (tail, head, _, _, _) in enumerate(arcs):
+            outgoing[tail].append(a)
+            incoming[head].append(a)
+        m.addConstrs((flow.sum(outgoing[node]) == flow.sum(incoming[node]) for node in range(len(nodes))),
+                     name="balance")
+        fleet = gp.quicksum(crossings * flow[a] for a, (_, _, crossings, _, _) in enumerate(arcs) if crossings)
+        deadhead = gp.quicksum(minutes * flow[a] for a, (_, _, _, kind, minutes) in enumerate(arcs)
+                               if kind == 'deadhead')
+        m.setObjective(fleet + deadhead_cost * deadhead, GRB.MINIMIZE)
+        m.optimize()
+        result = {'trips': network['trips'], 'nodes': len(nodes), 'arcs': len(arcs), 'build_time': build_time,
+                  'solve_time': m.Runtime, 'status': status_names.get(m.Status, m.Status), 'fleet': None,
+                  'deadhead': None, 'by_class': None}
+        if m.Status == GRB.OPTIMAL:
+            result['fleet'] = round(fleet.getValue())
+            result['deadhead'] = deadhead.getValue()
+            by_class = {}
+            for a, (tail, _, crossings, _, _) in enumerate(arcs):
+                if crossings and flow[a].x > 0.5:
+                    by_class[nodes[tail][0]] = by_class.get(nodes[tail][0], 0) + round(crossings * flow[a].x)
+            result['by_class'] = by_class
+    return result
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        with gp.Env() as env:
+            with build_model(data, env=env) as m:
+                m.setParam("OutputFlag", 0)
+                optimize(m)
+                timetable = solved_timetable(m)
+            print("\nUnits: - - - -")
+            for name, interline, by_loco_type in (("Per route", False, False), ("Interlined", True, False),
+                                                  ("Interlined by loco type", True, True)):
+                result = min_fleet(data, timetable, interline, by_loco_type=by_loco_type, env=env)
+                if result['fleet'] is None:
+                    print("\t{}: {} trips, no fleet (status {}, network of {} arcs)".format(
+                        name, result['trips'], result['status'], result['arcs']))
+                    continue
+                print("\t{}: {} trips, fleet {}, deadhead {:.1f} min, by class {} (network of {} arcs built in "
+                      "{:.4f}s, solved in {:.4f}s)".format(name, result['trips'], result['fleet'], result['deadhead'],
+                                                           result['by_class'], result['arcs'], result['build_time'],
+                                                           result['solve_time']))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3.7
+
+# Constructive heuristic for the level 3 model, used as a MIP start:
+# - Each route gets the cheapest loco type that can carry the demand of its busiest edge (edge_Npassengers) with
+#   at most car_max cars, with the fewest cars that do.
+# - Each train runs at its max speed and waits wait_time_at_station at each station.  The dwells are then
+#   extended until the trains of every transfer overlap for min_overlap, and until the trains of different
+#   routes on a shared edge are min_headway apart.
+# - set_start() passes the timetable to the model as a MIP start.  If the timetable is not feasible (checked with
+#   level3_evaluator.evaluate()), only the loco types and cars are passed and Gurobi completes the start.
+
+import time
+from math import ceil
+
+import gurobipy as gp
+
+from level3_model import (init_data, build_model, optimize, running_times, compile_transfers, headway_pairs,
+                          to_time_units, record_incumbents, time_to_first_incumbent, wait_time_at_station,
+                          min_headway)
+from level3_evaluator import prepare_network, evaluate
+
+debug = False
+# debug = True
+
+# Number of passes over the transfers and headways before giving up on a feasible timetable.
+max_rounds = 50
+
+
+def choose_trains(data, running_time):
+    '''
+    Pick the loco type and number of cars of every route.
+    Returns {route: (loco_type, cars)}, without a route if no loco type can carry its demand.
+    '''
+    choice = {}
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        max_Npassengers = max(data['edge_Npassengers'][route][edge] for edge in edges)
+        best = None
+        for loco_type in data['loco_types']:
+            cars = max(data['car_min'][loco_type], ceil(max_Npassengers / data['car_cap'][loco_type]))
+            if cars > data['car_max'][loco_type]:
+                continue
+            # Cycle time at max speed, in minutes, for the number of trains.
+            cycle = 2 * sum(running_time[route][edge][loco_type] for edge in edges) + (2 * len(edges) - 1) * wait_time_at_station
+            fixed_costs = data['loco_Cfix'][loco_type] + cars * data['car_Cfix'][loco_type]
+            variable_costs = data['route_dist'][route] * (data['loco_Ckm'][loco_type] + cars * data['car_Ckm'][loco_type])
+            cost = cycle / data['period'] * (fixed_costs + variable_costs)
+            if best is None or cost < best[0]:
+                best = (cost, loco_type, cars)
+        if best is not None:
+            choice[route] = best[1:]
+    return choice
+
+
+def leg_times(dwells, legs):
+    # Departure and arrival times of each leg of a route, given the dwell before each leg and the running times.
+    departures, arrivals = [], []
+    t = 0
+    for dwell, running in zip(dwells, legs):
+        departures.append(t + dwell)
+        t = departures[-1] + running
+        arrivals.append(t)
+    return departures, arrivals
+
+
+def initial_timetable(data, time_unit='min'):
+    '''
+    Build a timetable with the heuristic, in the structure of level3_model.solved_timetable().
+    A route is run as a sequence of legs: its edges in direction 0 and then in direction 1.  dwells[route][k] is
+    the time at the station before leg k (at the first station, the time after the start of the cycle).
+    Returns None if some route has no loco type able to carry its demand.
+    '''
+    running_time = running_times(data, time_unit)
+    choice = choose_trains(data, running_times(data, 'min'))
+    routes, route_edges = data['routes'], data['route_edges']
+    if len(choice) < len(routes):
+        return None
+    period = to_time_units(data['period'], time_unit)
+    wait = to_time_units(wait_time_at_station, time_unit)
+    headway = to_time_units(min_headway, time_unit)
+    step = to_time_units(1, time_unit)
+
+    legs, leg_index = {}, {}
+    for route in routes:
+        edges = route_edges[route]
+        loco_type = choice[route][0]
+        legs[route] = [running_time[route][edge][loco_type] for edge in edges] + \
+                      [running_time[route][edge][loco_type] for edge in reversed(edges)]
+        for k, edge in enumerate(edges):
+            leg_index[route, 0, edge] = k
+            leg_index[route, 1, edge] = 2 * len(edges) - 1 - k
+    dwells = {route: [0] + [wait] * (len(legs[route]) - 1) for route in routes}
+
+    # Transfers: the dwell before leg k is the stay at the station of the transfer.
+    transfers = {}
+    for t, route, position, direction, min_overlap, max_overlap in compile_transfers(data):
+        n = len(route_edges[route])
+        k = n if position == n else position if direction == 0 else 2 * n - position
+        transfers.setdefault(t, []).append((route, k, to_time_units(min_overlap, time_unit)))
+    pairs = [(leg_index[route1, direction, edge1], route1, leg_index[route2, direction, edge2], route2)
+             for _, (route1, edge1), (route2, edge2), direction in headway_pairs(data)]
+
+    def times():
+        return {route: leg_times(dwells[route], legs[route]) for route in routes}
+
+    for _ in range(max_rounds):
+        changed = False
+        for members in transfers.values():
+            current = times()
+            # Arrival at the station of every train of the transfer: the end of the previous leg (0 at the start).
+            arrival = {(route, k): current[route][1][k - 1] if k > 0 else 0 for route, k, _ in members}
+            window_start = max(arrival.values())
+            for route, k, min_overlap in members:
+                late = window_start + min_overlap - current[route][0][k]
+                if late > 1e-9:
+                    dwells[route][k] += late
+                    changed = True
+        for k1, route1, k2, route2 in pairs:
+            current = times()
+            for delay in range(int(period / step)):
+                d = current[route1][0][k1] - current[route2][0][k2] - delay * step
+                a = current[route1][1][k1] - current[route2][1][k2] - delay * step
+                shift = (d - headway) // period
+                if (d - shift * period <= period - headway + 1e-9 and
+                        headway - 1e-9 <= a - shift * period <= period - headway + 1e-9):
+                    break
+            else:
+                # No delay within a period separates the two trains: leave the pair, and the timetable is not
+                # feasible (set_start() then only passes the loco types and cars).
+                if debug:
+                    print("No delay separates leg {} of {} from leg {} of {}".format(k2, route2, k1, route1))
+                continue
+            if delay > 0:
+                dwells[route2][k2] += delay * step
+                changed = True
+        if not changed:
+            break
+
+    current = times()
+    timetable = {'time_unit': time_unit, 'loco_type': {}, 'cars': {}, 'cycle_time': {}, 'period': {},
+                 'arrival_times': {}, 'departure_times': {}}
+    for route in routes:
+        departures, arrivals = current[route]
+        timetable['loco_type'][route], timetable['cars'][route] = choice[route]
+        timetable['cycle_time'][route] = arrivals[-1]
+        timetable['period'][route] = data['period']
+        for key, values in (('departure_times', departures), ('arrival_times', arrivals)):
+            timetable[key][route] = {direction: {edge: values[leg_index[route, direction, edge]]
+                                                 for edge in route_edges[route]} for direction in (0, 1)}
+    return timetable
+
+
+def set_start(m, timetable):
+    '''
+    Pass a timetable (e.g. from initial_timetable()) to a model built by build_model() as a MIP start.
+    The whole timetable is passed if it is feasible, else only the loco types and numbers of cars.
+    Returns the violations found by level3_evaluator.evaluate().
+    '''
+    data = m._data
+    _, violations = evaluate(prepare_network(data, m._time_unit), timetable)
+    for route in data['routes']:
+        for loco_type in data['loco_types']:
+            used = timetable['loco_type'][route] == loco_type
+            m._x_rt[route, loco_type].Start = 1 if used else 0
+            m._w_rt[route, loco_type].Start = timetable['cars'][route] if used else 0
+        if m._frequency_selection:
+            for p in data['period_choices']:
+                m._y_rp[route, p].Start = 1 if p == timetable['period'][route] else 0
+    if violations:
+        return violations
+
+    for key, times in (('arrival_times', m._arrival_times), ('departure_times', m._departure_times)):
+        for route in data['routes']:
+            for direction in (0, 1):
+                for edge, var in times[route][direction].items():
+                    var.Start = timetable[key][route][direction][edge]
+    for route in data['routes']:
+        for loco_type in data['loco_types']:
+            used = timetable['loco_type'][route] == loco_type
+            m._cycle_times[route][loco_type].Start = timetable['cycle_time'][route] if used else 0
+    if not m._frequency_selection:
+        period = to_time_units(data['period'], m._time_unit)
+        headway = to_time_units(min_headway, m._time_unit)
+        for key, (route1, edge1), (route2, edge2), direction in headway_pairs(data):
+            d = (timetable['departure_times'][route1][direction][edge1] -
+                 timetable['departure_times'][route2][direction][edge2])
+            m._headway_z[key, route1, route2].Start = -((d - headway) // period)
+    return violations
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        start = time.time()
+        timetable = initial_timetable(data)
+        heuristic_time = time.time() - start
+        cost, violations = evaluate(prepare_network(data), timetable)
+        print("Heuristic timetable in {:.3f}s: cost {}, {} violated constraints".format(heuristic_time, cost,
+                                                                                     len(violations)))
+
+        with gp.Env() as env:
+            for use_start in (False, True):
+                with build_model(data, env=env) as m:
+                    m.setParam("OutputFlag", 1 if debug else 0)
+                    if use_start:
+                        set_start(m, timetable)
+                    record_incumbents(m)
+                    optimize(m)
+                    print("{}: first incumbent after {:.3f}s, objective {}, gap {:.4f}".format(
+                        "With MIP start" if use_start else "Without MIP start", time_to_first_incumbent(m),
+                        m.objVal, m.MIPGap))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3.7
+
+# Reproducible level 3 solves:
+# - Gurobi is deterministic for the same model, parameters, thread count and software, but the defaults use every
+#   processor of the machine and one fixed seed, so solve times are not comparable between machines and a single
+#   run does not show how much they vary.  reproducible() fixes the seed and the thread count of a model.
+# - run_record() records everything a solve depends on: the build options, every solver parameter (and the ones
+#   that differ from their defaults), the seed and thread count, and a hash of the input data, with its results.
+#   write_manifest() saves the records with the software versions and the machine in a JSON run manifest.
+# - repeat_solve() solves the same model with several seeds and summarize() reports the median and the variance of
+#   the solve time, the work (Gurobi's deterministic measure of effort, which does not depend on the machine load)
+#   and the nodes.
+
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize
+
+debug = False
+# debug = True
+
+# Seeds of repeat_solve() and the thread count of reproducible solves.
+default_seeds = (0, 1, 2, 3, 4)
+default_threads = 1
+
+# Results of a solve that are summarized over the seeds.
+summarized = ('runtime', 'work', 'nodes')
+
+
+def canonical(value):
+    # JSON form of data: dicts become lists of [key, value] sorted by key, tuples and sets become lists.
+    if isinstance(value, dict):
+        return sorted(([canonical(key), canonical(item)] for key, item in value.items()), key=str)
+    if isinstance(value, (set, frozenset)):
+        return sorted((canonical(item) for item in value), key=str)
+    if isinstance(value, (tuple, list)):
+        return [canonical(item) for item in value]
+    return value
+
+
+def data_hash(data):
+    # Hash of every entry of the data, to tell which input a run was made with.
+    text = json.dumps(canonical(data), default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def software_versions():
+    # Versions of Python, Gurobi and NumPy, and the git commit of the code (None outside of a git checkout).
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'gurobi': "{}.{}.{}".format(*gp.gurobi.version()),
+            'numpy': np.__version__, 'commit': commit}
+
+
+def machine():
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'processors': os.cpu_count()}
+
+
+def solver_parameters(m):
+    '''
+    Every parameter of a model, as {name: value}, and the ones that differ from their defaults.
+    Returns (parameters, changed).
+    '''
+    parameters, changed = {}, {}
+    for name in dir(GRB.Param):
+        if name.startswith('_'):
+            continue
+        try:
+            _, _, value, _, _, default = m.getParamInfo(name)
+        except gp.GurobiError:
+            continue
+        parameters[name] = value
+        if value != default:
+            changed[name] = value
+    return parameters, changed
+
+
+def reproducible(m, seed=0, threads=None):
+    # Fix the seed and the thread count of a model (default_threads if threads is None).
+    m.setParam("Seed", seed)
+    m.setParam("Threads", default_threads if threads is None else threads)
+
+
+def run_record(m, data, options):
+    # Record of a solved model: inputs (data hash, build options, parameters) and results.
+    parameters, changed = solver_parameters(m)
+    record = {'model': m.ModelName, 'data_hash': data_hash(data), 'options': options, 'seed': parameters['Seed'],
+              'threads': parameters['Threads'], 'changed_parameters': changed, 'parameters': parameters,
+              'status': m.Status, 'runtime': m.Runtime, 'work': m.Work, 'nodes': m.NodeCount,
+              'objective': m.ObjVal if m.SolCount > 0 else None, 'gap': m.MIPGap if m.SolCount > 0 else None}
+    if not parameters['Threads']:
+        # 0 means every processor, which is what the log reports.
+        record['threads_used'] = os.cpu_count()
+    return record
+
+
+def manifest(records):
+    # Run manifest: when and how the runs were made, and their records.
+    return {'created': time.strftime("%Y-%m-%dT%H:%M:%S%z"), 'command': sys.argv, 'software': software_versions(),
+            'machine': machine(), 'runs': records}
+
+
+def write_manifest(path, records):
+    with open(path, 'w') as f:
+        json.dump(manifest(records), f, indent=1, default=str)
+
+
+def repeat_solve(data, seeds=default_seeds, threads=None, time_limit=None, env=None, **options):
+    '''
+    Build and solve the model of data once per seed, with the thread count fixed (see reproducible()).  options are
+    passed to build_model().  The model is rebuilt for every seed so the runs are independent.
+    Returns the list of run records (see run_record()).
+    '''
+    records = []
+    for seed in seeds:
+        with build_model(data, env=env, **options) as m:
+            m.setParam("OutputFlag", 1 if debug else 0)
+            reproducible(m, seed, threads)
+            if time_limit is not None:
+                m.setParam("TimeLimit", time_limit)
+            optimize(m)
+            records.append(run_record(m, data, options))
+    return records
+
+
+def summarize(records):
+    '''
+    Median and variance of the solve time, work and nodes of runs, and the distinct objective values (runs with
+    different seeds that stop at the time limit can have different solutions).
+    '''
+    summary = {'runs': len(records)}
+    for key in summarized:
+        values = [record[key] for record in records]
+        summary[key + '_median'] = statistics.median(values)
+        summary[key + '_variance'] = statistics.variance(values) if len(values) > 1 else 0.0
+    summary['objectives'] = sorted({round(record['objective'], 6) for record in records
+                                    if record['objective'] is not None})
+    return summary
+
+
+if __name__ == "__main__":
+    # Usage: python level3/level3_manifest.py [manifest path]
+    path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              "level3_runs.json")
+    try:
+
+        data = init_data()
+        records = []
+        with gp.Env() as env:
+            for threads in (1, 0):
+                runs = repeat_solve(data, threads=threads, env=env)
+                records += runs
+                summary = summarize(runs)
+                print("\nThreads {}: {} runs, solve time median {:.3f}s (variance {:.2e}), work median {:.4f} "
+                      "(variance {:.2e}), nodes median {} (variance {:.1f}), objectives {}".format(
+                          threads or "all", summary['runs'], summary['runtime_median'], summary['runtime_variance'],
+                          summary['work_median'], summary['work_variance'], summary['nodes_median'],
+                          summary['nodes_variance'], summary['objectives']))
+        write_manifest(path, records)
+        print("\nManifest of {} runs written to {} (data hash {})".format(len(records), path, data_hash(data)))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3.7
+
+# Max-plus cycle time analysis of the level 3 network:
+# - event_graph() builds the timed event graph of one period for given loco types and numbers of units: the
+#   departure and arrival events of each route (times from the start of the cycle, as in build_model()), plus
+#   one start event shared by all routes.  Each arc i -> j with weight w and tokens k means
+#   x_j(n) >= x_i(n - k) + w: the running times and waits (0 tokens), the transfer overlaps (0 tokens, both trains
+#   are in the same cycle), and the circulation of the units from the end of a cycle to the start of a later one
+#   (as many tokens as the route has units).
+# - max_cycle_ratio() computes the maximum cycle mean (total weight / total tokens of a circuit) with Howard's
+#   policy iteration, which handles arcs with 0 or several tokens directly.  It is the minimum period at which
+#   the network can run with these loco types and units, and its circuit is the critical circuit.
+# - min_units() uses it as a screening check before the optimization: the fewest units of each route so the
+#   network can run with the period of the data, found by adding a unit to the critical circuit until it fits.
+#
+# Headways are not in the event graph, since they only exclude times modulo the period and do not add a minimum
+# duration.  Karp's algorithm is not used since it needs exactly one token per arc.
+
+import time
+from itertools import product
+from math import ceil
+
+import gurobipy as gp
+
+from level3_model import (init_data, build_model, optimize, solved_timetable, running_times, compile_transfers,
+                          time_units, wait_time_at_station)
+
+debug = False
+# debug = True
+
+# Tolerance when comparing cycle means.
+tolerance = 1e-9
+
+# Maximum number of policy iterations of max_cycle_ratio().
+max_iterations = 1000
+
+
+def event_graph(data, loco_type, units, time_unit='min'):
+    '''
+    Build the event graph for the loco type and number of units of each route ({route: value} dicts).
+    Returns (labels, arcs): the label of each node, e.g. ('r1', 'd', 0, ('s1', 's2')) or ('start',), and the
+    list of arcs (source, target, weight in minutes, tokens, kind).
+    '''
+    to_minutes = 1 / time_units[time_unit]
+    running_time = running_times(data, time_unit)
+    labels, index = [('start',)], {('start',): 0}
+    arcs = []
+
+    def node(label):
+        if label not in index:
+            index[label] = len(labels)
+            labels.append(label)
+        return index[label]
+
+    wait = wait_time_at_station
+    legs = {}
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        legs[route] = [(0, edge) for edge in edges] + [(1, edge) for edge in reversed(edges)]
+        previous = 0
+        for k, (direction, edge) in enumerate(legs[route]):
+            departure = node((route, 'd', direction, edge))
+            arrival = node((route, 'a', direction, edge))
+            arcs.append((previous, departure, wait if k > 0 else 0, 0, 'start' if k == 0 else 'dwell'))
+            arcs.append((departure, arrival, running_time[route][edge][loco_type[route]] * to_minutes, 0, 'run'))
+            previous = arrival
+        arcs.append((previous, 0, 0, units[route], 'circulation'))
+
+    # Transfers: every train of a transfer waits at the station until min_overlap after the others arrived.
+    dwells = {}
+    for t, route, position, direction, min_overlap, _ in compile_transfers(data):
+        n = len(legs[route]) // 2
+        k = n if position == n else position if direction == 0 else 2 * n - position
+        arrival = 0 if k == 0 else index[(route, 'a') + legs[route][k - 1]]
+        dwells.setdefault(t, []).append((arrival, index[(route, 'd') + legs[route][k]], min_overlap))
+    for members in dwells.values():
+        for arrival, _, min_overlap in members:
+            for _, departure, _ in members:
+                arcs.append((arrival, departure, min_overlap, 0, 'transfer'))
+    return labels, arcs
+
+
+def max_cycle_ratio(n_nodes, arcs):
+    '''
+    Maximum cycle ratio (sum of weights / sum of tokens over a circuit) of a graph where every node has an incoming
+    arc, with Howard's policy iteration.  arcs are (source, target, weight, tokens, ...) tuples.
+    Returns (ratio, critical circuit as a list of arc indices, in the order of the circuit).
+    Raises ValueError if the graph has a circuit without tokens (no period is possible).
+    '''
+    incoming = [[] for _ in range(n_nodes)]
+    for a, arc in enumerate(arcs):
+        incoming[arc[1]].append(a)
+    if any(not node_arcs for node_arcs in incoming):
+        raise ValueError("Every event needs an incoming arc")
+    # The policy chooses one incoming arc per node.
+    policy = [max(node_arcs, key=lambda a: arcs[a][2]) for node_arcs in incoming]
+
+    for _ in range(max_iterations):
+        # Value determination: the cycle mean eta and the bias x of each node under the policy.
+        eta, x = [None] * n_nodes, [None] * n_nodes
+        cycles = []
+        state = [0] * n_nodes  # 0: not seen, 1: on the current walk, 2: done.
+        for start in range(n_nodes):
+            walk = []
+            j = start
+            while state[j] == 0:
+                state[j] = 1
+                walk.append(j)
+                j = arcs[policy[j]][0]
+            if state[j] == 1:
+                # New circuit: from j back to j following the predecessors.
+                cycle = walk[walk.index(j):]
+                weight = sum(arcs[policy[c]][2] for c in cycle)
+                tokens = sum(arcs[policy[c]][3] for c in cycle)
+                if tokens <= 0:
+                    raise ValueError("Circuit without tokens: {}".format(cycle))
+                mean = weight / tokens
+                x[cycle[0]] = 0.0
+                for c in reversed(cycle[1:]):
+                    source, _, w, tau = arcs[policy[c]][:4]
+                    x[c] = x[source] + w - mean * tau
+                for c in cycle:
+                    eta[c] = mean
+                cycles.append((mean, [policy[c] for c in reversed(cycle)]))
+            # The rest of the walk leads to nodes with known values.
+            for c in reversed(walk):
+                if eta[c] is None:
+                    source, _, w, tau = arcs[policy[c]][:4]
+                    eta[c] = eta[source]
+                    x[c] = x[source] + w - eta[c] * tau
+                state[c] = 2
+
+        # Policy improvement: first a predecessor with a larger cycle mean, then a larger bias.
+        changed = False
+        for j in range(n_nodes):
+            best = max(incoming[j], key=lambda a: eta[arcs[a][0]])
+            if eta[arcs[best][0]] > eta[j] + tolerance:
+                policy[j] = best
+                changed = True
+        if not changed:
+            for j in range(n_nodes):
+                def bias(a):
+                    source, _, w, tau = arcs[a][:4]
+                    return x[source] + w - eta[j] * tau
+                candidates = [a for a in incoming[j] if abs(eta[arcs[a][0]] - eta[j]) <= tolerance]
+                best = max(candidates, key=bias)
+                if bias(best) > x[j] + max(tolerance, tolerance * abs(x[j])):
+                    policy[j] = best
+                    changed = True
+        if not changed:
+            return max(cycles, key=lambda cycle: cycle[0])
+    raise ValueError("Policy iteration did not converge in {} iterations".format(max_iterations))
+
+
+def minimum_period(data, loco_type, units, time_unit='min'):
+    '''
+    Minimum period (minutes) of the network with these loco types and units, and its critical circuit as a list
+    of (source label, target label, weight, tokens, kind).
+    '''
+    labels, arcs = event_graph(data, loco_type, units, time_unit)
+    ratio, circuit = max_cycle_ratio(len(labels), arcs)
+    return ratio, [(labels[arcs[a][0]], labels[arcs[a][1]]) + tuple(arcs[a][2:]) for a in circuit]
+
+
+def timetable_units(timetable):
+    # Number of units of each route of a solved timetable: its cycle time divided by its period, rounded up.
+    to_minutes = 1 / time_units[timetable['time_unit']]
+    return {route: max(1, ceil(cycle * to_minutes / timetable['period'][route] - 1e-6))
+            for route, cycle in timetable['cycle_time'].items()}
+
+
+def min_units(data, loco_type, period=None, time_unit='min'):
+    '''
+    Screening check: the fewest units of each route so the network with these loco types can run every period
+    minutes (default data['period']).  Starts from the units each route needs on its own, and adds a unit to a
+    route of the critical circuit while the minimum period is too long.
+    Returns (units, minimum period, critical circuit).
+    '''
+    if period is None:
+        period = data['period']
+    labels, arcs = event_graph(data, loco_type, {route: 1 for route in data['routes']}, time_unit)
+    cycle = {route: 0 for route in data['routes']}
+    for source, target, weight, _, kind in arcs:
+        if kind in ('run', 'dwell'):
+            cycle[labels[target][0]] += weight
+    units = {route: max(1, ceil(cycle[route] / period - tolerance)) for route in data['routes']}
+    while True:
+        ratio, circuit = minimum_period(data, loco_type, units, time_unit)
+        if ratio <= period + tolerance:
+            return units, ratio, circuit
+        # The circulation arcs of the critical circuit are the routes whose units limit the period.
+        routes = [source[0] for source, target, _, _, kind in circuit if kind == 'circulation']
+        for route in routes:
+            units[route] += 1
+
+
+def print_circuit(circuit):
+    # Total weight of each kind of arc of a critical circuit, and its transfer and circulation arcs.
+    totals = {}
+    for source, target, weight, tokens, kind in circuit:
+        totals[kind] = totals.get(kind, 0) + weight
+        if kind in ('transfer', 'circulation'):
+            print("\t\t{} -> {}: {} {:.0f} min{}".format(source, target, kind, weight,
+                                                        ", {} tokens".format(tokens) if tokens else ""))
+    print("\t\t" + ", ".join("{} {:.0f} min".format(kind, total) for kind, total in totals.items()))
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+
+        # Stability of the optimized timetable.
+        with gp.Env() as env, build_model(data, env=env) as m:
+            m.setParam("OutputFlag", 0)
+            optimize(m)
+            timetable = solved_timetable(m)
+            mip_time = m.Runtime
+        units = timetable_units(timetable)
+        start = time.time()
+        ratio, circuit = minimum_period(data, timetable['loco_type'], units)
+        print("\nOptimized timetable (solved in {:.3f}s): units {}, period {} min, minimum period {:.2f} min "
+              "(computed in {:.2f} ms)".format(mip_time, units, data['period'], ratio, (time.time() - start) * 1000))
+        print("\tCritical circuit:")
+        print_circuit(circuit)
+
+        # Screening of every loco type assignment.
+        print("\nScreening: - - - -")
+        for assignment in product(data['loco_types'], repeat=len(data['routes'])):
+            loco_type = dict(zip(data['routes'], assignment))
+            start = time.time()
+            units, ratio, _ = min_units(data, loco_type)
+            print("\tloco types {}: units {}, minimum period {:.2f} min ({:.2f} ms)".format(
+                loco_type, units, ratio, (time.time() - start) * 1000))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
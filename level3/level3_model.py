@@ -4,27 +4,89 @@
 
 # Level 3 model:
 # - PESP constraints include station wait time and padding.
-# - PESP constraint for overlap of routes at Union station.
+# - PESP constraint for overlap of routes at transfer stations (e.g. Union), given in the transfers data.
 # - Two routes
 # - Two locomotive types
+# - Times are in whole minutes (or seconds, see time_unit) and running times are precomputed per edge.
+# - Optional frequency selection: each route picks its period from period_choices.
+# - Optional passenger routing: an origin-destination matrix is assigned over all routes, sharing capacity.
+# - PESP headway constraints between routes that share an edge (same stations by name) in the same direction.
+# - Optional symmetry breaking for identical locomotive types and identical routes.
+# - Optional consists: each route picks a loco with a mix of coach types from a precomputed catalogue.
+# - Optional speed profiles: each train picks a speed per edge, trading energy against running time.
+# - Solver parameters tuned for a formulation (see level3_tuning.py) are loaded from profiles/ by build_model().
+#
+# The model is built by build_model() so that other scripts (e.g. level3_benchmark.py) can reuse it.
+# Set lazy_constraints = True below to separate the max-speed constraints in a callback instead of adding
+# them all up front.
+
+import json
+import os
 
 import gurobipy as gp
 from gurobipy import GRB
-from math import ceil
+from functools import reduce
+from itertools import product
+from math import ceil, gcd
 
-# This is required to allow for multiple train type.  If the default value (-1) is used, we get error:
-# Error code 10020: Objective Q not PSD (diagonal adjustment of 2.3e+02 would be required). Set NonConvex parameter to 2 to solve model.
-gp.setParam("NonConvex", 2)
+import numpy as np
 
 debug = False
 # debug = True
 
-try:
+lazy_constraints = False
+# lazy_constraints = True
 
-    # Create a new model
-    m = gp.Model("level3")
+frequency_selection = False
+# frequency_selection = True
+
+passenger_routing = False
+# passenger_routing = True
+
+symmetry_breaking = False
+# symmetry_breaking = True
+
+consists = False
+# consists = True
+
+speed_profiles = False
+# speed_profiles = True
+
+# Directory of the solver parameter profiles written by level3_tuning.py, one JSON file per formulation.  Set
+# use_profiles = False to build models with Gurobi's default parameters.
+profiles_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")
+use_profiles = True
 
-    #### Initialize Data: ####
+# Cost of a passenger travelling 1km, used with passenger routing so passengers take short paths.
+passenger_km_cost = 0.001
+
+# Minimum time (minutes) a train waits at each station, and minimum headway (minutes) between trains of
+# different routes on the same edge.
+wait_time_at_station = 1
+min_headway = 3
+
+# Unit of the time variables: 'min' or 's' (whole minutes or seconds), or 'h' for fractions of an hour.  The
+# running times are rounded up to whole units, so the objective depends on the unit (see running_times()).
+time_unit = 'min'
+# time_unit = 's'
+
+# Number of time units in a minute, for each supported time unit.
+time_units = {'h': 1 / 60, 'min': 1, 's': 60}
+
+# Tolerance used when checking if a lazy constraint is violated by a candidate solution.
+lazy_tolerance = 1e-6
+
+# Speeds (as a share of the max speed of the loco type) a train can choose on each edge with speed profiles, and
+# the share of loco_Ckm that is traction energy at max speed.
+speed_levels = (1.0, 0.95, 0.9, 0.85, 0.8)
+energy_share = 0.5
+
+
+def init_data():
+    '''
+    Initialize the data for the Barrie and Lakeshore West lines.
+    Returns a dict with one entry per data structure used by build_model().
+    '''
 
     '''
     ---- Init data for locomotives ----
@@ -74,14 +136,30 @@ try:
         print(car_max)
 
 
+    '''
+    ---- Init data for the coaches of consists (used with consists instead of the car types): ----
+    coach_types: The coach type.  Any loco type can haul any mix of coach types
+    coach_Cfix, coach_Ckm, coach_cap: Fixed cost, cost per km and capacity of a coach (as for the cars)
+    coach_cab: True if the coach is a cab car, i.e. it has a driving cab for push-pull operation
+    cab_cars: Number of cab cars in each consist
+
+    The number of coaches of a consist is between car_min and car_max of its loco type.
+    e.g. an MP40 with 9 bilevel coaches and a cab car carries 9 * 162 + 136 passengers
+    '''
+    coach_types, coach_Cfix, coach_Ckm, coach_cap, coach_cab = gp.multidict({
+        'bilevel': [0, 37.26, 162, False],
+        'cab': [0, 37.26, 136, True]
+    })
+    cab_cars = 1
+
+
     '''
     Init data for routes and stations:
-    e.g. edge (s1,s2) is 30km long and must trans    e.g. edge (s1,s2) is 30km long and must transport 40 passengers (and the reverse)
-port 40 passengers (and the reverse)
+    e.g. edge (s1,s2) is 30km long and must transport 40 passengers (and the reverse)
          The route is (s1,s2,s1) and is 60km long.  Note, all routes are cycles.
-    
+
     Note:  Since ridership is greatest between the stations Union and York University, the edge capacity
-            is fixed by this maximum capacity. 
+            is fixed by this maximum capacity.
     '''
     stations = {'r1': ['s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11'],
                 'r2': ['s1','s2','s3','s4','s5','s6','s7','s8','s9','s10','s11', 's12']}
@@ -150,6 +228,687 @@ port 40 passengers (and the reverse)
     # Init period (variable T in the paper):
     period = 60  # The period is an hour
 
+    # Units of the data.  Times given in the data (period, transfer overlaps) are in minutes.
+    units = {'edge_len': 'km', 'route_dist': 'km', 'loco_speed': 'km/h', 'period': 'min',
+             'loco_Ckm': '$/km', 'car_Ckm': '$/km', 'car_cap': 'passengers', 'coach_Ckm': '$/km',
+             'coach_cap': 'passengers', 'edge_Npassengers': 'passengers'}
+
+    # Periods (minutes) a route can choose from when frequency selection is used.
+    # They must all divide the period, which is then the hyperperiod of the timetable.
+    period_choices = [15, 20, 30, 60]
+
+    '''
+    Init transfers between routes:
+    station: Name of the hub station
+    routes: Routes that must be at the station at the same time.  None for every route serving the station.
+    direction: Direction of the routes when at the station (0 is away from the first station of the route)
+    min_overlap: Minimum time (minutes) all the trains are at the station together
+    max_overlap: Maximum time (minutes) any of the trains waits at the station.  None for no limit.
+
+    e.g. trains on the Barrie and Lakeshore West lines overlap at Union for at least 5 minutes.
+    '''
+    transfers = [{'station': "Union", 'routes': ['r1', 'r2'], 'direction': 0, 'min_overlap': 5, 'max_overlap': None}]
+
+    '''
+    Init origin-destination demand (used with passenger routing instead of edge_Npassengers):
+    od_demand: Number of passengers per period travelling from the origin to the destination station (by name)
+
+    e.g. 150 passengers go from York University to Union, using any route serving both.
+    '''
+    od_demand = {("York University", "Union"): 150, ("Maple", "Union"): 80, ("Aurora", "Union"): 100,
+                 ("Newmarket", "Union"): 80, ("Bradford", "Union"): 60, ("Barrie South", "Union"): 80,
+                 ("Union", "York University"): 100, ("Union", "Aurora"): 50, ("Union", "Barrie South"): 50,
+                 ("Exhibition", "Union"): 200, ("Port Credit", "Union"): 300, ("Oakville", "Union"): 400,
+                 ("Burlington", "Union"): 300, ("Hamilton", "Union"): 200,
+                 ("Union", "Port Credit"): 150, ("Union", "Oakville"): 150, ("Union", "Hamilton"): 100,
+                 ("Exhibition", "York University"): 50, ("York University", "Oakville"): 30}
+
+    return {'loco_types': loco_types, 'loco_Cfix': loco_Cfix, 'loco_Ckm': loco_Ckm, 'loco_speed': loco_speed,
+            'car_types': car_types, 'car_Cfix': car_Cfix, 'car_Ckm': car_Ckm, 'car_cap': car_cap,
+            'car_min': car_min, 'car_max': car_max,
+            'coach_types': coach_types, 'coach_Cfix': coach_Cfix, 'coach_Ckm': coach_Ckm, 'coach_cap': coach_cap,
+            'coach_cab': coach_cab, 'cab_cars': cab_cars,
+            'stations': stations, 'station_to_name': station_to_name, 'route_to_name': route_to_name,
+            'routes': routes, 'route_edges': route_edges, 'route_dist': route_dist,
+            'edges': edges, 'edge_len': edge_len, 'edge_Npassengers': edge_Npassengers,
+            'period': period, 'period_choices': period_choices, 'transfers': transfers, 'units': units,
+            'od_demand': od_demand}
+
+
+def to_time_units(minutes, time_unit):
+    # Convert a time in minutes to the unit of the time variables.
+    return minutes * time_units[time_unit]
+
+
+def running_times(data, time_unit):
+    '''
+    Running time of each loco type on each edge at its max speed: edge_len (km) / loco_speed (km/h).
+    The structure is: running_time[route][edge][loco_type], in time_unit.  For 'min' and 's' the running times
+    are rounded up to whole units so that every time constant in the model is an integer.  Each edge is rounded up
+    on its own, so no train runs faster than its max speed, but the cycle times are longer than with exact times
+    and this changes the objective: on the shipped data it is 1.250e5 in minutes, 1.160e5 in seconds and 1.158e5
+    in hours (exact).
+    '''
+    if data.get('units', {}).get('loco_speed', 'km/h') != 'km/h' or data.get('units', {}).get('edge_len', 'km') != 'km':
+        raise ValueError("Running times need edge_len in km and loco_speed in km/h, got {}".format(data['units']))
+    running_time = {}
+    for route in data['routes']:
+        running_time[route] = {}
+        for edge in data['route_edges'][route]:
+            running_time[route][edge] = {}
+            for loco_type in data['loco_types']:
+                value = to_time_units(data['edge_len'][route][edge] / data['loco_speed'][loco_type] * 60, time_unit)
+                running_time[route][edge][loco_type] = value if time_unit == 'h' else ceil(value - 1e-9)
+    return running_time
+
+
+def energy_cost_km(loco_Ckm, level):
+    '''
+    Extra cost per km of running at level times the max speed instead of the max speed (negative: a saving).
+    The traction energy per km grows with the square of the speed, and is energy_share of loco_Ckm at max speed.
+    Works on NumPy arrays.
+    '''
+    return loco_Ckm * energy_share * (level ** 2 - 1)
+
+
+def speed_profile_table(data, time_unit):
+    '''
+    Running time and extra energy cost of each speed level (speed_levels) for each loco type on each edge.
+    Running times are rounded up as in running_times(), and when two levels have the same running time only the
+    slower (cheaper) one is valid.
+    The structure is: table[route] = {'time', 'level', 'Ckm', 'valid'} with arrays of shape (edges of the route,
+    loco types, levels), Ckm being the extra cost per km (see energy_cost_km()).
+    '''
+    running_time = running_times(data, 'h')
+    levels = np.array(speed_levels)
+    loco_Ckm = np.array([data['loco_Ckm'][loco_type] for loco_type in data['loco_types']], dtype=float)
+    table = {}
+    for route in data['routes']:
+        at_max_speed = np.array([[running_time[route][edge][loco_type] * 60 for loco_type in data['loco_types']]
+                                 for edge in data['route_edges'][route]])
+        time = to_time_units(at_max_speed[:, :, None] / levels, time_unit)
+        if time_unit != 'h':
+            time = np.ceil(time - 1e-9)
+        valid = np.ones(time.shape, dtype=bool)
+        valid[:, :, :-1] = time[:, :, :-1] != time[:, :, 1:]
+        table[route] = {'time': time, 'level': np.broadcast_to(levels, time.shape),
+                        'Ckm': np.broadcast_to(energy_cost_km(loco_Ckm[:, None], levels), time.shape), 'valid': valid}
+    return table
+
+
+def formulation_name(options):
+    '''
+    Name of the formulation built by build_model() with options (a dict of its keyword arguments, others are
+    ignored), e.g. 'base' or 'frequency_selection+consists'.  The tuned profile of the formulation is stored under
+    this name.
+    '''
+    flags = ('lazy_constraints', 'frequency_selection', 'passenger_routing', 'symmetry_breaking', 'consists',
+             'speed_profiles')
+    parts = [flag for flag in flags if options.get(flag, False)]
+    if not options.get('headways', True):
+        parts.append('no_headways')
+    if options.get('time_unit', 'min') != 'min':
+        parts.append('time_unit_' + options['time_unit'])
+    return "+".join(parts) if parts else 'base'
+
+
+def profile_parameters(formulation):
+    # Solver parameters of the tuned profile of a formulation ({} if it was not tuned or use_profiles is False).
+    path = os.path.join(profiles_dir, formulation + ".json")
+    if not use_profiles or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)['parameters']
+
+
+def coefficient_ranges(m):
+    '''
+    Compute the coefficient ranges Gurobi prints under "Coefficient statistics" (absolute values, zeros ignored).
+    Returns a dict such as {'Matrix': (1.0, 12.0), 'RHS': (1.0, 60.0), ...}.  Indicator constraints are not
+    included.
+    '''
+    m.update()
+    values = {'Matrix': [], 'QMatrix': [], 'QLMatrix': [], 'Objective': [], 'QObjective': [], 'Bounds': [], 'RHS': []}
+    for constr in m.getConstrs():
+        row = m.getRow(constr)
+        values['Matrix'] += [row.getCoeff(i) for i in range(row.size())]
+        values['RHS'].append(constr.RHS)
+    for qconstr in m.getQConstrs():
+        row = m.getQCRow(qconstr)
+        values['QMatrix'] += [row.getCoeff(i) for i in range(row.size())]
+        linear = row.getLinExpr()
+        values['QLMatrix'] += [linear.getCoeff(i) for i in range(linear.size())]
+        values['RHS'].append(qconstr.QCRHS)
+    obj = m.getObjective()
+    if isinstance(obj, gp.QuadExpr):
+        values['QObjective'] += [obj.getCoeff(i) for i in range(obj.size())]
+        obj = obj.getLinExpr()
+    values['Objective'] += [obj.getCoeff(i) for i in range(obj.size())]
+    for var in m.getVars():
+        values['Bounds'] += [bound for bound in (var.LB, var.UB) if abs(bound) < GRB.INFINITY]
+
+    ranges = {}
+    for key, coeffs in values.items():
+        coeffs = [abs(coeff) for coeff in coeffs if coeff != 0]
+        ranges[key] = (min(coeffs), max(coeffs)) if coeffs else None
+    return ranges
+
+
+def print_coefficient_ranges(m):
+    print("Coefficient statistics:")
+    for key, value in coefficient_ranges(m).items():
+        if value is None:
+            print("  {:17s}[0e+00, 0e+00]".format(key + " range"))
+        else:
+            print("  {:17s}[{:.0e}, {:.0e}]".format(key + " range", value[0], value[1]))
+
+
+def hyperperiod(periods):
+    # Least common multiple of the periods, i.e. the length after which every route repeats its timetable.
+    return reduce(lambda a, b: a * b // gcd(a, b), periods)
+
+
+def station_index(data):
+    '''
+    Inverted index from station name to the routes serving it.
+    The value is the list of (route, position of the station on the route).
+    e.g. index["Union"] = [('r1', 0), ('r2', 0)]
+    '''
+    station_to_name, routes, route_edges = data['station_to_name'], data['routes'], data['route_edges']
+    index = {}
+    for route in routes:
+        route_stations = [edge[0] for edge in route_edges[route]] + [route_edges[route][-1][1]]
+        for position, station in enumerate(route_stations):
+            index.setdefault(station_to_name[route][station], []).append((route, position))
+    return index
+
+
+def compile_transfers(data):
+    '''
+    Resolve the transfers data into the list of (transfer number, route, position, direction, min_overlap,
+    max_overlap) used by build_model(), looking the routes up in station_index().
+    '''
+    index = station_index(data)
+    compiled = []
+    for t, transfer in enumerate(data['transfers']):
+        serving = index.get(transfer['station'], [])
+        if transfer['routes'] is not None:
+            serving = [(route, position) for route, position in serving if route in transfer['routes']]
+            missing = set(transfer['routes']) - {route for route, _ in serving}
+            if missing:
+                raise ValueError("Transfer at {}: routes {} do not serve the station".format(transfer['station'],
+                                                                                           sorted(missing)))
+        for route, position in serving:
+            compiled.append((t, route, position, transfer.get('direction', 0), transfer['min_overlap'],
+                             transfer.get('max_overlap')))
+    return compiled
+
+
+def dwell_window(m, route, position, direction):
+    '''
+    Return the (arrival, departure) of the train of route at the station in the given position and direction.
+    The first station in direction 0 is the start of the cycle, so its arrival is 0.  The turn-around station
+    is the same in both directions: arrival in direction 0 and departure in direction 1.
+    '''
+    route_edges = m._data['route_edges'][route]
+    arrival_times, departure_times = m._arrival_times[route], m._departure_times[route]
+    last = len(route_edges)
+    if position == last:
+        return arrival_times[0][route_edges[-1]], departure_times[1][route_edges[-1]]
+    if direction == 0:
+        arrival = 0 if position == 0 else arrival_times[0][route_edges[position - 1]]
+        return arrival, departure_times[0][route_edges[position]]
+    if position == 0:
+        raise ValueError("Route {}: no departure from the first station in direction 1".format(route))
+    return arrival_times[1][route_edges[position]], departure_times[1][route_edges[position - 1]]
+
+
+def passenger_arcs(data):
+    '''
+    The arcs passengers can travel on: one per route, edge and direction.
+    Returns a list of (route, edge, direction, from name, to name).
+    '''
+    station_to_name = data['station_to_name']
+    arcs = []
+    for route in data['routes']:
+        for edge in data['route_edges'][route]:
+            from_name, to_name = station_to_name[route][edge[0]], station_to_name[route][edge[1]]
+            arcs.append((route, edge, 0, from_name, to_name))
+            arcs.append((route, edge, 1, to_name, from_name))
+    return arcs
+
+
+def station_arcs(data):
+    '''
+    The arcs of passenger_arcs() leaving and entering each station, found with station_index().
+    Returns (outgoing, incoming): dicts from station name to the list of arc indices.
+    '''
+    offsets, n_arcs = {}, 0
+    for route in data['routes']:
+        offsets[route] = n_arcs
+        n_arcs += 2 * len(data['route_edges'][route])
+    outgoing, incoming = {}, {}
+    for name, serving in station_index(data).items():
+        for route, position in serving:
+            # Arcs 2k and 2k + 1 of a route are edge k in direction 0 and 1, and the station is the start of edge
+            # position and the end of edge position - 1.
+            arc = offsets[route] + 2 * position
+            if position < len(data['route_edges'][route]):
+                outgoing.setdefault(name, []).append(arc)
+                incoming.setdefault(name, []).append(arc + 1)
+            if position > 0:
+                outgoing.setdefault(name, []).append(arc - 1)
+                incoming.setdefault(name, []).append(arc - 2)
+    return outgoing, incoming
+
+
+def od_by_origin(data):
+    '''
+    Aggregate the nonzero entries of data['od_demand'] by origin: od[origin][destination] = passengers.
+    The passenger flows are modeled per origin instead of per origin-destination pair, so the number of flow
+    variables grows with the number of origins, not with the number of OD pairs.
+    '''
+    od = {}
+    for (origin, destination), passengers in data['od_demand'].items():
+        if passengers > 0 and origin != destination:
+            od.setdefault(origin, {})
+            od[origin][destination] = od[origin].get(destination, 0) + passengers
+    return od
+
+
+def reachable_arcs(arcs, outgoing, incoming, origin, destinations):
+    '''
+    Indices of the arcs on some path from origin to one of destinations, with the arcs of each station from
+    station_arcs().  Flow variables are only needed on these arcs.
+    '''
+    def search(starts, adjacent, end_of):
+        seen, stack, used = set(starts), list(starts), set()
+        while stack:
+            for i in adjacent.get(stack.pop(), []):
+                used.add(i)
+                if end_of(i) not in seen:
+                    seen.add(end_of(i))
+                    stack.append(end_of(i))
+        return used
+
+    forward = search([origin], outgoing, lambda i: arcs[i][4])
+    backward = search(list(destinations), incoming, lambda i: arcs[i][3])
+    return sorted(forward & backward)
+
+
+def name_part(name):
+    # Station names can have spaces, which are not allowed in the names of a model file (MPS/LP).
+    return name.replace(' ', '_')
+
+
+def add_passenger_flows(m, route_capacity, cap_scale):
+    '''
+    Assign the OD demand to the routes with a multi-commodity flow aggregated by origin.
+    flow[o, i] is the number of passengers from origin o on arc i of passenger_arcs().  The passengers of all
+    origins on the arc must fit in the trains of its route: route_capacity[route] (divided by cap_scale) per train,
+    for every train of the period.  Passengers can change routes at any station.
+    Returns the flow variables.
+    '''
+    data = m._data
+    arcs = passenger_arcs(data)
+    outgoing, incoming = station_arcs(data)
+    od = od_by_origin(data)
+    used = {}
+    for origin, destinations in od.items():
+        used[origin] = reachable_arcs(arcs, outgoing, incoming, origin, destinations)
+        missing = set(destinations) - {arcs[i][4] for i in used[origin]}
+        if missing:
+            raise ValueError("No route from {} to {}".format(origin, sorted(missing)))
+    keys = [(origin, i) for origin in od for i in used[origin]]
+    flow = gp.tupledict({(origin, i): m.addVar(vtype=GRB.CONTINUOUS, name="flow_{}_{}".format(name_part(origin), i))
+                         for origin, i in keys})
+
+    # Flow conservation: passengers leave their origin and get off at their destinations.
+    for origin, destinations in od.items():
+        out_arcs, in_arcs = {}, {}
+        for i in used[origin]:
+            out_arcs.setdefault(arcs[i][3], []).append(i)
+            in_arcs.setdefault(arcs[i][4], []).append(i)
+        for station in dict.fromkeys(list(out_arcs) + list(in_arcs)):
+            supply = sum(destinations.values()) if station == origin else -destinations.get(station, 0)
+            m.addConstr(gp.quicksum(flow[origin, i] for i in out_arcs.get(station, []))
+                        - gp.quicksum(flow[origin, i] for i in in_arcs.get(station, []))
+                        == supply, "flow_{}_{}".format(name_part(origin), name_part(station)))
+
+    # Shared capacity of each arc.
+    arc_flows = {}
+    for origin, i in keys:
+        arc_flows.setdefault(i, []).append(flow[origin, i])
+    for i, arc_flow in arc_flows.items():
+        route, edge, direction = arcs[i][:3]
+        load = gp.quicksum(arc_flow) / cap_scale
+        name = "capacity_{}_{}_{}_{}".format(route, edge[0], edge[1], direction)
+        if m._frequency_selection:
+            # A route running every p minutes has period/p trains per period.
+            for p in data['period_choices']:
+                m.addGenConstrIndicator(m._y_rp[route, p], True, (data['period'] / p) * route_capacity[route] - load,
+                                        GRB.GREATER_EQUAL, 0, name="{}_{}".format(name, p))
+        else:
+            m.addConstr(load <= route_capacity[route], name)
+
+    # Passenger-km cost so passengers take short paths.
+    m.update()
+    m.setObjective(m.getObjective() + passenger_km_costs(data, flow), GRB.MINIMIZE)
+    return flow
+
+
+def passenger_km_costs(data, flow):
+    # Passenger-km cost of the flows returned by add_passenger_flows().
+    arcs, edge_len = passenger_arcs(data), data['edge_len']
+    return passenger_km_cost * gp.quicksum(var * edge_len[arcs[i][0]][arcs[i][1]] for (_, i), var in flow.items())
+
+
+def shared_edge_index(data):
+    '''
+    Inverted index of the edges used by more than one route.
+    Stations are identified by name (station_to_name) since station ids are local to each route.
+    The key is the (from name, to name) pair in the direction of travel, and the value is the list of
+    (route, edge, direction) using it.  e.g. index[("Union", "Exhibition")] = [('r2', ('s1', 's2'), 0), ...]
+    '''
+    station_to_name, routes, route_edges = data['station_to_name'], data['routes'], data['route_edges']
+    index = {}
+    for route in routes:
+        for edge in route_edges[route]:
+            from_name, to_name = station_to_name[route][edge[0]], station_to_name[route][edge[1]]
+            index.setdefault((from_name, to_name), []).append((route, edge, 0))
+            index.setdefault((to_name, from_name), []).append((route, edge, 1))
+    return {key: users for key, users in index.items() if len({route for route, _, _ in users}) > 1}
+
+
+def headway_pairs(data):
+    '''
+    Generate the pairs of trains that need a headway constraint: one pair for every two different routes using the
+    same edge in the same direction.  Only the edges in shared_edge_index() are looked at, so routes that do not
+    share track never get compared.
+    Yields (edge key, (route1, edge1), (route2, edge2), direction).
+    '''
+    for key, users in shared_edge_index(data).items():
+        for i in range(len(users)):
+            route1, edge1, direction = users[i]
+            for route2, edge2, _ in users[i + 1:]:
+                if route1 != route2:
+                    yield key, (route1, edge1), (route2, edge2), direction
+
+
+def coach_data(data):
+    '''
+    The coach types of the consists, as arrays in the order of the coach types.
+    Without data['coach_types'], the car types mirror the loco types (as in the w_rt model): each loco type hauls
+    only the car type of the same name, and there are no cab cars.
+    Returns a dict with coach_types, coach_Cfix, coach_Ckm, coach_cap, coach_cab, cab_cars and hauls (for each
+    loco type, a boolean array of the coach types it can haul).
+    '''
+    if 'coach_types' in data:
+        coach_types = list(data['coach_types'])
+        coaches = {key: np.array([data[key][coach_type] for coach_type in coach_types], dtype=float)
+                   for key in ('coach_Cfix', 'coach_Ckm', 'coach_cap', 'coach_cab')}
+        coaches['cab_cars'] = data['cab_cars']
+        coaches['hauls'] = {loco_type: np.ones(len(coach_types), dtype=bool) for loco_type in data['loco_types']}
+    else:
+        coach_types = list(data['loco_types'])
+        coaches = {'coach_' + key[4:]: np.array([data[key][coach_type] for coach_type in coach_types], dtype=float)
+                   for key in ('car_Cfix', 'car_Ckm', 'car_cap')}
+        coaches['coach_cab'] = np.zeros(len(coach_types))
+        coaches['cab_cars'] = 0
+        coaches['hauls'] = {loco_type: np.array([coach_type == loco_type for coach_type in coach_types])
+                            for loco_type in data['loco_types']}
+    coaches['coach_types'] = coach_types
+    return coaches
+
+
+def consist_catalogue(data):
+    '''
+    Enumerate the feasible consists: a loco type with a number of coaches of each coach type it can haul (see
+    coach_data()), between car_min and car_max coaches in total and with cab_cars cab cars.
+    Consists with the same loco type, capacity and costs are only kept once, and consists with a loco type for
+    which another consist is at least as large and at most as expensive are dropped.
+    Returns a dict of arrays with one entry per consist: loco (index in data['loco_types']), coaches (number of
+    each coach type), cars, capacity, Cfix and Ckm (of the whole consist, loco included).  The coach data is in
+    the coaches entry.
+    '''
+    coaches = coach_data(data)
+    loco, counts = [], []
+    for i, loco_type in enumerate(data['loco_types']):
+        car_max = data['car_max'][loco_type]
+        candidates = np.array(list(product(*[range(car_max + 1 if hauls else 1)
+                                             for hauls in coaches['hauls'][loco_type]])), dtype=int)
+        cars = candidates.sum(axis=1)
+        feasible = ((cars >= data['car_min'][loco_type]) & (cars <= car_max) &
+                    (candidates @ coaches['coach_cab'] == coaches['cab_cars']))
+        counts.append(candidates[feasible])
+        loco.append(np.full(feasible.sum(), i))
+    loco, counts = np.concatenate(loco), np.concatenate(counts)
+    loco_Cfix = np.array([data['loco_Cfix'][loco_type] for loco_type in data['loco_types']], dtype=float)
+    loco_Ckm = np.array([data['loco_Ckm'][loco_type] for loco_type in data['loco_types']], dtype=float)
+    capacity = counts @ coaches['coach_cap']
+    Cfix = loco_Cfix[loco] + counts @ coaches['coach_Cfix']
+    Ckm = loco_Ckm[loco] + counts @ coaches['coach_Ckm']
+
+    _, first = np.unique(np.column_stack([loco, capacity, Cfix, Ckm]), axis=0, return_index=True)
+    keep = np.sort(first)
+    loco, counts, capacity, Cfix, Ckm = loco[keep], counts[keep], capacity[keep], Cfix[keep], Ckm[keep]
+    # dominated[i, j]: consist j is at least as good as consist i on every count, and better on one.
+    at_least = ((loco[:, None] == loco[None, :]) & (capacity[None, :] >= capacity[:, None]) &
+                (Cfix[None, :] <= Cfix[:, None]) & (Ckm[None, :] <= Ckm[:, None]))
+    better = (capacity[None, :] > capacity[:, None]) | (Cfix[None, :] < Cfix[:, None]) | (Ckm[None, :] < Ckm[:, None])
+    keep = ~(at_least & better).any(axis=1)
+    return {'loco': loco[keep], 'coaches': counts[keep], 'cars': counts[keep].sum(axis=1), 'capacity': capacity[keep],
+            'Cfix': Cfix[keep], 'Ckm': Ckm[keep], 'coach_data': coaches}
+
+
+def symmetry_classes(data):
+    '''
+    Find the loco types and routes that are interchangeable in the model.
+    Two loco types are symmetric if all their loco and car data is the same.  Two routes are symmetric if they
+    serve the same stations (by name) with the same edge lengths and demand, and are in the same transfers, so
+    swapping their timetables gives a solution with the same cost.
+    Returns (loco classes, route classes): the lists of classes with more than one member, in data order.
+    '''
+    loco_classes, route_classes = {}, {}
+    for loco_type in data['loco_types']:
+        signature = tuple(data[key][loco_type] for key in ('loco_Cfix', 'loco_Ckm', 'loco_speed', 'car_Cfix',
+                                                           'car_Ckm', 'car_cap', 'car_min', 'car_max'))
+        loco_classes.setdefault(signature, []).append(loco_type)
+    for route in data['routes']:
+        names = data['station_to_name'][route]
+        edges = data['route_edges'][route]
+        signature = (tuple((names[edge[0]], names[edge[1]], data['edge_len'][route][edge],
+                            data['edge_Npassengers'][route][edge]) for edge in edges),
+                     data['route_dist'][route],
+                     tuple(transfer['routes'] is None or route in transfer['routes'] for transfer in data['transfers']))
+        route_classes.setdefault(signature, []).append(route)
+    return ([members for members in loco_classes.values() if len(members) > 1],
+            [members for members in route_classes.values() if len(members) > 1])
+
+
+def add_symmetry_breaking(m):
+    '''
+    Break the symmetries found by symmetry_classes():
+    - Identical loco types: only the first type of each class can be used (orbit fixing), since any solution
+      using another type of the class has the same cost with the first one.
+    - Identical routes r1, r2, ... (in data order): their loco types, in the order of loco_types, are
+      non-decreasing, and so are their numbers of cars when they use the same loco type.
+    '''
+    data, x_rt, w_rt = m._data, m._x_rt, m._w_rt
+    routes, loco_types = data['routes'], data['loco_types']
+    loco_classes, route_classes = symmetry_classes(data)
+    for members in loco_classes:
+        for loco_type in members[1:]:
+            for route in routes:
+                x_rt[route, loco_type].UB = 0
+
+    max_cars = max(data['car_max'][loco_type] for loco_type in loco_types)
+
+    def loco_index(route):
+        return gp.quicksum(k * x_rt[route, loco_type] for k, loco_type in enumerate(loco_types))
+
+    for members in route_classes:
+        for route1, route2 in zip(members, members[1:]):
+            m.addConstr(loco_index(route1) <= loco_index(route2), "symmetry_loco_{}_{}".format(route1, route2))
+            m.addConstr(w_rt.sum(route1, '*') <= w_rt.sum(route2, '*') + max_cars * (loco_index(route2) - loco_index(route1)),
+                        "symmetry_cars_{}_{}".format(route1, route2))
+
+
+def add_lazy_constraint(m, name, variables, coeffs, rhs):
+    '''
+    Register the linear constraint sum(coeffs[i] * variables[i]) >= rhs.
+    In eager mode the constraint is added to the model right away.  In lazy mode it is only stored in m._lazy
+    and added by lazy_callback() once a candidate solution violates it.
+    '''
+    if m._lazy_constraints:
+        m._lazy.append((name, variables, coeffs, rhs))
+    else:
+        m.addConstr(gp.LinExpr(coeffs, variables) >= rhs, name)
+
+
+def lazy_callback(model, where):
+    '''
+    Separate the stored lazy constraints.  Every constraint violated by the new incumbent candidate is added with
+    cbLazy.  The whole pool is checked at every candidate: Gurobi does not guarantee that later candidates respect
+    the constraints already added, so one that was added can be violated again.
+    m._lazy_added counts the cbLazy calls and m._lazy_used the distinct constraints of the pool (by index) added.
+    '''
+    if where != GRB.Callback.MIPSOL:
+        return
+    values = dict(zip(model._lazy_vars, model.cbGetSolution(model._lazy_vars)))
+    for index, (name, variables, coeffs, rhs) in enumerate(model._lazy):
+        activity = sum(coeff * values[var] for var, coeff in zip(variables, coeffs))
+        if activity < rhs - lazy_tolerance:
+            model.cbLazy(gp.LinExpr(coeffs, variables) >= rhs)
+            model._lazy_added += 1
+            model._lazy_used.add(index)
+
+
+def incumbent_callback(model, where):
+    # Record the (runtime, objective) of every new incumbent in m._incumbents.
+    if where == GRB.Callback.MIPSOL:
+        model._incumbents.append((model.cbGet(GRB.Callback.RUNTIME), model.cbGet(GRB.Callback.MIPSOL_OBJ)))
+
+
+def record_incumbents(m):
+    # Register incumbent_callback() on a model built by build_model().
+    m._incumbents = []
+    if incumbent_callback not in m._callbacks:
+        m._callbacks.append(incumbent_callback)
+
+
+def time_to_first_incumbent(m):
+    # Runtime when the first incumbent was found (None if none was found), after record_incumbents().
+    if m._incumbents:
+        return m._incumbents[0][0]
+    # A solution found in presolve is not reported to the callback.
+    return m.Runtime if m.SolCount > 0 else None
+
+
+def level3_callback(model, where):
+    # Dispatch to every callback registered on the model in m._callbacks.
+    for callback in model._callbacks:
+        callback(model, where)
+
+
+def optimize(m):
+    # Optimize the model, passing the callback only if something was registered.
+    if m._callbacks:
+        m.optimize(level3_callback)
+    else:
+        m.optimize()
+
+
+def build_model(data, name="level3", lazy_constraints=False, headways=True, frequency_selection=False,
+                time_unit='min', passenger_routing=False, symmetry_breaking=False, consists=False,
+                speed_profiles=False, m=None, tag=None, env=None):
+    '''
+    Build the level 3 model from the data returned by init_data().
+    The variable dicts are attached to the returned model (e.g. m._x_rt, m._arrival_times) so that the results
+    can be read after optimizing.
+
+    Times are in time_unit (see time_units) and the max-speed constraints use the running times from
+    running_times().  The number of trains of a route is its cycle time divided by the period, both in the same
+    unit.
+
+    If lazy_constraints is True the max-speed constraints are not added up front.  They are stored in m._lazy
+    and separated by lazy_callback() when a candidate solution violates them.  The headway constraints are
+    separated the same way.
+
+    If headways is True, trains of different routes using the same edge in the same direction are kept at least
+    headway_time apart (see headway_pairs()).
+
+    If frequency_selection is True, each route chooses its period from data['period_choices'] with the binary
+    variables m._y_rp, and the number of trains of a route is cycle time / chosen period.  Each train must carry
+    the demand of one chosen period (edge_Npassengers is the demand per period).  The choices must
+    divide data['period'], which is used as the hyperperiod.
+    Headway constraints then use the gcd of the chosen periods of the two routes, and are added eagerly as
+    indicator constraints (lazy mode only applies to the max-speed constraints).
+
+    If passenger_routing is True, the capacity constraints on edge_Npassengers are replaced by the assignment of
+    data['od_demand'] to the routes (see add_passenger_flows()), so routes serving the same stations share the
+    passengers.  The flows are in m._flow.
+
+    If symmetry_breaking is True, the symmetric loco types and routes found by symmetry_classes() are broken (see
+    add_symmetry_breaking()).  Only use it when no constraint is added to a single route after the build (e.g. not
+    for disruption recovery), since the routes would not be symmetric anymore.
+
+    If consists is True, each route chooses one consist of consist_catalogue() (in m._catalogue) with the binary
+    variables m._consist[route, k], which sum to 1 for each route.  The costs and capacity of a route are those of
+    its consist, and x_rt and w_rt (continuous, the total number of coaches) are set by the choice.
+
+    If speed_profiles is True, the train of each route chooses one speed level of speed_profile_table() on each edge
+    and direction, with the binary variables m._profiles[route, loco_type, edge, direction] (a list of (variable,
+    running time, level, extra cost per km)) which sum to x_rt.  The running time of the chosen level replaces the running time at
+    max speed, and its energy saving is added to the objective for every trip of the route (see energy_costs()).
+
+    If m is given, the model is added to m as another block instead of creating a new model: its objective is
+    added to the objective of m.  The names of the variables and constraints of the block are prefixed with tag.
+    The m._x_rt, m._arrival_times, ... attributes then refer to the last block added.
+
+    The model is created in env (the default environment if None), so a script solving many models can start one
+    gp.Env and reuse it.  Parameters are only set on the model, never globally, so they do not leak into other
+    models of the same process.  The caller should dispose the model (or use it in a with block) when done.
+    '''
+    loco_types = data['loco_types']
+    car_cap, car_min, car_max = data['car_cap'], data['car_min'], data['car_max']
+    routes, route_edges = data['routes'], data['route_edges']
+    edge_Npassengers = data['edge_Npassengers']
+    period = data['period']
+    period_units = to_time_units(period, time_unit)
+    running_time = running_times(data, time_unit)
+
+    # Create a new model
+    new_model = m is None
+    if new_model:
+        m = gp.Model(name, env=env)
+        # This is required to allow for multiple train type.  If the default value (-1) is used, we get error:
+        # Error code 10020: Objective Q not PSD (diagonal adjustment of 2.3e+02 would be required). Set NonConvex parameter to 2 to solve model.
+        m.setParam("NonConvex", 2)
+        m._formulation = formulation_name(
+            {'lazy_constraints': lazy_constraints, 'headways': headways, 'frequency_selection': frequency_selection,
+             'time_unit': time_unit, 'passenger_routing': passenger_routing, 'symmetry_breaking': symmetry_breaking,
+             'consists': consists, 'speed_profiles': speed_profiles})
+        for parameter, value in profile_parameters(m._formulation).items():
+            m.setParam(parameter, value)
+        m._callbacks = []
+        m._lazy = []
+        m._lazy_added = 0
+        m._lazy_used = set()
+    m.update()
+    first_var, first_constr, first_qconstr, first_genconstr = m.NumVars, m.NumConstrs, m.NumQConstrs, m.NumGenConstrs
+    m._data = data
+    m._lazy_constraints = lazy_constraints
+    m._frequency_selection = frequency_selection
+    m._time_unit = time_unit
+    m._consists = consists
+    m._speed_profiles = speed_profiles
+
+    if frequency_selection:
+        period_choices = data['period_choices']
+        if period % hyperperiod(period_choices) != 0:
+            raise ValueError("The period choices {} must divide the period {}".format(period_choices, period))
+
 
     # Create Variables and Set Objective: ------------------------------------------------------------------------------
 
@@ -157,7 +916,33 @@ port 40 passengers (and the reverse)
     x_rt = m.addVars(routes, loco_types, vtype=GRB.BINARY, name="x_rt")  # returns a tuple dict.  e.g. x_rt['r1', 'a']
 
     # Create and add the integer variables w_(r,t) representing the number of coaches of type t on route r
-    w_rt = m.addVars(routes, loco_types, vtype=GRB.INTEGER, name="w_rt")
+    # (continuous with consists, where the choice of consist sets it).
+    w_rt = m.addVars(routes, loco_types, vtype=GRB.CONTINUOUS if consists else GRB.INTEGER, name="w_rt")
+
+    # Consists: consist[route, k] is 1 if route uses consist k of the catalogue.
+    if consists:
+        catalogue = consist_catalogue(data)
+        consist = m.addVars(routes, range(len(catalogue['loco'])), vtype=GRB.BINARY, name="consist")
+        m._catalogue = catalogue
+        m._consist = consist
+
+    # Speed profiles: one binary per speed level of each loco type on each edge and direction.
+    if speed_profiles:
+        profile_table = speed_profile_table(data, time_unit)
+        profiles = {}
+        for route in routes:
+            table = profile_table[route]
+            for i, edge in enumerate(route_edges[route]):
+                for j, loco_type in enumerate(loco_types):
+                    for direction in (0, 1):
+                        choices = []
+                        for k in np.flatnonzero(table['valid'][i, j]):
+                            var = m.addVar(vtype=GRB.BINARY, name="profile_{}_{}_{}_{}_{}_{}".format(
+                                route, name_part(loco_type), edge[0], edge[1], direction, k))
+                            choices.append((var, float(table['time'][i, j, k]), float(table['level'][i, j, k]),
+                                            float(table['Ckm'][i, j, k])))
+                        profiles[route, loco_type, edge, direction] = choices
+        m._profiles = profiles
 
     # Additions for Level 2:
     # - The estimated cycle time is now a decision variable (this is used in the objective to determine the number of trains used)
@@ -202,63 +987,138 @@ port 40 passengers (and the reverse)
             route_cycle_times[loco_type] = m.addVar(vtype=GRB.CONTINUOUS, name="cycletime_{}_{}".format(route, loco_type))
         cycle_times[route] = route_cycle_times
 
+    m._x_rt = x_rt
+    m._w_rt = w_rt
+    m._arrival_times = arrival_times
+    m._departure_times = departure_times
+    m._cycle_times = cycle_times
+
+    # Frequency selection:
+    # y_rp is 1 if route r runs every p minutes.  num_trains[route][loco_type] is the cycle time divided by the
+    # chosen period, set with one indicator constraint per period choice so the model stays linear in y_rp.
+    # It replaces cycle_times / period in the objective, so with p == period the cost is the same.
+    num_trains = {}
+    if frequency_selection:
+        y_rp = m.addVars(routes, period_choices, vtype=GRB.BINARY, name="y_rp")
+        m.addConstrs((y_rp.sum(route, '*') == 1 for route in routes), name="one_period")
+        for route in routes:
+            num_trains[route] = {}
+            for loco_type in loco_types:
+                n = m.addVar(vtype=GRB.CONTINUOUS, name="numtrains_{}_{}".format(route, loco_type))
+                for p in period_choices:
+                    m.addGenConstrIndicator(y_rp[route, p], True, n - cycle_times[route][loco_type] / to_time_units(p, time_unit),
+                                            GRB.GREATER_EQUAL, 0, name="numtrains_{}_{}_{}".format(route, loco_type, p))
+                num_trains[route][loco_type] = n
+        m._y_rp = y_rp
+    else:
+        for route in routes:
+            num_trains[route] = {loco_type: cycle_times[route][loco_type] / period_units for loco_type in loco_types}
+    m._num_trains = num_trains
+
     # Set objective (level2/3 is quadratic instead of linear)
-    obj = 0
-    for route in routes:
-        for loco_type in loco_types:
-            fixed_costs = x_rt[route, loco_type]*loco_Cfix[loco_type] + w_rt[route, loco_type]*car_Cfix[loco_type]
-            variable_costs = route_dist[route] * (x_rt[route, loco_type]*loco_Ckm[loco_type] + w_rt[route, loco_type]*car_Ckm[loco_type])
-            # obj += level1_num_trains[route][loco_type] * (fixed_costs + variable_costs)  # Level 1
-            obj += (cycle_times[route][loco_type] / period) * (fixed_costs + variable_costs)
+    if consists:
+        obj = consist_costs(data, catalogue, consist, num_trains)
+    else:
+        obj = route_costs(data, x_rt, w_rt, num_trains)
+    if speed_profiles:
+        obj += energy_costs(m)
 
     # Set objective
-    m.setObjective(obj, GRB.MINIMIZE)
+    if new_model:
+        m.setObjective(obj, GRB.MINIMIZE)
+    else:
+        m.update()
+        m.setObjective(m.getObjective() + obj, GRB.MINIMIZE)
 
 
     # Add Constraints: -------------------------------------------------------------------------------------------------
 
     # Add constraints on decision variables:
-    for route in routes:
-        for loco_type in loco_types:
-            # Min/Max allowed number of cars
-            m.addConstr(w_rt[route, loco_type] >= car_min[loco_type]*x_rt[route, loco_type], "car_min_rt_{}_{}".format(route, loco_type))
-            m.addConstr(w_rt[route, loco_type] <= car_max[loco_type] * x_rt[route, loco_type], "car_min_rt_{}_{}".format(route, loco_type))
+    if consists:
+        # One consist per route, which sets the loco type and the number of coaches.  The catalogue only has
+        # consists with car_min to car_max coaches.
+        m.addConstrs((consist.sum(route, '*') == 1 for route in routes), name="one_consist")
+        for route in routes:
+            for i, loco_type in enumerate(loco_types):
+                of_loco = [k for k in range(len(catalogue['loco'])) if catalogue['loco'][k] == i]
+                m.addConstr(x_rt[route, loco_type] == gp.quicksum(consist[route, k] for k in of_loco),
+                            "consist_loco_{}_{}".format(route, loco_type))
+                m.addConstr(w_rt[route, loco_type] == gp.quicksum(int(catalogue['cars'][k]) * consist[route, k]
+                                                                  for k in of_loco),
+                            "consist_cars_{}_{}".format(route, loco_type))
+    else:
+        for route in routes:
+            for loco_type in loco_types:
+                # Min/Max allowed number of cars
+                m.addConstr(w_rt[route, loco_type] >= car_min[loco_type]*x_rt[route, loco_type], "car_min_rt_{}_{}".format(route, loco_type))
+                m.addConstr(w_rt[route, loco_type] <= car_max[loco_type] * x_rt[route, loco_type], "car_max_rt_{}_{}".format(route, loco_type))
+
+    if speed_profiles:
+        # One speed level per edge and direction for the loco type of the route.
+        for (route, loco_type, edge, direction), choices in profiles.items():
+            m.addConstr(gp.quicksum(choice[0] for choice in choices) == x_rt[route, loco_type],
+                        "profile_{}_{}_{}_{}_{}".format(route, name_part(loco_type), edge[0], edge[1], direction))
 
+    if symmetry_breaking:
+        add_symmetry_breaking(m)
 
     # Add constraints based on properties rail network. (e.g. passenger capacity).
+    # The capacity rows are divided by the largest car capacity, so their coefficients are about 1 (numbers of cars).
+    cap_scale = max(car_cap[loco_type] for loco_type in loco_types)
+    if consists:
+        cap_scale = float(catalogue['coach_data']['coach_cap'].max())
+    route_capacity = {}
     for route in routes:
-        cur_route_capacity = sum((w_rt[route, loco_type] * car_cap[loco_type]) for loco_type in loco_types)
+        if consists:
+            cur_route_capacity = gp.quicksum(float(capacity / cap_scale) * consist[route, k]
+                                             for k, capacity in enumerate(catalogue['capacity']))
+        else:
+            cur_route_capacity = sum((w_rt[route, loco_type] * (car_cap[loco_type] / cap_scale)) for loco_type in loco_types)
+        route_capacity[route] = cur_route_capacity
+        if passenger_routing:
+            continue
+        if frequency_selection:
+            # edge_Npassengers is the demand per period, so a train running every p minutes carries p/period of it.
+            # Only the busiest edge of the route is needed.
+            max_Npassengers = max(edge_Npassengers[route][edge] for edge in route_edges[route])
+            for p in period_choices:
+                m.addGenConstrIndicator(y_rp[route, p], True, cur_route_capacity, GRB.GREATER_EQUAL,
+                                        max_Npassengers / cap_scale * p / period, name="capacity_{}_{}".format(route, p))
+            continue
         for edge in route_edges[route]:
             # Add constraint that the passenger requirements for each edge are met.
-            m.addConstr(edge_Npassengers[route][edge] <= cur_route_capacity)
+            m.addConstr(cur_route_capacity >= edge_Npassengers[route][edge] / cap_scale,
+                        "capacity_{}_{}_{}".format(route, edge[0], edge[1]))
+    m._flow = add_passenger_flows(m, route_capacity, cap_scale) if passenger_routing else None
 
     # Add Level 2 and some level 3 Constraints:
 
     # Constraint to ensure the train does not exceed its max speed between any pair of stations.
-    # the LHS is speed on edge and the RHS is the max speed of train.
-    # - if the loco type is not used on the route, LHS == RHS == 0.
+    # We have distance / (arrival at s_i - departure at s_i-1) <= max speed.  i.e. distance/time = velocity
+    # Since arrival_times[route][0][edge] >= departure_times[route][0][edge], this is the same as
+    # (arrival - departure) >= distance / max speed, which is the precomputed running time of the loco type.
+    # - if the loco type is not used on the route, the RHS is 0.
+    # - with speed profiles, the running time is the one of the chosen speed level.
     for route in routes:
         for loco_type in loco_types:
             for edge in route_edges[route]:
-                # Forward direction (going from s_i-1 to s_i).
+                # Forward direction (going from s_i-1 to s_i) and the reverse direction.
                 # The structure is: arrival_times[route][direction][edge]
-                # We have distance / (arrival at s_i - departure at s_i-1).  i.e. distance/time = velocity
-                # fwd_speed = edge_len[edge] / (arrival_times[route][0][edge] - departure_times[route][0][edge])  # Error code 10003: Divisor must be a constant
-                # m.addConstr(x_rt[route, loco_type] * fwd_speed <= x_rt * loco_speed[loco_type])
-                # The following fixes the error and is equivalent since arrival_times[route][0][edge] >= departure_times[route][0][edge]
-                m.addConstr(x_rt[route, loco_type] * edge_len[route][edge]
-                            <=
-                            x_rt[route, loco_type] * loco_speed[loco_type] * (arrival_times[route][0][edge] - departure_times[route][0][edge]))
-                # The reverse direction:
-                m.addConstr(x_rt[route, loco_type] * edge_len[route][edge]
-                            <=
-                            x_rt[route, loco_type] * loco_speed[loco_type] * (arrival_times[route][1][edge] - departure_times[route][1][edge]))
+                for direction in (0, 1):
+                    if speed_profiles:
+                        choices = profiles[route, loco_type, edge, direction]
+                        variables = [choice[0] for choice in choices]
+                        coeffs = [-choice[1] for choice in choices]
+                    else:
+                        variables, coeffs = [x_rt[route, loco_type]], [-running_time[route][edge][loco_type]]
+                    add_lazy_constraint(m, "speed_{}_{}_{}_{}_{}".format(route, loco_type, edge[0], edge[1], direction),
+                                        [arrival_times[route][direction][edge], departure_times[route][direction][edge]]
+                                        + variables, [1, -1] + coeffs, 0)
 
     # Constraints to ensure that stations are visited in order:
     # Also to ensure that each station is waited at for at least 1 minute.
     # Note: Waiting at a station also creates padding/headway between trains since they all follow
     #   the same cyclic schedule.
-    wait_time_at_station = 1
     for route in routes:
         i = 0
         route_len = len(route_edges[route])
@@ -269,15 +1129,18 @@ port 40 passengers (and the reverse)
             if i != 0: # and i != route_len-1:
                 prev_edge = route_edges[route][i - 1]
                 # Ensure station departing from has been arrived at in previous edge.
-                m.addConstr(departure_times[route][0][edge] >= arrival_times[route][0][prev_edge] + (wait_time_at_station / period))
+                m.addConstr(departure_times[route][0][edge] >= arrival_times[route][0][prev_edge] + to_time_units(wait_time_at_station, time_unit),
+                            "dwell_{}_{}_{}".format(route, edge[0], 0))
             # Ensure we arrive at the next station in edge after we depart.
-            m.addConstr(arrival_times[route][0][edge] >= departure_times[route][0][edge])
+            m.addConstr(arrival_times[route][0][edge] >= departure_times[route][0][edge],
+                        "run_{}_{}_{}_{}".format(route, edge[0], edge[1], 0))
             i += 1
 
         # Constraint for the turn-around point on each route:
         # The loco departs the last station on direction 1 (reverse) after it arrives in direction 0 (forward).
         turnaround = route_edges[route][-1]  # The last edge.
-        m.addConstr(departure_times[route][1][turnaround] >= arrival_times[route][0][turnaround] + (wait_time_at_station / period))
+        m.addConstr(departure_times[route][1][turnaround] >= arrival_times[route][0][turnaround] + to_time_units(wait_time_at_station, time_unit),
+                    "turnaround_{}_{}".format(route, turnaround[1]))
 
         # Reverse direction:
         i = route_len - 1
@@ -286,9 +1149,11 @@ port 40 passengers (and the reverse)
             if i != route_len - 1: # and i != route_len-1:
                 prev_edge = route_edges[route][i + 1]
                 # Ensure station departing from has been arrived at in previous edge.
-                m.addConstr(departure_times[route][1][edge] >= arrival_times[route][1][prev_edge] + (wait_time_at_station / period))
+                m.addConstr(departure_times[route][1][edge] >= arrival_times[route][1][prev_edge] + to_time_units(wait_time_at_station, time_unit),
+                            "dwell_{}_{}_{}".format(route, edge[1], 1))
             # Ensure we arrive at the next station in edge after we depart.
-            m.addConstr(arrival_times[route][1][edge] >= departure_times[route][1][edge])
+            m.addConstr(arrival_times[route][1][edge] >= departure_times[route][1][edge],
+                        "run_{}_{}_{}_{}".format(route, edge[0], edge[1], 1))
             i -= 1
 
     # Constraint to set the value of the cycle time of route r for locomotive of type t
@@ -300,27 +1165,200 @@ port 40 passengers (and the reverse)
             first_station = route_edges[route][0]
             m.addConstr(x_rt[route, loco_type] * cycle_times[route][loco_type]
                         ==
-                        x_rt[route, loco_type] * arrival_times[route][1][first_station])
+                        x_rt[route, loco_type] * arrival_times[route][1][first_station],
+                        "cycle_{}_{}".format(route, loco_type))
 
 
     # More Level 3 constraints:
-    # Ensure trains overlap at union station for at least 5 minutes:
-    union_overlap_time = (5 / period)
-    union_r1 = route_edges['r1'][0]
-    union_r2 = route_edges['r2'][0]
-    m.addConstr(departure_times['r1'][0][union_r1] >= union_overlap_time)
-    m.addConstr(departure_times['r2'][0][union_r2] >= union_overlap_time)
+    # Ensure trains overlap at the transfer stations (e.g. at Union for at least 5 minutes):
+    # Every train of transfer t is at the station during [overlap_start[t], overlap_end[t]], which is at least
+    # min_overlap long.  This needs one constraint per route instead of one per pair of routes.
+    transfer_windows = {}
+    for t, route, position, direction, min_overlap, max_overlap in compile_transfers(data):
+        transfer_windows[t, route] = dwell_window(m, route, position, direction) + (min_overlap, max_overlap)
+    transfer_ids = sorted({t for t, _ in transfer_windows})
+    overlap_start = m.addVars(transfer_ids, vtype=GRB.CONTINUOUS, name="overlap_start")
+    overlap_end = m.addVars(transfer_ids, vtype=GRB.CONTINUOUS, name="overlap_end")
+    m.addConstrs((overlap_start[t] >= transfer_windows[t, route][0] for t, route in transfer_windows),
+                 name="overlap_arrival")
+    m.addConstrs((overlap_end[t] <= transfer_windows[t, route][1] for t, route in transfer_windows),
+                 name="overlap_departure")
+    # The longest min_overlap of the rows of a transfer, as in the evaluator.
+    min_overlap = {}
+    for (t, _), window in transfer_windows.items():
+        min_overlap[t] = max(min_overlap.get(t, 0), window[2])
+    m.addConstrs((overlap_end[t] - overlap_start[t] >= to_time_units(min_overlap[t], time_unit) for t in transfer_ids),
+                 name="overlap_min")
+    m.addConstrs((transfer_windows[t, route][1] - transfer_windows[t, route][0]
+                  <= to_time_units(transfer_windows[t, route][3], time_unit)
+                  for t, route in transfer_windows if transfer_windows[t, route][3] is not None),
+                 name="overlap_max")
 
+    # Headway between trains of different routes on shared track:
+    # PESP constraint headway <= (t1 - t2 + period * z) <= period - headway for both the departure and the arrival
+    # on the edge, where z is an integer shift in periods.
+    # The same z is used for the departure and arrival so trains cannot overtake each other on the edge.
+    headway_time = to_time_units(min_headway, time_unit)
+    m._headway_z = {}
+    if headways and frequency_selection:
+        add_frequency_headways(m, headway_time)
+    elif headways:
+        for key, (route1, edge1), (route2, edge2), direction in headway_pairs(data):
+            z = m.addVar(lb=-GRB.INFINITY, vtype=GRB.INTEGER,
+                         name="z_headway_{}_{}_{}_{}_{}".format(route1, route2, edge1[0], edge1[1], direction))
+            m._headway_z[key, route1, route2] = z
+            for event, times in (('d', departure_times), ('a', arrival_times)):
+                t1, t2 = times[route1][direction][edge1], times[route2][direction][edge2]
+                constr_name = "headway_{}_{}_{}_{}_{}_{}".format(event, route1, route2, edge1[0], edge1[1], direction)
+                add_lazy_constraint(m, constr_name + "_lb", [t1, t2, z], [1, -1, period_units], headway_time)
+                add_lazy_constraint(m, constr_name + "_ub", [t1, t2, z], [-1, 1, -period_units], headway_time - period_units)
 
+    if lazy_constraints:
+        # Lazy constraints must be enabled on the model for cbLazy to be allowed.
+        m.setParam("LazyConstraints", 1)
+        m.update()
+        m._lazy_vars = list({var for _, variables, _, _ in m._lazy for var in variables})
+        if lazy_callback not in m._callbacks:
+            m._callbacks.append(lazy_callback)
 
-    # Optimize and Print Results: --------------------------------------------------------------------------------------
+    if tag is not None:
+        # Prefix the names of this block so they stay unique in m.
+        m.update()
+        for var in m.getVars()[first_var:]:
+            var.VarName = "{}_{}".format(tag, var.VarName)
+        for constr in m.getConstrs()[first_constr:]:
+            constr.ConstrName = "{}_{}".format(tag, constr.ConstrName)
+        for qconstr in m.getQConstrs()[first_qconstr:]:
+            qconstr.QCName = "{}_{}".format(tag, qconstr.QCName)
+        for genconstr in m.getGenConstrs()[first_genconstr:]:
+            genconstr.GenConstrName = "{}_{}".format(tag, genconstr.GenConstrName)
 
-    # Optimize model
-    m.optimize()
+    return m
 
 
+def route_costs(data, x_rt, w_rt, num_trains):
+    # Cost of running the trains of every route: number of trains * (fixed costs + variable costs).
+    loco_Cfix, loco_Ckm, car_Cfix, car_Ckm = data['loco_Cfix'], data['loco_Ckm'], data['car_Cfix'], data['car_Ckm']
+    route_dist = data['route_dist']
+    obj = 0
+    for route in data['routes']:
+        for loco_type in data['loco_types']:
+            fixed_costs = x_rt[route, loco_type]*loco_Cfix[loco_type] + w_rt[route, loco_type]*car_Cfix[loco_type]
+            variable_costs = route_dist[route] * (x_rt[route, loco_type]*loco_Ckm[loco_type] + w_rt[route, loco_type]*car_Ckm[loco_type])
+            # obj += level1_num_trains[route][loco_type] * (fixed_costs + variable_costs)  # Level 1
+            obj += num_trains[route][loco_type] * (fixed_costs + variable_costs)
+    return obj
+
+
+def consist_costs(data, catalogue, consist, num_trains):
+    # Cost of running the trains of every route with the consists of consist_catalogue().
+    route_dist, loco_types = data['route_dist'], data['loco_types']
+    obj = 0
+    for route in data['routes']:
+        for k, (loco, Cfix, Ckm) in enumerate(zip(catalogue['loco'], catalogue['Cfix'], catalogue['Ckm'])):
+            obj += num_trains[route][loco_types[loco]] * consist[route, k] * float(Cfix + route_dist[route] * Ckm)
+    return obj
+
+
+def energy_costs(m):
+    '''
+    Extra energy cost of the speed levels chosen in a model built with speed profiles (negative for a saving).
+    Each route runs one trip per period of the data (period / chosen period trips with frequency selection), and
+    each trip runs every edge once in each direction.
+    '''
+    data = m._data
+    trip_energy = {route: 0 for route in data['routes']}
+    for (route, _, edge, _), choices in m._profiles.items():
+        trip_energy[route] += gp.quicksum(data['edge_len'][route][edge] * Ckm * var for var, _, _, Ckm in choices)
+    if not m._frequency_selection:
+        return gp.quicksum(trip_energy.values())
+    return gp.quicksum(trip_energy[route] * gp.quicksum(data['period'] / p * m._y_rp[route, p]
+                                                        for p in data['period_choices'])
+                       for route in data['routes'])
+
+
+def add_frequency_headways(m, headway_time):
+    '''
+    Headway constraints when each route chooses its period (see build_model()).
+    Two routes with periods p and q meet every gcd(p, q) minutes, so the PESP constraint uses that period:
+    headway <= (t1 - t2 + g * z_g) <= g - headway, enforced by an indicator on u_g, which is forced to 1 when
+    the chosen periods have gcd g.  Combinations where g is less than two headways are infeasible and forbidden.
+    '''
+    data, y_rp = m._data, m._y_rp
+    period_choices = data['period_choices']
+    arrival_times, departure_times = m._arrival_times, m._departure_times
+    gcd_choices = {}
+    for p in period_choices:
+        for q in period_choices:
+            gcd_choices.setdefault(gcd(p, q), []).append((p, q))
+
+    for key, (route1, edge1), (route2, edge2), direction in headway_pairs(data):
+        pair_name = "{}_{}_{}_{}_{}".format(route1, route2, edge1[0], edge1[1], direction)
+        for g, combinations in gcd_choices.items():
+            g_units = to_time_units(g, m._time_unit)
+            if g_units < 2 * headway_time:
+                m.addConstrs((y_rp[route1, p] + y_rp[route2, q] <= 1 for p, q in combinations),
+                             name="headway_forbid_{}_{}".format(pair_name, g))
+                continue
+            u = m.addVar(vtype=GRB.BINARY, name="u_headway_{}_{}".format(pair_name, g))
+            z = m.addVar(lb=-GRB.INFINITY, vtype=GRB.INTEGER, name="z_headway_{}_{}".format(pair_name, g))
+            m._headway_z[key, route1, route2, g] = z
+            m.addConstrs((u >= y_rp[route1, p] + y_rp[route2, q] - 1 for p, q in combinations),
+                         name="headway_gcd_{}_{}".format(pair_name, g))
+            for event, times in (('d', departure_times), ('a', arrival_times)):
+                t1, t2 = times[route1][direction][edge1], times[route2][direction][edge2]
+                constr_name = "headway_{}_{}_{}".format(event, pair_name, g)
+                m.addGenConstrIndicator(u, True, t1 - t2 + g_units * z, GRB.GREATER_EQUAL, headway_time,
+                                        name=constr_name + "_lb")
+                m.addGenConstrIndicator(u, True, t1 - t2 + g_units * z, GRB.LESS_EQUAL, g_units - headway_time,
+                                        name=constr_name + "_ub")
+
+
+def solved_timetable(m):
+    '''
+    Read the solution of a model built by build_model() into plain dicts, so it can be used without the model.
+    The structure is the same as in the model, e.g. timetable['arrival_times'][route][direction][edge], with
+    times in timetable['time_unit'].  loco_type, cars, cycle_time and period (minutes) are given per route, and
+    with consists the number of coaches of each coach type in timetable['coaches'][route].  With speed profiles,
+    timetable['speed_level'][route][direction][edge] is the chosen speed level.
+    '''
+    data = m._data
+    timetable = {'time_unit': m._time_unit, 'loco_type': {}, 'cars': {}, 'cycle_time': {}, 'period': {},
+                 'arrival_times': {}, 'departure_times': {}}
+    for route in data['routes']:
+        loco_type = max(data['loco_types'], key=lambda loco_type: m._x_rt[route, loco_type].x)
+        timetable['loco_type'][route] = loco_type
+        timetable['cars'][route] = round(m._w_rt[route, loco_type].x)
+        timetable['cycle_time'][route] = m._cycle_times[route][loco_type].x
+        timetable['period'][route] = data['period']
+        if m._speed_profiles:
+            timetable.setdefault('speed_level', {})[route] = {
+                direction: {edge: max(m._profiles[route, loco_type, edge, direction], key=lambda choice: choice[0].x)[2]
+                            for edge in data['route_edges'][route]} for direction in (0, 1)}
+        if m._consists:
+            k = max(range(len(m._catalogue['loco'])), key=lambda k: m._consist[route, k].x)
+            coach_types = m._catalogue['coach_data']['coach_types']
+            timetable.setdefault('coaches', {})[route] = {coach_type: int(n) for coach_type, n
+                                                          in zip(coach_types, m._catalogue['coaches'][k]) if n}
+        if m._frequency_selection:
+            timetable['period'][route] = max(data['period_choices'], key=lambda p: m._y_rp[route, p].x)
+        for key, times in (('arrival_times', m._arrival_times), ('departure_times', m._departure_times)):
+            timetable[key][route] = {direction: {edge: var.x for edge, var in times[route][direction].items()}
+                                     for direction in (0, 1)}
+    return timetable
+
+
+def print_results(m):
+    # Print the solution of a model built by build_model().
+    data = m._data
+    loco_types, routes, route_edges = data['loco_types'], data['routes'], data['route_edges']
+    stations, station_to_name, route_to_name = data['stations'], data['station_to_name'], data['route_to_name']
+    period = data['period']
+    x_rt, w_rt, cycle_times = m._x_rt, m._w_rt, m._cycle_times
+    arrival_times, departure_times = m._arrival_times, m._departure_times
+
     def value_to_minutes(val):
-        return val*60
+        return val / time_units[m._time_unit]
 
     print("\nStation to name mapping: - - - -")
     for route in routes:
@@ -332,15 +1370,26 @@ port 40 passengers (and the reverse)
     print("\tNote: x_rt is binary.  1 if type t is used on route r.  Similar, w_rt is the number of coaches for type t")
     for route in routes:
         print("\tRoute {}:".format(route))
+        route_period = period
+        if m._frequency_selection:
+            route_period = max(data['period_choices'], key=lambda p: m._y_rp[route, p].x)
+            print("\t\tPeriod: {}m".format(route_period))
         for loco_type in loco_types:
-            print("\t\tNumber of loco used: {}".format(ceil(cycle_times[route][loco_type].x * 60 / period)))
+            print("\t\tNumber of loco used: {}".format(ceil(value_to_minutes(cycle_times[route][loco_type].x) / route_period - 1e-6)))
             print("\t\t{} {}".format(x_rt[route, loco_type].varName, x_rt[route, loco_type].x))
             print("\t\t{} {}".format(w_rt[route, loco_type].varName, w_rt[route, loco_type].x))
+        if m._consists:
+            k = max(range(len(m._catalogue['loco'])), key=lambda k: m._consist[route, k].x)
+            coaches = zip(m._catalogue['coach_data']['coach_types'], m._catalogue['coaches'][k])
+            print("\t\tConsist: {} with {}, capacity {:.0f}".format(
+                loco_types[m._catalogue['loco'][k]], ", ".join("{} {}".format(n, coach_type)
+                                                               for coach_type, n in coaches if n),
+                m._catalogue['capacity'][k]))
 
 
     print("\nRoute Schedules: - - - -")
     for route in routes:
-        print("\n\tRoute {} - formatted (station event, event time in units of period, event time in minutes):".format(route))
+        print("\n\tRoute {} - formatted (station event, event time in time units, event time in minutes):".format(route))
         for edge in route_edges[route]:
             depart_var = departure_times[route][0][edge]
             arrive_var = arrival_times[route][0][edge]
@@ -360,10 +1409,35 @@ port 40 passengers (and the reverse)
             print("\t\t{} {} {}m".format(cycle_times[route][loco_type].varName,
                                         cycle_times[route][loco_type].x, value_to_minutes(cycle_times[route][loco_type].x)))
 
+    if m._lazy_constraints:
+        print("\nLazy constraints added: {} ({} distinct, not needed: {})".format(
+            m._lazy_added, len(m._lazy_used), len(m._lazy) - len(m._lazy_used)))
+
     print("\n########\nThe Objective Value is {}\n########".format(m.objVal))
 
-except gp.GurobiError as e:
-    print('Error code ' + str(e.errno) + ': ' + str(e))
 
-except AttributeError:
-    print('Encountered an attribute error')
+if __name__ == "__main__":
+    try:
+
+        with gp.Env() as env, build_model(init_data(), lazy_constraints=lazy_constraints,
+                                          frequency_selection=frequency_selection, time_unit=time_unit,
+                                          passenger_routing=passenger_routing, symmetry_breaking=symmetry_breaking,
+                                          consists=consists, speed_profiles=speed_profiles, env=env) as m:
+
+            # Optimize and Print Results: ------------------------------------------------------------------------------
+
+            # Optimize model
+            optimize(m)
+
+            if m.SolCount > 0:
+                print_results(m)
+            else:
+                # No solution to print: report the status, and the conflicting constraints if it is infeasible.
+                from level3_diagnostics import diagnose, print_diagnostics
+                print_diagnostics(diagnose(m))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
+
+    except AttributeError:
+        print('Encountered an attribute error')
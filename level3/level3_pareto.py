@@ -0,0 +1,178 @@
+#!/usr/bin/env python3.7
+
+# Pareto frontier of the level 3 model: operating cost vs. passenger in-vehicle time vs. fleet size.
+# - in-vehicle time: passengers of each edge (edge_Npassengers) * the running time of the train on the edge, in
+#   passenger-minutes per period.  Dwells are not counted since the demand does not say who stays on board.
+# - fleet size: the number of units, i.e. the number of trains of each route rounded up.
+# - The frontier is computed with the augmented epsilon-constraint method: the cost (plus a small multiple of the
+#   two other objectives, so no point is weakly dominated) is minimized with in-vehicle time <= e1 and
+#   fleet <= e2, over a grid of (e1, e2) between the extreme points.
+# - Each worker process solves the points of one fleet bound in a single model, from the tightest to the loosest
+#   in-vehicle time bound, so the previous solution is always a feasible MIP start for the next point.
+
+import multiprocessing
+import time
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import init_data, build_model, optimize, time_units
+
+debug = False
+# debug = True
+
+# Weight of the in-vehicle time (per passenger-minute) and of the fleet (per unit) added to the cost.
+augmentation = 1e-4
+
+# Time limit (in seconds) for each point of the frontier.
+time_limit = 30
+
+
+def plain_data(data):
+    # Copy of data with plain lists and dicts instead of gurobipy tuplelists/tupledicts, which cannot be pickled.
+    return {key: list(value) if isinstance(value, gp.tuplelist) else dict(value) if isinstance(value, gp.tupledict)
+            else value for key, value in data.items()}
+
+
+def add_objectives(m):
+    '''
+    Add the in-vehicle time and fleet size to a model built by build_model(), with their epsilon constraints
+    (unbounded until set_bounds() is called).
+    Sets m._cost (the cost objective), m._in_vehicle_time and m._fleet.
+    '''
+    data = m._data
+    routes, route_edges = data['routes'], data['route_edges']
+    m.update()
+    m._cost = m.getObjective()
+    to_minutes = 1 / time_units[m._time_unit]
+
+    m._in_vehicle_time = m.addVar(vtype=GRB.CONTINUOUS, name="in_vehicle_time")
+    m.addConstr(m._in_vehicle_time == to_minutes * gp.quicksum(
+        data['edge_Npassengers'][route][edge] * (m._arrival_times[route][direction][edge] -
+                                                 m._departure_times[route][direction][edge])
+        for route in routes for edge in route_edges[route] for direction in (0, 1)), "in_vehicle_time")
+    units = m.addVars(routes, vtype=GRB.INTEGER, name="units")
+    m.addConstrs((units[route] >= gp.quicksum(m._num_trains[route].values()) for route in routes), name="units")
+    m._fleet = units.sum()
+
+    m._in_vehicle_bound = m.addConstr(m._in_vehicle_time <= GRB.INFINITY, "epsilon_in_vehicle_time")
+    m._fleet_bound = m.addConstr(m._fleet <= GRB.INFINITY, "epsilon_fleet")
+    m.setObjective(m._cost + augmentation * (m._in_vehicle_time + m._fleet), GRB.MINIMIZE)
+
+
+def set_bounds(m, in_vehicle_time=GRB.INFINITY, fleet=GRB.INFINITY):
+    # Set the epsilon constraints of a model prepared by add_objectives().
+    m._in_vehicle_bound.RHS = in_vehicle_time
+    m._fleet_bound.RHS = fleet
+
+
+def point(m):
+    # Objective values of the solution of a model prepared by add_objectives().
+    return {'cost': m._cost.getValue(), 'in_vehicle_time': m._in_vehicle_time.x, 'fleet': round(m._fleet.getValue())}
+
+
+def extreme_point(m, objective):
+    # Minimize one objective (with the cost as a tie-breaker) and return the point, or None if no solution is found.
+    m.setObjective(objective + augmentation * m._cost, GRB.MINIMIZE)
+    optimize(m)
+    result = point(m) if m.SolCount > 0 else None
+    m.setObjective(m._cost + augmentation * (m._in_vehicle_time + m._fleet), GRB.MINIMIZE)
+    return result
+
+
+def solve_points(args):
+    '''
+    Worker: solve the points of one fleet bound in its own environment and model.
+    args is (data, options, fleet bound, in-vehicle time bounds).  Returns a list of rows.
+    '''
+    data, options, fleet, in_vehicle_times = args
+    rows = []
+    with gp.Env(params={'OutputFlag': 1 if debug else 0}) as env, build_model(data, env=env, **options) as m:
+        add_objectives(m)
+        m.setParam("TimeLimit", time_limit)
+        variables = m.getVars()
+        for in_vehicle_time in sorted(in_vehicle_times):
+            if m.SolCount > 0:
+                # The previous solution meets the looser bound, so it is a feasible start.
+                m.setAttr("Start", variables, m.getAttr("X", variables))
+            set_bounds(m, in_vehicle_time, fleet)
+            optimize(m)
+            row = {'fleet_bound': fleet, 'in_vehicle_bound': in_vehicle_time, 'solve_time': m.Runtime,
+                   'status': m.Status}
+            if m.SolCount > 0:
+                row.update(point(m))
+                row['gap'] = m.MIPGap
+            rows.append(row)
+    return rows
+
+
+def non_dominated(rows):
+    # Keep the rows with a solution that no other row beats on every objective.
+    keys = ('cost', 'in_vehicle_time', 'fleet')
+    solved = [row for row in rows if 'cost' in row]
+    frontier = []
+    for row in solved:
+        dominated = any(all(other[key] <= row[key] + 1e-6 for key in keys) and
+                        any(other[key] < row[key] - 1e-6 for key in keys) for other in solved)
+        duplicate = any(all(abs(other[key] - row[key]) <= 1e-6 for key in keys) for other in frontier)
+        if not dominated and not duplicate:
+            frontier.append(row)
+    return sorted(frontier, key=lambda row: (row['fleet'], row['in_vehicle_time']))
+
+
+def pareto_frontier(data, in_vehicle_steps=5, max_fleet_steps=5, processes=None, **options):
+    '''
+    Compute the Pareto frontier of data.  options are passed to build_model().
+    The in-vehicle time bounds are in_vehicle_steps values between its minimum and its value at the cheapest
+    timetable, and the fleet bounds at most max_fleet_steps values between the minimum fleet and the fleet of the
+    cheapest timetable.  The points of each fleet bound are solved in a separate process (at most processes at
+    once, default the number of CPUs).
+    Returns (frontier rows, every row).
+    '''
+    data = plain_data(data)
+    with gp.Env(params={'OutputFlag': 1 if debug else 0}) as env, build_model(data, env=env, **options) as m:
+        add_objectives(m)
+        m.setParam("TimeLimit", time_limit)
+        cheapest = extreme_point(m, m._cost)
+        fastest = extreme_point(m, m._in_vehicle_time)
+        smallest = extreme_point(m, m._fleet)
+    if cheapest is None or fastest is None or smallest is None:
+        return [], []
+
+    low, high = fastest['in_vehicle_time'], cheapest['in_vehicle_time']
+    in_vehicle_times = [high] if in_vehicle_steps < 2 or high - low < 1e-6 else \
+        [low + (high - low) * i / (in_vehicle_steps - 1) for i in range(in_vehicle_steps)]
+    fleets = list(range(smallest['fleet'], cheapest['fleet'] + 1))
+    if len(fleets) > max_fleet_steps:
+        fleets = sorted({fleets[round(i * (len(fleets) - 1) / (max_fleet_steps - 1))] for i in range(max_fleet_steps)})
+
+    tasks = [(data, options, fleet, in_vehicle_times) for fleet in fleets]
+    # Spawned processes do not inherit the Gurobi environment of this one.
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        rows = [row for rows in pool.map(solve_points, tasks) for row in rows]
+    return non_dominated(rows), rows
+
+
+def print_frontier(frontier):
+    print("\nPareto frontier: - - - -")
+    print("\tfleet\tin-vehicle time (passenger-min)\tcost")
+    for row in frontier:
+        print("\t{}\t{:.0f}\t{:.2f}".format(row['fleet'], row['in_vehicle_time'], row['cost']))
+
+
+if __name__ == "__main__":
+    try:
+
+        from level3_model_toydata import init_toy_data
+
+        # On the shipped data the cheapest timetable is also the fastest and uses the fewest units, so the frontier
+        # is a single point.  The toy data has a cheap slow loco type and an expensive fast one.
+        for name, data in (("Barrie and Lakeshore West", init_data()), ("Toy data", init_toy_data())):
+            start = time.time()
+            frontier, rows = pareto_frontier(data)
+            print("\n########\n{}".format(name))
+            print_frontier(frontier)
+            print("\n{} points solved in {:.2f}s".format(len(rows), time.time() - start))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
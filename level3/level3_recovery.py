@@ -0,0 +1,186 @@
+#!/usr/bin/env python3.7
+
+# Disruption recovery for a solved level 3 timetable:
+# - Takes the solved timetable (see level3_model.solved_timetable()) and a disruption:
+#     delay:        a train departs late from a station.
+#                   e.g. {'type': 'delay', 'route': 'r1', 'edge': ('s3', 's4'), 'direction': 0, 'delay': 10}
+#     blocked_edge: no train can depart onto an edge (both directions) between start and end.
+#                   e.g. {'type': 'blocked_edge', 'route': 'r1', 'edge': ('s3', 's4'), 'start': 20, 'end': 40}
+#     lost_unit:    a route loses one of its units and may run every 2 periods instead.
+#                   e.g. {'type': 'lost_unit', 'route': 'r1'}
+#   Times in disruptions are in minutes from the start of the cycle.
+# - Every event outside a time window starting at the disruption is fixed to its planned time, as are the loco
+#   types and cars.  Only the window is re-solved, with a hard time limit, minimizing the cost plus the deviation
+#   from the plan.  If the window has no feasible timetable it is doubled (up to the end of the cycle).
+
+from math import ceil
+
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import (init_data, build_model, optimize, solved_timetable, to_time_units, record_incumbents,
+                          time_to_first_incumbent, time_units)
+
+debug = False
+# debug = True
+
+# Cost of moving an event one minute away from its planned time.
+deviation_cost = 10.0
+
+
+def window_start(timetable, disruption):
+    # Start (minutes) of the window affected by the disruption.
+    if disruption['type'] == 'delay':
+        value = timetable['departure_times'][disruption['route']][disruption['direction']][disruption['edge']]
+        return value / time_units[timetable['time_unit']]
+    if disruption['type'] == 'blocked_edge':
+        return disruption['start']
+    if disruption['type'] == 'lost_unit':
+        return 0
+    raise ValueError("Unknown disruption type {}".format(disruption['type']))
+
+
+def build_recovery_model(data, timetable, disruption, start, end, **options):
+    '''
+    Build the model re-solving the events planned in [start, end] minutes after the disruption.
+    options are passed to build_model().
+    '''
+    time_unit = timetable['time_unit']
+    to_units = time_units[time_unit]
+    lost_unit = disruption['type'] == 'lost_unit'
+    if lost_unit:
+        # The route losing a unit may run every other period.  The other routes keep their period.
+        # edge_Npassengers is the demand per period, so it doubles with the period.
+        period = data['period']
+        edge_Npassengers = {route: {edge: 2 * passengers for edge, passengers in route_demand.items()}
+                            for route, route_demand in data['edge_Npassengers'].items()}
+        data = dict(data, period=2 * period, period_choices=[period, 2 * period], edge_Npassengers=edge_Npassengers)
+    m = build_model(data, name="level3_recovery", frequency_selection=lost_unit, time_unit=time_unit, **options)
+    m.setParam("OutputFlag", 1 if debug else 0)
+    m.update()
+
+    routes, loco_types = data['routes'], data['loco_types']
+    for route in routes:
+        for loco_type in loco_types:
+            used = 1 if timetable['loco_type'][route] == loco_type else 0
+            m._x_rt[route, loco_type].LB = m._x_rt[route, loco_type].UB = used
+            if not (lost_unit and route == disruption['route']):
+                m._w_rt[route, loco_type].LB = m._w_rt[route, loco_type].UB = used * timetable['cars'][route]
+        if lost_unit:
+            units = ceil(timetable['cycle_time'][route] / to_time_units(timetable['period'][route], time_unit) - 1e-9)
+            if route == disruption['route']:
+                m.addConstr(gp.quicksum(m._num_trains[route].values()) <= units - 1, "lost_unit_{}".format(route))
+            else:
+                m._y_rp[route, timetable['period'][route]].LB = 1
+
+    # Fix the events outside the window and measure the deviation of the others.
+    deviation = 0
+    for key, times in (('arrival_times', m._arrival_times), ('departure_times', m._departure_times)):
+        for route in routes:
+            for direction in (0, 1):
+                for edge, var in times[route][direction].items():
+                    planned = timetable[key][route][direction][edge]
+                    if planned < start * to_units - 1e-6 or planned > end * to_units + 1e-6:
+                        var.LB = var.UB = planned
+                        continue
+                    dev = m.addVar(vtype=GRB.CONTINUOUS, name="dev_{}".format(var.VarName))
+                    m.addConstr(dev >= var - planned)
+                    m.addConstr(dev >= planned - var)
+                    deviation += dev
+
+    # Disruption constraints:
+    route = disruption['route']
+    if disruption['type'] == 'delay':
+        planned = timetable['departure_times'][route][disruption['direction']][disruption['edge']]
+        m.addConstr(m._departure_times[route][disruption['direction']][disruption['edge']]
+                    >= planned + to_time_units(disruption['delay'], time_unit), "delay")
+    elif disruption['type'] == 'blocked_edge':
+        for direction in (0, 1):
+            planned = timetable['departure_times'][route][direction][disruption['edge']]
+            if disruption['start'] * to_units <= planned < disruption['end'] * to_units:
+                m.addConstr(m._departure_times[route][direction][disruption['edge']]
+                            >= to_time_units(disruption['end'], time_unit), "blocked_{}".format(direction))
+
+    m.update()
+    m.setObjective(m.getObjective() + (deviation_cost / to_units) * deviation, GRB.MINIMIZE)
+    return m
+
+
+def recover(data, timetable, disruption, window=30, time_limit=5, **options):
+    '''
+    Re-solve the timetable after a disruption.
+    window is the initial length (minutes) of the window, doubled until a feasible timetable is found.
+    Returns (new timetable or None, stats) where stats has the window used, the solve time, the time to the
+    first feasible timetable and the objective.
+    '''
+    start = window_start(timetable, disruption)
+    cycle_end = max(timetable['cycle_time'].values()) / time_units[timetable['time_unit']]
+    stats = {'solve_time': 0.0, 'time_to_first': None, 'objective': None}
+    while True:
+        end = start + window
+        m = build_recovery_model(data, timetable, disruption, start, end, **options)
+        m.setParam("TimeLimit", max(time_limit - stats['solve_time'], 0.01))
+        record_incumbents(m)
+        optimize(m)
+        stats['window'] = window
+        if m.SolCount > 0:
+            stats['time_to_first'] = stats['solve_time'] + time_to_first_incumbent(m)
+        stats['solve_time'] += m.Runtime
+        if m.SolCount > 0:
+            stats['objective'] = m.objVal
+            new_timetable = solved_timetable(m)
+            m.dispose()
+            return new_timetable, stats
+        status = m.Status
+        m.dispose()
+        if status == GRB.TIME_LIMIT or stats['solve_time'] >= time_limit or end >= cycle_end:
+            return None, stats
+        window *= 2
+
+
+def print_changes(timetable, new_timetable):
+    # Print the events whose time changed.
+    to_minutes = 1 / time_units[timetable['time_unit']]
+    print("\nChanged events (planned -> recovered, minutes): - - - -")
+    for key in ('departure_times', 'arrival_times'):
+        for route, route_times in timetable[key].items():
+            for direction, times in route_times.items():
+                for edge, planned in times.items():
+                    new = new_timetable[key][route][direction][edge]
+                    if abs(new - planned) > 1e-6:
+                        station = edge[0] if (key == 'departure_times') == (direction == 0) else edge[1]
+                        print("\t{}_{}_{}_{} {:.1f} -> {:.1f}".format(key[0], route, station, direction,
+                                                                   planned * to_minutes, new * to_minutes))
+    for route in timetable['period']:
+        if timetable['period'][route] != new_timetable['period'][route] or timetable['cars'][route] != new_timetable['cars'][route]:
+            print("\tRoute {}: period {}m -> {}m, cars {} -> {}".format(route, timetable['period'][route],
+                                                                      new_timetable['period'][route],
+                                                                      timetable['cars'][route],
+                                                                      new_timetable['cars'][route]))
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        with gp.Env() as env:
+            with build_model(data, env=env) as m:
+                m.setParam("OutputFlag", 0)
+                optimize(m)
+                timetable = solved_timetable(m)
+
+            for disruption in ({'type': 'delay', 'route': 'r1', 'edge': ('s3', 's4'), 'direction': 0, 'delay': 10},
+                               {'type': 'blocked_edge', 'route': 'r2', 'edge': ('s5', 's6'), 'start': 20, 'end': 40},
+                               {'type': 'lost_unit', 'route': 'r1'}):
+                print("\n########\nDisruption: {}".format(disruption))
+                new_timetable, stats = recover(data, timetable, disruption, env=env)
+                print("Window {}m, first feasible after {}s, solve time {:.3f}s".format(
+                    stats['window'], "-" if stats['time_to_first'] is None else "{:.3f}".format(stats['time_to_first']),
+                    stats['solve_time']))
+                if new_timetable is None:
+                    print("No feasible timetable found")
+                else:
+                    print_changes(timetable, new_timetable)
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3.7
+
+# Robust level 3 timetables under running-time uncertainty:
+# - The running time of a train on an edge is its running time at max speed plus a random extra time.  By default
+#   the extra time is exponential with a mean of extra_running_time times the running time.
+#   data['extra_running_time'][route][edge] (mean, minutes) overrides it per edge.
+# - sample_extra_times() samples the extra times of many scenarios at once.  propagate() pushes the delays along
+#   each route for all the scenarios with one NumPy operation per leg: a train departs at the later of its planned
+#   departure and its arrival plus the minimum wait, and arrives after the sampled running time.
+# - light_robustness() re-solves the timetable so the running time supplement of each leg (the scheduled running
+#   time minus the running time at max speed) covers the protection quantile of its sampled extra time.  The total
+#   shortfall is minimized, with the cost at most (1 + max_cost_increase) times the nominal cost (light
+#   robustness).
+#
+# The delays are only propagated along one cycle of each route, without the transfers between routes (see
+# level3_simulator.py for both).
+
+import time
+
+import numpy as np
+import gurobipy as gp
+from gurobipy import GRB
+
+from level3_model import (init_data, build_model, optimize, solved_timetable, running_times, to_time_units,
+                          time_units, wait_time_at_station)
+from level3_evaluator import prepare_network, evaluate
+
+debug = False
+# debug = True
+
+# Mean extra running time, as a share of the running time at max speed.
+extra_running_time = 0.05
+
+# Share of the sampled extra running times each leg is protected against.
+protection = 0.9
+
+# An arrival is punctual if it is less than this many minutes late.
+punctuality_threshold = 3
+
+
+def route_legs(data, timetable):
+    '''
+    The legs of each route of a timetable: its edges in direction 0, then in direction 1.
+    Returns {route: (legs, departures, arrivals, running times)} with the (direction, edge) of each leg and the
+    planned departures, arrivals and running times at max speed as arrays, in minutes.
+    '''
+    to_minutes = 1 / time_units[timetable['time_unit']]
+    running_time = running_times(data, 'h')
+    result = {}
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        legs = [(0, edge) for edge in edges] + [(1, edge) for edge in reversed(edges)]
+        loco_type = timetable['loco_type'][route]
+        departures = np.array([timetable['departure_times'][route][direction][edge] for direction, edge in legs])
+        arrivals = np.array([timetable['arrival_times'][route][direction][edge] for direction, edge in legs])
+        running = np.array([running_time[route][edge][loco_type] * 60 for _, edge in legs])
+        result[route] = (legs, departures * to_minutes, arrivals * to_minutes, running)
+    return result
+
+
+def mean_extra_times(data, route, legs, running):
+    # Mean extra running time (minutes) of each leg of a route.
+    override = data.get('extra_running_time', {}).get(route, {})
+    return np.array([override.get(edge, extra_running_time * run) for (_, edge), run in zip(legs, running)])
+
+
+def sample_extra_times(data, legs, n_samples, rng):
+    '''
+    Sample n_samples scenarios of extra running times.
+    legs is the result of route_legs().  Returns {route: array (n_samples, number of legs)} in minutes.
+    '''
+    samples = {}
+    for route, (route_leg_list, _, _, running) in legs.items():
+        mean = mean_extra_times(data, route, route_leg_list, running)
+        samples[route] = rng.exponential(1.0, size=(n_samples, len(mean))) * mean
+    return samples
+
+
+def propagate(legs, samples):
+    '''
+    Propagate the sampled extra running times along each route.
+    Returns {route: array (n_samples, number of legs)} of the arrival delays (minutes) of each leg.
+    '''
+    delays = {}
+    for route, (_, departures, arrivals, running) in legs.items():
+        extra = samples[route]
+        actual = np.empty_like(extra)
+        previous = np.zeros(extra.shape[0])
+        for k in range(extra.shape[1]):
+            # The first departure is the start of the cycle, so it has no wait.
+            departure = np.maximum(departures[k], previous + (wait_time_at_station if k > 0 else 0))
+            previous = actual[:, k] = departure + running[k] + extra[:, k]
+        delays[route] = np.maximum(actual - arrivals, 0)
+    return delays
+
+
+def punctuality(delays):
+    # Share of punctual arrivals, mean arrival delay and mean delay at the end of the cycle, over every route.
+    all_delays = np.concatenate([route_delays.ravel() for route_delays in delays.values()])
+    end_delays = np.concatenate([route_delays[:, -1] for route_delays in delays.values()])
+    return {'punctual': float(np.mean(all_delays < punctuality_threshold)), 'mean_delay': float(all_delays.mean()),
+            'mean_end_delay': float(end_delays.mean())}
+
+
+def evaluate_timetable(data, timetable, n_samples=10000, seed=0):
+    # Punctuality of a timetable over n_samples sampled scenarios.
+    legs = route_legs(data, timetable)
+    samples = sample_extra_times(data, legs, n_samples, np.random.default_rng(seed))
+    return punctuality(propagate(legs, samples))
+
+
+def protection_levels(data, n_samples, rng):
+    '''
+    Running time supplement (minutes) needed on each leg for each loco type: the protection quantile of the
+    sampled extra running time.
+    Returns protection_level[route][direction, edge][loco_type].
+    '''
+    running_time = running_times(data, 'h')
+    levels = {}
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        legs = [(0, edge) for edge in edges] + [(1, edge) for edge in edges]
+        levels[route] = {leg: {} for leg in legs}
+        for loco_type in data['loco_types']:
+            running = np.array([running_time[route][edge][loco_type] * 60 for _, edge in legs])
+            mean = mean_extra_times(data, route, legs, running)
+            quantiles = np.quantile(rng.exponential(1.0, size=(n_samples, len(legs))) * mean, protection, axis=0)
+            for leg, level in zip(legs, quantiles):
+                levels[route][leg][loco_type] = level
+    return levels
+
+
+def light_robustness(data, max_cost_increase=0.1, n_samples=10000, seed=0, env=None, **options):
+    '''
+    Solve the nominal model, then re-solve it maximizing the protection of the legs with the cost at most
+    (1 + max_cost_increase) times the nominal cost.  options are passed to build_model().
+    Returns (nominal timetable, robust timetable, total shortfall (minutes)); the robust timetable is None if no
+    solution was found.
+    '''
+    m = build_model(data, env=env, **options)
+    m.setParam("OutputFlag", 1 if debug else 0)
+    optimize(m)
+    if m.SolCount == 0:
+        m.dispose()
+        return None, None, None
+    nominal = solved_timetable(m)
+    nominal_cost = m.objVal
+
+    time_unit = m._time_unit
+    running_time = running_times(data, time_unit)
+    levels = protection_levels(data, n_samples, np.random.default_rng(seed))
+    shortfall = {}
+    for route in data['routes']:
+        for direction, edge in levels[route]:
+            s = m.addVar(vtype=GRB.CONTINUOUS, name="shortfall_{}_{}_{}_{}".format(route, edge[0], edge[1], direction))
+            shortfall[route, direction, edge] = s
+            needed = gp.quicksum((running_time[route][edge][loco_type] +
+                                  to_time_units(levels[route][direction, edge][loco_type], time_unit))
+                                 * m._x_rt[route, loco_type] for loco_type in data['loco_types'])
+            m.addConstr(m._arrival_times[route][direction][edge] - m._departure_times[route][direction][edge] + s
+                        >= needed, "protection_{}_{}_{}_{}".format(route, edge[0], edge[1], direction))
+    m.update()
+    cost = m.getObjective()
+    m.addQConstr(cost <= (1 + max_cost_increase) * nominal_cost, "max_cost")
+    # The cost breaks the ties between timetables with the same shortfall.
+    total_shortfall = gp.quicksum(shortfall.values())
+    m.setObjective(total_shortfall + cost / nominal_cost * 1e-3, GRB.MINIMIZE)
+    optimize(m)
+    robust = solved_timetable(m) if m.SolCount > 0 else None
+    result = total_shortfall.getValue() / time_units[time_unit] if m.SolCount > 0 else None
+    m.dispose()
+    return nominal, robust, result
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        network = prepare_network(data)
+        n_samples = 10000
+        with gp.Env() as env:
+            print("\n\tmax cost increase\tcost\tshortfall (min)\tpunctual\tmean delay\tmean end delay\tevaluation (s)")
+            for max_cost_increase in (0.05, 0.1, 0.2):
+                nominal, robust, shortfall = light_robustness(data, max_cost_increase, n_samples, env=env)
+                rows = [('nominal', nominal, None)] if max_cost_increase == 0.05 else []
+                rows.append(("{:.0%}".format(max_cost_increase), robust, shortfall))
+                for name, timetable, total in rows:
+                    if timetable is None:
+                        print("\t{}\tno solution".format(name))
+                        continue
+                    start = time.time()
+                    stats = evaluate_timetable(data, timetable, n_samples)
+                    print("\t{}\t{:.2f}\t{}\t{:.1%}\t{:.2f}\t{:.2f}\t{:.3f}".format(
+                        name, evaluate(network, timetable)[0], "-" if total is None else "{:.1f}".format(total),
+                        stats['punctual'], stats['mean_delay'], stats['mean_end_delay'], time.time() - start))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
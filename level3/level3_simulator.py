@@ -0,0 +1,238 @@
+#!/usr/bin/env python3.7
+
+# Delay propagation simulator for solved level 3 timetables:
+# - event_graph() rolls the periodic timetable out over n_periods periods into an event-activity graph.  The
+#   events are the departures and arrivals of every trip (one trip per route and period).  The activities are:
+#     run:         departure -> arrival on an edge, at least the running time at max speed.
+#     dwell:       arrival -> next departure of the trip, at least wait_time_at_station.
+#     circulation: last arrival of a trip -> first departure of the trip the same unit runs next.  A route with
+#                  cycle time c and period p needs ceil(c / p) units, so trip k is run by the unit of trip
+#                  k - ceil(c / p).
+#     transfer:    arrival of a train at a transfer station -> departure of every other train of the transfer
+#                  that it meets in the timetable, so the connection is kept.
+# - simulate() computes the actual event times of many Monte Carlo samples at once, in max-plus form: an event
+#   happens at the later of its planned time and the end of its incoming activities.  The events are processed
+#   by level of the graph (the longest chain of activities before them), with a few NumPy operations per level
+#   for all the samples.
+# - The samples draw extra running times as in level3_robust.py, and a delay of the first departure of some trips.
+#
+# Headways between routes are not modelled: a late train does not delay the trains behind it on a shared edge.
+
+import time
+from math import ceil
+
+import numpy as np
+import gurobipy as gp
+
+from level3_model import (init_data, build_model, optimize, solved_timetable, running_times, compile_transfers,
+                          time_units, wait_time_at_station)
+from level3_robust import mean_extra_times, punctuality_threshold
+
+debug = False
+# debug = True
+
+# Probability that a trip starts late, and the mean of its initial delay (minutes, exponential).
+initial_delay_probability = 0.1
+initial_delay_mean = 5.0
+
+# Number of samples simulated at once, to bound memory.
+batch_size = 2000
+
+
+def event_graph(data, timetable, n_periods=4):
+    '''
+    Build the event-activity graph of a timetable (see solved_timetable()) over n_periods periods of data.
+    Times are in minutes.  Returns a dict with:
+      planned: planned time of each event.  events: (route, trip, direction, edge, 'd' or 'a') of each event.
+      src, dst, duration, kind: the activities.  run_mean: mean extra running time of each activity (0 if not a
+      run).  trip_start: the first departure event of each trip.  levels: for each level of the graph, the
+      activities ending in it sorted by their event, the events and the start of each event's activities.
+    '''
+    to_minutes = 1 / time_units[timetable['time_unit']]
+    running_time = running_times(data, 'h')
+    horizon = n_periods * data['period']
+    events, planned, index = [], [], {}
+    src, dst, duration, kind, run_mean = [], [], [], [], []
+    trip_start = []
+
+    def add_activity(source, target, minimum, activity_kind, mean=0.0):
+        src.append(source)
+        dst.append(target)
+        duration.append(minimum)
+        kind.append(activity_kind)
+        run_mean.append(mean)
+
+    legs, units = {}, {}
+    n_trips = {route: int(ceil(horizon / timetable['period'][route])) for route in data['routes']}
+    for route in data['routes']:
+        edges = data['route_edges'][route]
+        legs[route] = [(0, edge) for edge in edges] + [(1, edge) for edge in reversed(edges)]
+        period = timetable['period'][route]
+        loco_type = timetable['loco_type'][route]
+        running = np.array([running_time[route][edge][loco_type] * 60 for _, edge in legs[route]])
+        means = mean_extra_times(data, route, legs[route], running)
+        units[route] = max(1, ceil(timetable['cycle_time'][route] * to_minutes / period - 1e-9))
+        for trip in range(n_trips[route]):
+            for k, (direction, edge) in enumerate(legs[route]):
+                for event_kind, times in (('d', timetable['departure_times']), ('a', timetable['arrival_times'])):
+                    index[route, trip, k, event_kind] = len(events)
+                    events.append((route, trip, direction, edge, event_kind))
+                    planned.append(times[route][direction][edge] * to_minutes + trip * period)
+                add_activity(index[route, trip, k, 'd'], index[route, trip, k, 'a'], running[k], 'run', means[k])
+                if k > 0:
+                    add_activity(index[route, trip, k - 1, 'a'], index[route, trip, k, 'd'], wait_time_at_station,
+                                 'dwell')
+            trip_start.append(index[route, trip, 0, 'd'])
+            if trip >= units[route]:
+                add_activity(index[route, trip - units[route], len(legs[route]) - 1, 'a'], index[route, trip, 0, 'd'],
+                             0, 'circulation')
+
+    # Transfers: the dwell of a train is between the arrival of the leg before k and the departure of leg k.  At the
+    # first station (k = 0) the dwell starts with the trip, and the train that brings passengers is the unit
+    # arriving from its previous trip.
+    def dwell(route, trip, k):
+        # (arrival event or None, planned start of the dwell, departure event)
+        departure = index[route, trip, k, 'd']
+        if k > 0:
+            arrival = index[route, trip, k - 1, 'a']
+            return arrival, planned[arrival], departure
+        previous = trip - units[route]
+        arrival = index[route, previous, len(legs[route]) - 1, 'a'] if previous >= 0 else None
+        return arrival, trip * timetable['period'][route], departure
+
+    dwells = {}
+    for t, route, position, direction, _, _ in compile_transfers(data):
+        n = len(data['route_edges'][route])
+        k = n if position == n else position if direction == 0 else 2 * n - position
+        dwells.setdefault(t, []).append((route, k))
+    for members in dwells.values():
+        for route1, k1 in members:
+            for route2, k2 in members:
+                if route2 == route1:
+                    continue
+                for trip1 in range(n_trips[route1]):
+                    arrival1, start1, departure1 = dwell(route1, trip1, k1)
+                    if arrival1 is None:
+                        continue
+                    for trip2 in range(n_trips[route2]):
+                        _, start2, departure2 = dwell(route2, trip2, k2)
+                        if start1 <= planned[departure2] and start2 <= planned[departure1]:
+                            add_activity(arrival1, departure2, 0, 'transfer')
+
+    graph = {'planned': np.array(planned), 'events': events, 'src': np.array(src), 'dst': np.array(dst),
+             'duration': np.array(duration, dtype=float), 'kind': np.array(kind), 'run_mean': np.array(run_mean),
+             'trip_start': np.array(trip_start)}
+    graph['levels'] = graph_levels(len(events), graph['src'], graph['dst'])
+    return graph
+
+
+def graph_levels(n_events, src, dst):
+    '''
+    Group the activities by the level of the event they end in: an event is one level after the latest of its
+    predecessors (Kahn's algorithm).  Returns a list of (activities, events, starts) for the levels after the first,
+    with the activities sorted by event and starts the position of the first activity of each event.
+    '''
+    incoming = [[] for _ in range(n_events)]
+    outgoing = [[] for _ in range(n_events)]
+    for a, (source, target) in enumerate(zip(src, dst)):
+        incoming[target].append(a)
+        outgoing[source].append(target)
+    remaining = np.array([len(activities) for activities in incoming])
+    level = np.zeros(n_events, dtype=int)
+    ready = [e for e in range(n_events) if remaining[e] == 0]
+    while ready:
+        following = []
+        for e in ready:
+            for target in outgoing[e]:
+                level[target] = max(level[target], level[e] + 1)
+                remaining[target] -= 1
+                if remaining[target] == 0:
+                    following.append(target)
+        ready = following
+    if remaining.any():
+        raise ValueError("The event-activity graph has a cycle")
+    levels = []
+    for value in range(1, level.max() + 1 if n_events else 1):
+        level_events = np.flatnonzero(level == value)
+        activities = [a for e in level_events for a in incoming[e]]
+        starts = np.cumsum([0] + [len(incoming[e]) for e in level_events[:-1]])
+        levels.append((np.array(activities), level_events, starts))
+    return levels
+
+
+def sample_batch(graph, n_samples, rng):
+    # Extra running time of every activity and initial delay of every event, for n_samples samples.
+    extra = rng.exponential(1.0, size=(n_samples, len(graph['src']))) * graph['run_mean']
+    initial = np.zeros((n_samples, len(graph['planned'])))
+    starts = graph['trip_start']
+    late = rng.random((n_samples, len(starts))) < initial_delay_probability
+    initial[:, starts] = late * rng.exponential(initial_delay_mean, size=(n_samples, len(starts)))
+    return extra, initial
+
+
+def simulate_batch(graph, extra, initial):
+    '''
+    Actual time of every event of every sample, given the extra duration of every activity and the initial delay
+    of every event (arrays of shape (samples, activities) and (samples, events)).
+    '''
+    actual = graph['planned'] + initial
+    src, duration = graph['src'], graph['duration']
+    for activities, events, starts in graph['levels']:
+        ends = actual[:, src[activities]] + duration[activities] + extra[:, activities]
+        actual[:, events] = np.maximum(actual[:, events], np.maximum.reduceat(ends, starts, axis=1))
+    return actual
+
+
+def simulate(graph, n_samples=10000, seed=0):
+    # Delay (minutes) of every event of n_samples Monte Carlo samples, as an array (samples, events).
+    rng = np.random.default_rng(seed)
+    delays = []
+    for start in range(0, n_samples, batch_size):
+        extra, initial = sample_batch(graph, min(batch_size, n_samples - start), rng)
+        delays.append(simulate_batch(graph, extra, initial) - graph['planned'])
+    return np.concatenate(delays)
+
+
+def route_punctuality(graph, delays, data):
+    '''
+    Punctuality of the arrivals of each route: share of punctual arrivals, mean delay, and mean delay of the
+    arrivals of the last trip (to see if the delays build up over the periods).
+    '''
+    rows = []
+    for route in data['routes']:
+        arrivals = np.array([e for e, event in enumerate(graph['events']) if event[0] == route and event[4] == 'a'])
+        last_trip = max(graph['events'][e][1] for e in arrivals)
+        last = np.array([e for e in arrivals if graph['events'][e][1] == last_trip])
+        route_delays = delays[:, arrivals]
+        rows.append({'route': route, 'arrivals': len(arrivals), 'punctual': float(np.mean(route_delays < punctuality_threshold)),
+                     'mean_delay': float(route_delays.mean()), 'last_trip_delay': float(delays[:, last].mean())})
+    return rows
+
+
+if __name__ == "__main__":
+    try:
+
+        data = init_data()
+        with gp.Env() as env, build_model(data, env=env) as m:
+            m.setParam("OutputFlag", 0)
+            optimize(m)
+            timetable = solved_timetable(m)
+
+        for n_periods in (1, 4, 12):
+            start = time.time()
+            graph = event_graph(data, timetable, n_periods)
+            build_time = time.time() - start
+            start = time.time()
+            delays = simulate(graph)
+            simulate_time = time.time() - start
+            print("\n{} periods: {} events, {} activities ({} transfers), {} levels; built in {:.3f}s, "
+                  "10000 samples simulated in {:.3f}s".format(n_periods, len(graph['planned']), len(graph['src']),
+                                                              int(np.sum(graph['kind'] == 'transfer')),
+                                                              len(graph['levels']), build_time, simulate_time))
+            print("\troute\tarrivals\tpunctual\tmean delay\tlast trip delay")
+            for row in route_punctuality(graph, delays, data):
+                print("\t{}\t{}\t{:.1%}\t{:.2f}\t{:.2f}".format(row['route'], row['arrivals'], row['punctual'],
+                                                                row['mean_delay'], row['last_trip_delay']))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3.7
+
+# Stress test of the level 3 formulations on large synthetic networks:
+# - grow_network() grows the shipped Barrie and Lakeshore West data into n_routes routes.  Each new route is built
+#   from one of the shipped routes, and is one of:
+#     trunk:    a copy serving the same stations, so it shares every edge with its line (headways on all of them).
+#     branch:   shares the line from Union up to a random branch point, then runs to new stations, with edge lengths
+#               drawn from the line.
+#     separate: a copy with new station names (except Union), sharing no track.
+#   The demand of every edge is scaled by demand_scale.  The transfer at Union and the OD demand stay on the shipped
+#   routes and stations.
+# - stress_report() builds and solves every formulation on networks of increasing size, with a time limit, and
+#   records the build time, model size, solve time, gap and memory: the resident memory of the process after the
+#   build (Python and Gurobi, from /proc on Linux) and the peak memory Gurobi reports for the solve.  The rows are
+#   written to a CSV file, and printed as a table and as a text plot of solve time against the number of routes.
+#
+# A formulation breaks at a size when it errors (e.g. out of memory or too large for the license), or when it finds
+# no solution within the time limit.  Once a formulation has broken, it is still built on the larger networks (for
+# the build time, size and memory) but not solved.
+
+import csv
+import os
+import random
+import sys
+import time
+from math import ceil, log10
+
+import gurobipy as gp
+
+from level3_model import init_data, build_model, optimize
+from level3_diagnostics import model_statistics, status_names
+from level3_tuning import formulations
+
+debug = False
+# debug = True
+
+# Share of the new routes that are trunk copies and branches (the rest are separate lines).
+trunk_share = 0.4
+branch_share = 0.4
+
+# Number of routes of the networks of the report, and the time limit (seconds) of each solve.
+default_sizes = (2, 5, 10, 20, 50, 100, 200)
+time_limit = 60
+
+# Columns of the report.
+report_columns = ['routes', 'formulation', 'build_time', 'vars', 'binary', 'integer', 'constrs', 'qconstrs',
+                  'genconstrs', 'nonzeros', 'build_mem_mb', 'solve_time', 'status', 'objective', 'gap',
+                  'solve_mem_mb', 'error']
+
+
+def grow_network(data, n_routes, demand_scale=1.0, seed=0):
+    '''
+    Return a copy of data with n_routes routes (see the top of the file).  The first routes are the shipped ones.
+    The kind of each new route is random (seeded), with trunk_share trunks and branch_share branches.
+    '''
+    rng = random.Random(seed)
+    base_routes = list(data['routes'])
+    routes = []
+    route_edges, route_dist, stations, station_to_name, route_to_name = {}, {}, {}, {}, {}
+    edges, edge_len, edge_Npassengers = {}, {}, {}
+    for i in range(n_routes):
+        route = "r{}".format(i + 1)
+        base = base_routes[i % len(base_routes)]
+        base_edges = list(data['route_edges'][base])
+        names = dict(data['station_to_name'][base])
+        lengths = [data['edge_len'][base][edge] for edge in base_edges]
+        demand = [data['edge_Npassengers'][base][edge] for edge in base_edges]
+        kind = 'trunk'
+        if i >= len(base_routes):
+            draw = rng.random()
+            kind = 'trunk' if draw < trunk_share else 'branch' if draw < trunk_share + branch_share else 'separate'
+        if kind == 'branch':
+            # The stations after the branch point are new, with edge lengths drawn from the line.
+            branch_point = rng.randint(1, len(base_edges) - 1)
+            for k in range(branch_point, len(base_edges)):
+                names['s{}'.format(k + 2)] = "Branch {} station {}".format(i + 1, k + 2 - branch_point)
+                lengths[k] = rng.choice(lengths)
+        elif kind == 'separate':
+            names = {station: name if name == "Union" else "{} ({})".format(name, i + 1)
+                     for station, name in names.items()}
+
+        routes.append(route)
+        route_edges[route] = base_edges
+        stations[route] = list(data['stations'][base])
+        station_to_name[route] = names
+        route_to_name[route] = "{} {} {}".format(data['route_to_name'][base], kind, i + 1)
+        edges[route] = list(base_edges)
+        edge_len[route] = dict(zip(base_edges, lengths))
+        route_dist[route] = sum(lengths)
+        edge_Npassengers[route] = {edge: ceil(passengers * demand_scale)
+                                   for edge, passengers in zip(base_edges, demand)}
+
+    grown = dict(data)
+    grown.update({'routes': routes, 'route_edges': route_edges, 'route_dist': route_dist, 'stations': stations,
+                  'station_to_name': station_to_name, 'route_to_name': route_to_name, 'edges': edges,
+                  'edge_len': edge_len, 'edge_Npassengers': edge_Npassengers})
+    return grown
+
+
+def resident_memory_mb():
+    # Resident memory of this process (MB), or None if /proc is not available (e.g. not on Linux).
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def stress_run(data, options, solve=True, env=None):
+    # Build one formulation on one network, and solve it if solve is True.  Returns a row of the report.
+    row = {}
+    start = time.time()
+    try:
+        m = build_model(data, env=env, **options)
+    except MemoryError:
+        row.update({'build_time': time.time() - start, 'error': 'out of memory'})
+        return row
+    with m:
+        statistics = model_statistics(m)
+        row['build_time'] = time.time() - start
+        row['build_mem_mb'] = resident_memory_mb()
+        row.update({key: statistics[key] for key in report_columns if key in statistics})
+        if not solve:
+            row['status'] = 'not solved'
+            return row
+        m.setParam("OutputFlag", 1 if debug else 0)
+        m.setParam("TimeLimit", time_limit)
+        try:
+            optimize(m)
+        except gp.GurobiError as e:
+            row['error'] = e.errno
+            return row
+        row.update({'solve_time': m.Runtime, 'status': status_names.get(m.Status, m.Status),
+                    'solve_mem_mb': m.MaxMemUsed * 1024})
+        if m.SolCount > 0:
+            row.update({'objective': m.ObjVal, 'gap': m.MIPGap})
+    return row
+
+
+def broken(row):
+    # The formulation broke on this network: it failed or found no solution (or was not solved).
+    return 'error' in row or row.get('objective') is None
+
+
+def failure(row):
+    # Why a solve broke (the error or the status), or None if it did not break or was not solved.
+    if row.get('status') == 'not solved' or not broken(row):
+        return None
+    return row.get('error', row.get('status'))
+
+
+def stress_report(sizes=default_sizes, names=('base', 'lazy', 'frequency_selection'), demand_scale=1.0, seed=0,
+                  path=None, env=None):
+    '''
+    Build and solve the formulations (names in level3_tuning.formulations) on grown networks of each size.
+    Returns the rows of the report, and writes them to path as CSV if it is given.
+    '''
+    data = init_data()
+    rows = []
+    solving = set(names)
+    for n_routes in sizes:
+        grown = grow_network(data, n_routes, demand_scale, seed)
+        for name in names:
+            row = {'routes': n_routes, 'formulation': name}
+            row.update(stress_run(grown, formulations[name], name in solving, env))
+            rows.append(row)
+            if debug:
+                print(row)
+            if name in solving and broken(row):
+                solving.remove(name)
+        if path is not None:
+            # Rewritten after every size, so the report is kept if a larger network runs out of memory.
+            write_csv(path, rows)
+    return rows
+
+
+def write_csv(path, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=report_columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def print_report(rows):
+    print("\t".join(report_columns))
+    for row in rows:
+        print("\t".join("-" if row.get(column) is None else
+                        "{:.4g}".format(row[column]) if isinstance(row[column], float) else str(row[column])
+                        for column in report_columns))
+
+
+def plot_report(rows, key='solve_time', width=50):
+    '''
+    Text plot of a column of the report against the number of routes, one bar per row on a log scale, with an x
+    where the solve broke.
+    '''
+    values = [row[key] for row in rows if row.get(key)]
+    if not values:
+        return
+    low, high = log10(min(values)), log10(max(values))
+    print("\n{} (log scale, {:.3g} to {:.3g}):".format(key, min(values), max(values)))
+    for name in dict.fromkeys(row['formulation'] for row in rows):
+        print("  {}".format(name))
+        for row in rows:
+            if row['formulation'] != name:
+                continue
+            if not row.get(key):
+                bar = "x {}".format(failure(row)) if failure(row) is not None else "-"
+            else:
+                size = 1 + round((width - 1) * (log10(row[key]) - low) / (high - low)) if high > low else width
+                bar = "#" * size + " {:.3g}".format(row[key]) + (
+                    " x {}".format(failure(row)) if failure(row) is not None else "")
+            print("  {:>5} | {}".format(row['routes'], bar))
+
+
+if __name__ == "__main__":
+    # Usage: python level3/level3_stress.py [--demand-scale x] [--csv path] [max_routes] [formulation ...]
+    args = sys.argv[1:]
+    demand_scale = 1.0
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "level3_stress.csv")
+    while args and args[0] in ('--demand-scale', '--csv') and len(args) > 1:
+        if args[0] == '--demand-scale':
+            demand_scale = float(args[1])
+        else:
+            path = args[1]
+        args = args[2:]
+    max_routes = int(args[0]) if args and args[0].isdigit() else max(default_sizes)
+    names = [name for name in args if name in formulations] or ['base', 'lazy', 'frequency_selection']
+    try:
+
+        with gp.Env(params={'OutputFlag': 0}) as env:
+            rows = stress_report([n for n in default_sizes if n <= max_routes], names, demand_scale, path=path,
+                                 env=env)
+        print_report(rows)
+        plot_report(rows, 'build_time')
+        plot_report(rows, 'solve_time')
+        print("\nReport written to {}".format(path))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))
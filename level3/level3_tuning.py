@@ -0,0 +1,248 @@
+#!/usr/bin/env python3.7
+
+# Solver parameter tuning for the level 3 formulations:
+# - A formulation is a set of build_model() options (see level3_model.formulation_name()).  It is tuned over a set
+#   of representative instances: the shipped data, the toy data and synthetic networks from replicate_routes().
+#   Instances that the formulation cannot be built for (e.g. the toy data has no period choices), or that the
+#   default parameters cannot solve (e.g. too large for the license), are left out.
+# - Phase 1: random search over parameter_space.  Each trial solves every instance with one parameter setting, with
+#   one thread and a fixed seed, and the trials run in parallel processes.  Since the trials share the processors,
+#   they are compared by work (Gurobi's deterministic measure of effort) rather than by wall-clock time.  An
+#   instance not solved to optimality counts twice its work.  The score of a trial is the geometric mean over the
+#   instances of its work divided by the work of the default parameters, so 1 is the default.
+# - Phase 2: the best setting is solved again with each thread count in thread_counts, one trial at a time, and
+#   the fastest wall-clock time wins.
+# - The best setting is saved as the profile of the formulation (profiles/<formulation>.json), which build_model()
+#   loads automatically.  If no setting scores below min_improvement, the profile is saved with no parameters: a
+#   small gain on a few instances is not worth moving away from the defaults.
+
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from math import exp, log
+
+import gurobipy as gp
+from gurobipy import GRB
+
+import level3_model
+from level3_model import init_data, build_model, optimize, formulation_name, profiles_dir
+from level3_model_toydata import init_toy_data
+from level3_benchmark import replicate_routes
+from level3_manifest import software_versions
+from level3_pareto import plain_data
+
+debug = False
+# debug = True
+
+# Values tried for each parameter.  The first value is the one build_model() uses (Gurobi's default, except for
+# NonConvex which build_model() sets to 2).
+parameter_space = {
+    'MIPFocus': [0, 1, 2, 3],
+    'Cuts': [-1, 0, 1, 2],
+    'Presolve': [-1, 0, 1, 2],
+    'Heuristics': [0.05, 0.0, 0.2, 0.5],
+    'NonConvex': [2, -1],
+}
+
+# Thread counts tried for the best setting (counts above the number of processors are skipped).
+thread_counts = (1, 2, 4, 8)
+
+# Formulations that can be tuned from the command line, by name.
+formulations = {
+    'base': {},
+    'lazy': {'lazy_constraints': True},
+    'frequency_selection': {'frequency_selection': True},
+    'passenger_routing': {'passenger_routing': True},
+    'symmetry_breaking': {'symmetry_breaking': True},
+    'consists': {'consists': True},
+    'speed_profiles': {'speed_profiles': True},
+}
+
+# Time limit (seconds) of each solve, and the factor on the work of an instance that is not solved to optimality.
+time_limit = 30
+unsolved_penalty = 2
+
+# Added to the work of each instance so that trivial instances do not dominate the geometric mean.
+work_shift = 1e-3
+
+# Score a setting must beat to be saved instead of the defaults.
+min_improvement = 0.9
+
+
+def tuning_instances():
+    # Representative instances, as (name, data): the shipped data, the toy data and synthetic networks.
+    data = init_data()
+    return [('shipped', data), ('toy', init_toy_data()), ('3 routes', replicate_routes(data, 3)),
+            ('4 routes', replicate_routes(data, 4, shared=False))]
+
+
+def applicable_instances(instances, options, env=None):
+    # The instances the formulation can be built for (build_model() raises KeyError if the data lacks an entry).
+    result = []
+    for name, data in instances:
+        try:
+            build_model(data, env=env, **options).dispose()
+        except KeyError:
+            continue
+        result.append((name, data))
+    return result
+
+
+def sample_settings(n_trials, rng):
+    # The default setting ({}), then up to n_trials - 1 distinct random settings of parameter_space.
+    settings, seen = [{}], set()
+    for _ in range(20 * n_trials):
+        if len(settings) >= n_trials:
+            break
+        setting = {name: rng.choice(values) for name, values in parameter_space.items()}
+        setting = {name: value for name, value in setting.items() if value != parameter_space[name][0]}
+        key = tuple(sorted(setting.items()))
+        if setting and key not in seen:
+            seen.add(key)
+            settings.append(setting)
+    return settings
+
+
+def solve_instances(args):
+    '''
+    Worker: solve every instance with one parameter setting in its own environment.
+    args is (setting, instances, options, threads).  Returns {instance name: {'status', 'work', 'runtime', 'gap'}},
+    with 'error' instead if the solve failed.
+    '''
+    setting, instances, options, threads = args
+    # The tuned profiles must not leak into the trials.
+    use_profiles = level3_model.use_profiles
+    level3_model.use_profiles = False
+    results = {}
+    try:
+        with gp.Env(params={'OutputFlag': 1 if debug else 0}) as env:
+            for name, data in instances:
+                with build_model(data, env=env, **options) as m:
+                    m.setParam("TimeLimit", time_limit)
+                    m.setParam("Seed", 0)
+                    m.setParam("Threads", threads)
+                    for parameter, value in setting.items():
+                        m.setParam(parameter, value)
+                    try:
+                        optimize(m)
+                    except gp.GurobiError as e:
+                        results[name] = {'error': e.errno}
+                        continue
+                    results[name] = {'status': m.Status, 'work': m.Work, 'runtime': m.Runtime,
+                                     'gap': m.MIPGap if m.SolCount > 0 else None}
+    finally:
+        level3_model.use_profiles = use_profiles
+    return results
+
+
+def penalized_work(result):
+    return result['work'] * (1 if result['status'] == GRB.OPTIMAL else unsolved_penalty)
+
+
+def score(results, baseline):
+    # Geometric mean over the instances of the penalized work relative to the default setting (None if an instance
+    # failed).
+    if any('error' in result for result in results.values()):
+        return None
+    ratios = [(penalized_work(results[name]) + work_shift) / (penalized_work(baseline[name]) + work_shift)
+              for name in baseline]
+    return exp(sum(log(ratio) for ratio in ratios) / len(ratios))
+
+
+def tune(options, instances=None, n_trials=20, processes=None, seed=0):
+    '''
+    Tune the solver parameters of the formulation built with options (see the top of the file).
+    Returns the profile: a dict with the parameters, the score of every trial and the thread counts tried.
+    '''
+    if instances is None:
+        instances = tuning_instances()
+    instances = [(name, plain_data(data)) for name, data in instances]
+    with gp.Env(params={'OutputFlag': 0}) as env:
+        instances = applicable_instances(instances, options, env)
+
+    # The default setting first, to drop the instances it cannot solve and to have the reference work.
+    start = time.time()
+    baseline = solve_instances(({}, instances, options, 1))
+    instances = [(name, data) for name, data in instances if 'error' not in baseline[name]]
+    baseline = {name: baseline[name] for name, _ in instances}
+    if not instances:
+        raise ValueError("No instance of the formulation {} can be solved".format(formulation_name(options)))
+
+    settings = sample_settings(n_trials, random.Random(seed))[1:]
+    # Spawned processes do not inherit the Gurobi environment of this one.
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        results = pool.map(solve_instances, [(setting, instances, options, 1) for setting in settings])
+    trials = [{'parameters': {}, 'score': 1.0, 'results': baseline}]
+    trials += [{'parameters': setting, 'score': score(result, baseline), 'results': result}
+               for setting, result in zip(settings, results)]
+    scored = [trial for trial in trials if trial['score'] is not None]
+    best = min(scored, key=lambda trial: trial['score'])
+    if best['score'] >= min_improvement:
+        best = trials[0]
+    search_time = time.time() - start
+
+    # Thread counts of the best setting, one at a time so the wall-clock times are comparable.
+    threads = {}
+    for count in thread_counts:
+        if count > (os.cpu_count() or 1):
+            continue
+        result = solve_instances((best['parameters'], instances, options, count))
+        if not any('error' in row for row in result.values()):
+            threads[count] = sum(row['runtime'] for row in result.values())
+    parameters = dict(best['parameters'])
+    if threads:
+        fastest = min(threads, key=threads.get)
+        if fastest != 1:
+            parameters['Threads'] = fastest
+
+    return {'formulation': formulation_name(options), 'options': options, 'parameters': parameters,
+            'score': best['score'], 'instances': [name for name, _ in instances], 'trials': len(trials),
+            'thread_runtimes': threads, 'search_time': search_time,
+            'ranking': [{'parameters': trial['parameters'], 'score': trial['score']}
+                        for trial in sorted(scored, key=lambda trial: trial['score'])]}
+
+
+def save_profile(profile):
+    # Write the profile to profiles_dir, where build_model() finds it.  Returns its path.
+    os.makedirs(profiles_dir, exist_ok=True)
+    path = os.path.join(profiles_dir, profile['formulation'] + ".json")
+    profile = dict(profile, created=time.strftime("%Y-%m-%dT%H:%M:%S%z"), software=software_versions())
+    with open(path, 'w') as f:
+        json.dump(profile, f, indent=1, default=str)
+    return path
+
+
+if __name__ == "__main__":
+    # Usage: python level3/level3_tuning.py [--trials n] [--processes n] [formulation ...]
+    # The formulations are the names in formulations (default: base).
+    args = sys.argv[1:]
+    n_trials, processes = 20, None
+    while args and args[0] in ('--trials', '--processes') and len(args) > 1:
+        if args[0] == '--trials':
+            n_trials = int(args[1])
+        else:
+            processes = int(args[1])
+        args = args[2:]
+    unknown = [name for name in args if name not in formulations]
+    if unknown:
+        print("Unknown formulations {}, choose from {}".format(unknown, sorted(formulations)))
+        sys.exit(1)
+    try:
+
+        for name in args or ['base']:
+            profile = tune(formulations[name], n_trials=n_trials, processes=processes)
+            path = save_profile(profile)
+            print("\n{}: {} trials on {} in {:.1f}s, best score {:.3f} (1 is the default)".format(
+                profile['formulation'], profile['trials'], ", ".join(profile['instances']), profile['search_time'],
+                profile['score']))
+            for trial in profile['ranking'][:5]:
+                print("\t{:.3f}\t{}".format(trial['score'], trial['parameters'] or "defaults"))
+            print("\tThreads: {}".format(", ".join("{}: {:.3f}s".format(count, runtime)
+                                                   for count, runtime in profile['thread_runtimes'].items())))
+            print("\tProfile {} written to {}".format(profile['parameters'] or "(defaults)", path))
+
+    except gp.GurobiError as e:
+        print('Error code ' + str(e.errno) + ': ' + str(e))